@@ -6,15 +6,23 @@ Supported audio output libraries:
 
 It can play multiple samples at the same time via real-time mixing, and you can
 loop samples as well without noticable overhead (great for continous effects or music)
+The calls into the audio library are done by a separate audio control thread,
+the game only puts commands in a queue so it never has to wait for the mixer.
+The 'null' backend doesn't output anything at all (for headless runs and benchmarks).
+Long sound files (the title music) are not decoded up front but streamed while they play.
 Wav (PCM) files and .ogg files can be loaded (requires oggdec from the
 vorbis-tools package to decode those)
 
 High level api functions:
   init_audio
   play_sample
+  play_batch
   silence_audio
   shutdown_audio
 
+The game logic doesn't call these directly while it's updating the cave,
+it collects the sounds of a logic frame in a SoundQueue instead.
+
 Original version written by Irmen de Jong (irmen@razorvine.net)
 Extended version by Michael Kamensky
 
@@ -27,14 +35,20 @@ import tempfile
 import os
 import random
 import subprocess
-from typing import Union, Dict, Tuple
+import threading
+import traceback
+import queue
+import collections
+import audioop
+import miniaudio
+from typing import Union, Dict, Tuple, List, Optional, Callable, Generator
 from synthplayer import streaming, params as synth_params
 from synthplayer.sample import Sample
 from synthplayer.playback import Output, best_api
-from . import user_data_dir
+from . import user_data_dir, tracing
 
 
-__all__ = ["init_audio", "play_sample", "silence_audio", "shutdown_audio"]
+__all__ = ["init_audio", "play_sample", "play_batch", "silence_audio", "shutdown_audio", "SoundQueue"]
 
 
 def prepare_oggdec_exe():
@@ -65,11 +79,71 @@ except IOError:
 samples = {}    # type: Dict[str, Union[str, Sample]]
 
 
+class StereoPlayback(Sample):
+    # Plays a mono sample through the stereo mixer. The sample data itself stays mono in memory
+    # (all effects are mono C-64 style sounds), each chunk is expanded to stereo only when the mixer asks for it.
+    def __init__(self, sample: Sample) -> None:
+        super().__init__(name=sample.name, samplerate=sample.samplerate, nchannels=2, samplewidth=sample.samplewidth)
+        self.mono = sample
+
+    @property
+    def duration(self) -> float:
+        return self.mono.duration
+
+    def chunked_frame_data(self, chunksize: int, repeat: bool=False,
+                           stopcondition: Callable[[], bool]=lambda: False) -> Generator[memoryview, None, None]:
+        samplewidth = self.samplewidth
+        for chunk in self.mono.chunked_frame_data(chunksize // 2, repeat, stopcondition):
+            yield memoryview(audioop.tostereo(chunk, samplewidth, 1.0, 1.0))
+
+
+class StreamedSample(Sample):
+    # A long sound such as the title music. Only the compressed sound file data is kept in memory,
+    # it is decoded in small read-ahead blocks while it is being played. Mono, like the other samples.
+    readahead_seconds = 0.5
+
+    def __init__(self, data: bytes, name: str) -> None:
+        super().__init__(name=name, nchannels=1)
+        self.data = data
+        self._duration = miniaudio.vorbis_get_info(data).duration
+
+    @property
+    def duration(self) -> float:
+        return self._duration
+
+    def chunked_frame_data(self, chunksize: int, repeat: bool=False,
+                           stopcondition: Callable[[], bool]=lambda: False) -> Generator[memoryview, None, None]:
+        blocksize = int(self.samplerate * self.readahead_seconds)
+        residue = b""
+        while True:
+            for block in miniaudio.stream_memory(self.data, nchannels=1, sample_rate=self.samplerate, frames_to_read=blocksize):
+                frames = residue + block.tobytes()
+                mdata = memoryview(frames)
+                i = 0
+                while len(frames) - i >= chunksize:
+                    if stopcondition():
+                        return
+                    yield mdata[i: i + chunksize]
+                    i += chunksize
+                residue = frames[i:]
+            if not repeat:
+                break
+        if residue:
+            yield memoryview(residue)
+
+
+def playable(sample: Sample) -> Sample:
+    return StereoPlayback(sample) if sample.nchannels == 1 else sample
+
+
 class SoundEngine:
+    stream_min_duration = 15.0      # sound files longer than this (in seconds) are streamed instead of preloaded
+
     def __init__(self, samples_to_load: Dict[str, Tuple[Union[str, Sample], int]]) -> None:
         global samples
         samples.clear()
         self.output = Output(mixing="mix")
+        self.playable = {}      # type: Dict[str, Sample]
         if any(isinstance(smp, str) for smp, _ in samples_to_load.values()):
             print("Loading sound files...")
         for name, (filename, max_simultaneously) in samples_to_load.items():
@@ -77,48 +151,137 @@ class SoundEngine:
                 samples[name] = filename
             else:
                 data = pkgutil.get_data(__name__, "sounds/" + filename)
-                if data:
+                if data and miniaudio.vorbis_get_info(data).duration > self.stream_min_duration:
+                    samples[name] = StreamedSample(data, name)
+                elif data:
                     tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".ogg")
                     try:
                         tmp.write(data)
                         tmp.close()
-                        samples[name] = Sample(streaming.AudiofileToWavStream(tmp.name), name).stereo()
+                        # the sound files are all mono, keep them that way (stereo expansion is done while mixing)
+                        samples[name] = Sample(streaming.AudiofileToWavStream(tmp.name, channels=1), name)
                     finally:
                         os.remove(tmp.name)
                 else:
                     raise SystemExit("corrupt package; sound data is missing")
+            self.playable[name] = playable(samples[name])
             self.output.set_sample_play_limit(name, max_simultaneously)
         print("Sound API initialized:", self.output.audio_api)
-
-    def play_sample(self, samplename, repeat=False, after=0.0):
-        self.output.play_sample(samples[samplename], repeat, after)
-
-    def silence(self, sid_or_name=None):
+        # the output is only used from the audio control thread from now on
+        self.commands = queue.SimpleQueue()     # type: queue.SimpleQueue
+        self.num_commands = 0
+        self.enqueue_time = 0.0     # time the game thread spent in the sound engine calls
+        self.backend_time = 0.0     # time spent in the audio library calls (the game thread used to be blocked for this)
+        self.command_thread = threading.Thread(target=self._process_commands, name="audio-control", daemon=True)
+        self.command_thread.start()
+
+    def _process_commands(self) -> None:
+        while True:
+            command = self.commands.get()
+            if command is None:
+                break
+            func, args = command
+            start = time.perf_counter()
+            try:
+                func(*args)
+            except Exception:
+                # a failing command must not stop the audio control thread, or all later sounds are lost
+                print("Audio: {:s}{!r} failed:".format(func.__name__, args))
+                traceback.print_exc()
+            self.backend_time += time.perf_counter() - start
+            self.num_commands += 1
+
+    def _enqueue(self, func, *args) -> None:
+        start = time.perf_counter()
+        self.commands.put((func, args))
+        self.enqueue_time += time.perf_counter() - start
+
+    def _play_sample(self, samplename, repeat, after):
+        self.output.play_sample(self.playable[samplename], repeat, after)
+
+    def _silence(self, sid_or_name):
         if sid_or_name:
             self.output.stop_sample(sid_or_name)
         else:
             self.output.silence()
 
+    def _play_batch(self, silenced, plays):
+        # first stop the sounds that were silenced during the frame, then start the new ones
+        for sid_or_name in silenced:
+            self._silence(sid_or_name)
+        for samplename, repeat, after in plays:
+            self._play_sample(samplename, repeat, after)
+
+    def play_sample(self, samplename, repeat=False, after=0.0):
+        self._enqueue(self._play_sample, samplename, repeat, after)
+
+    def silence(self, sid_or_name=None):
+        self._enqueue(self._silence, sid_or_name)
+
+    def play_batch(self, silenced: List[Optional[str]], plays: List[Tuple[str, bool, float]]) -> None:
+        self._enqueue(self._play_batch, list(silenced), list(plays))
+
     def close(self):
+        self.commands.put(None)
+        self.command_thread.join()
         self.output.close()
+        print("Audio: {:d} commands, {:.1f} ms in the audio library, {:.1f} ms spent by the game thread."
+              .format(self.num_commands, self.backend_time * 1000, self.enqueue_time * 1000))
 
 
-sound_engine = None
+class NullSoundEngine:
+    # Accepts all sound engine calls without an audio device, and without decoding any sound data.
+    # It only counts the sample triggers (and optionally logs them), for tests and headless benchmark runs.
+    def __init__(self, samples_to_load: Dict[str, Tuple[Union[str, Sample], int]], log_triggers: bool=False) -> None:
+        global samples
+        samples.clear()
+        for name, (sample, _) in samples_to_load.items():
+            samples[name] = sample if isinstance(sample, Sample) else Sample(name=name)
+        self.log_triggers = log_triggers
+        self.triggers = collections.Counter()     # type: collections.Counter
+        self.num_silenced = 0
+        print("Sound API initialized: null (no audio output)")
 
+    def play_sample(self, samplename, repeat=False, after=0.0):
+        if samplename not in samples:
+            raise KeyError(samplename)
+        self.triggers[samplename] += 1
+        if self.log_triggers:
+            print("Audio: play", samplename, "(repeat)" if repeat else "")
+
+    def silence(self, sid_or_name=None):
+        self.num_silenced += 1
+        if self.log_triggers:
+            print("Audio: silence", sid_or_name or "all")
+
+    def play_batch(self, silenced: List[Optional[str]], plays: List[Tuple[str, bool, float]]) -> None:
+        for sid_or_name in silenced:
+            self.silence(sid_or_name)
+        for samplename, repeat, after in plays:
+            self.play_sample(samplename, repeat, after)
+
+    def close(self):
+        print("Audio: {:d} sample triggers, {:d} silence calls (null backend)."
+              .format(sum(self.triggers.values()), self.num_silenced))
+
+
+backends = ("default", "null")
+sound_engine = None     # type: Union[SoundEngine, NullSoundEngine, None]
 
-def init_audio(samples_to_load) -> SoundEngine:
+
+def init_audio(samples_to_load, backend="default") -> Union[SoundEngine, NullSoundEngine]:
     global sound_engine
-    sound_engine = SoundEngine(samples_to_load)
+    if backend == "null":
+        sound_engine = NullSoundEngine(samples_to_load)
+    else:
+        sound_engine = SoundEngine(samples_to_load)
     return sound_engine
 
 
+@tracing.traced("play_sample", "audio")
 def play_sample(samplename, repeat=False, after=0.0):
     return sound_engine.play_sample(samplename, repeat, after)
 
-# Krissz Engine specific boulder fall sound, a choice from one of two possibilities
-def play_krissz_boulder_sample(repeat=False, after=0.0):
-    return sound_engine.play_sample(random.choice(["boulder", "boulder2"]), repeat, after)
-
 # Krissz Engine sometimes plays a single diamond fall sound, and sometimes two overlapping diamond fall sounds
 def play_krissz_diamond_sample():
     diamond_sounds = [1, 2, 3, 4, 5, 6]
@@ -128,21 +291,123 @@ def play_krissz_diamond_sample():
         diamond_sounds.remove(first_sound)
         sound_engine.play_sample("diamond" + str(random.choice(diamond_sounds)), after=0.170)
 
-def play_timeout_sample(id):
-    for i in range(9):
-        silence_audio("timeout" + str(i))
-    sound_engine.play_sample("timeout" + str(id))
-
 
+@tracing.traced("silence_audio", "audio")
 def silence_audio(sid_or_name=None):
     sound_engine.silence(sid_or_name)
 
 
+@tracing.traced("play_batch", "audio")
+def play_batch(silenced, plays):
+    sound_engine.play_batch(silenced, plays)
+
+
+class SoundQueue:
+    # Collects the sounds triggered during a single game logic frame.
+    # At the end of the frame the requests are deduplicated per sample (or per sound group such as
+    # all boulder or all diamond sounds), sorted on priority, capped, and sent to the sound engine in one batch.
+    # Looping sounds (amoeba, magic wall) are started once and not retried, so they're never capped.
+    # This prevents grindy sounds and flooding the mixer on busy maps like Blifil.
+    # Outside of a frame (title screen, level loading from a keypress, ...) sounds are passed on immediately.
+    priorities = {
+        "music": 9, "finished": 9, "game_over": 9,
+        "extra_life": 8,
+        "explosion": 7, "voodoo_explosion": 7,
+        "cover": 6, "timeout": 6,
+        "amoeba": 5, "magic_wall": 5, "collect_diamond": 5,
+        "crack": 4,
+        "slime": 3, "box_push": 3,
+        "boulder": 2, "diamond": 2,
+        "walk_dirt": 1, "walk_empty": 1
+    }
+    max_plays_per_frame = 8
+
+    def __init__(self) -> None:
+        self.in_frame = False
+        self.silenced = []      # type: List[Optional[str]]
+        self.plays = []         # type: List[Tuple[str, bool, float]]
+        self.groups = set()     # type: set
+        self.play_groups = {}   # type: Dict[str, str]  # the group that each queued sample was played in
+        self.frame_sounds = 0   # the number of sounds sent to the sound engine at the end of the last frame
+
+    def begin_frame(self) -> None:
+        self.in_frame = True
+        self.frame_sounds = 0
+
+    def end_frame(self) -> None:
+        self.in_frame = False
+        if not self.silenced and not self.plays:
+            return
+        plays = sorted(self.plays, key=lambda play: -self.priority(play[0]))
+        plays = [play for play in plays if play[1]] + [play for play in plays if not play[1]][:self.max_plays_per_frame]
+        self.frame_sounds = len(plays)
+        play_batch(self.silenced, plays)
+        self.silenced = []
+        self.plays = []
+        self.groups.clear()
+        self.play_groups.clear()
+
+    def priority(self, samplename: str) -> int:
+        return self.priorities.get(samplename.rstrip("0123456789"), 0)
+
+    def play(self, samplename: str, repeat: bool=False, after: float=0.0, group: str="") -> None:
+        if not self.in_frame:
+            play_sample(samplename, repeat, after)
+            return
+        group = group or samplename
+        if group in self.groups:
+            return
+        self.groups.add(group)
+        self.play_groups[samplename] = group
+        self.plays.append((samplename, repeat, after))
+
+    def silence(self, sid_or_name: Optional[str]=None) -> None:
+        if not self.in_frame:
+            silence_audio(sid_or_name)
+            return
+        # whatever was queued earlier in this frame and is now silenced, doesn't have to be played at all
+        if sid_or_name:
+            self.plays = [play for play in self.plays if play[0] != sid_or_name]
+            self.groups.discard(self.play_groups.pop(sid_or_name, sid_or_name))
+        else:
+            self.plays.clear()
+            self.silenced.clear()
+            self.groups.clear()
+            self.play_groups.clear()
+        if sid_or_name not in self.silenced:
+            self.silenced.append(sid_or_name)
+
+    def play_krissz_boulder(self) -> None:
+        # Krissz Engine specific boulder fall sound, a choice from one of two possibilities
+        self.play(random.choice(["boulder", "boulder2"]), group="boulder")
+
+    def play_krissz_diamond(self) -> None:
+        # Krissz Engine sometimes plays a single diamond fall sound, and sometimes two overlapping diamond fall sounds
+        if not self.in_frame:
+            play_krissz_diamond_sample()
+            return
+        if "diamond" in self.groups:
+            return
+        diamond_sounds = [1, 2, 3, 4, 5, 6]
+        first_sound = random.choice(diamond_sounds)
+        self.play("diamond" + str(first_sound), group="diamond")
+        if random.randint(1, 2) == 2:
+            diamond_sounds.remove(first_sound)
+            self.plays.append(("diamond" + str(random.choice(diamond_sounds)), False, 0.170))
+
+    def play_timeout(self, id: int) -> None:
+        for i in range(9):
+            self.silence("timeout" + str(i))
+        self.play("timeout" + str(id))
+
+
 def shutdown_audio():
     sound_engine.close()
 
 
-def check_api():
+def check_api(backend="default"):
+    if backend == "null":
+        return
     a = best_api()
     a.close()
 
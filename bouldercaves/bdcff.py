@@ -15,9 +15,18 @@ Extended version by Michael Kamensky
 License: GNU GPL 3.0, see LICENSE
 """
 
+import io
+import os
+import re
 import sys
+import json
+import mmap
+import locale
+import hashlib
 import datetime
-from typing import Dict, List, Any, TextIO, Optional, Union
+import collections
+from typing import Dict, List, Any, TextIO, Optional, Union, Tuple
+from . import user_data_dir
 
 
 def get_system_username():
@@ -35,6 +44,17 @@ class BdcffFormatError(Exception):
     pass
 
 
+cache_dir = os.path.join(user_data_dir, "cavecache")
+cache_enabled = True    # parsed cavesets are cached under the user data dir, set to False to always parse the file
+CACHE_VERSION = 2
+
+
+def warn(warnings: List[str], message: str) -> None:
+    # parser warnings are printed, and kept so that a caveset from the parse cache can print them again
+    print(message)
+    warnings.append(message)
+
+
 class BdcffCave:
     class Map:
         def __init__(self):
@@ -50,6 +70,7 @@ class BdcffCave:
         self.properties = {}
         self.map = self.Map()
         self.objects = []
+        self.warnings = []      # type: List[str]
         self.intermission = False
         self.cavetime = 200
         self.slimepermeability = 1.0
@@ -135,8 +156,10 @@ class BdcffCave:
             pwidth, pheight = psize.split()[:2]
             pwidth = int(pwidth)
             pheight = int(pheight)
-            if pwidth != self.width or pheight != self.height:
-                raise BdcffFormatError("cave width or height doesn't match map, in cave " + self.name)
+            if pheight != self.height:
+                raise BdcffFormatError("map has {:d} lines but Size= says {:d}, in cave {:s}".format(self.height, pheight, self.name))
+            if pwidth != self.width:
+                raise BdcffFormatError("map width {:d} doesn't match Size= width {:d}, in cave {:s}".format(self.width, pwidth, self.name))
         self.properties.pop("cavedelay", 0)
         self.properties.pop("frametime", 0)
         # substandard properties for this extended version
@@ -165,8 +188,7 @@ class BdcffCave:
             self.properties.pop("timevalue", "1") # Krissz Engine variant takes priority
         self.single_life = self.properties.pop("singlelife", "false") == "true"
         if self.properties:
-            print("\nWARNING: unrecognised cave properties in cave " + self.name + " :")
-            print(self.properties, "\n")
+            warn(self.warnings, "\nWARNING: unrecognised cave properties in cave " + self.name + " :\n" + str(self.properties) + " \n")
         del self.properties
 
     def validate(self):
@@ -261,7 +283,7 @@ class BdcffParser:
     COLORNAMES = ["Black", "White", "Red", "Cyan", "Purple", "Green", "Blue", "Yellow",
                   "Orange", "Brown", "LightRed", "Gray1", "Gray2", "LightGreen", "LightBlue", "Gray3"]
 
-    def __init__(self, filename: Optional[str]=None) -> None:
+    def __init__(self, filename: Optional[str]=None, use_cache: bool=True) -> None:
         self.state = 0
         self.bdcff_version = ""
         self.game_properties = {}   # type: Dict[str, Any]
@@ -275,7 +297,11 @@ class BdcffParser:
         self.date = str(datetime.datetime.now().date())
         self.name = "Unnamed"
         self.description = ""
+        self.warnings = []      # type: List[str]
         if filename:
+            use_cache = use_cache and cache_enabled
+            if use_cache and self.load_cache(filename):
+                return
             with open(filename, "r") as f:
                 for line in f:
                     line = line.rstrip('\n')
@@ -283,6 +309,67 @@ class BdcffParser:
                         self.parse(line)
             self.postprocess()
             self.validate()
+            if use_cache:
+                self.save_cache(filename)
+
+    @property
+    def cave_names(self) -> List[str]:
+        return [cave.name for cave in self.caves]
+
+    def cave(self, index: int) -> 'BdcffCave':
+        # the same interface as BdcffCaveIndex, so a CaveSet can also be made from an already parsed file
+        return self.caves[index]
+
+    @staticmethod
+    def cache_key(filename: str) -> Dict[str, Any]:
+        # the parsed caveset cache is invalidated when the path, size or modification time of the file changes
+        stat = os.stat(filename)
+        return {"version": CACHE_VERSION, "path": os.path.abspath(filename), "size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+    @staticmethod
+    def cache_filename(filename: str) -> str:
+        return os.path.join(cache_dir, hashlib.sha1(os.path.abspath(filename).encode()).hexdigest() + ".json")
+
+    def load_cache(self, filename: str) -> bool:
+        try:
+            with open(self.cache_filename(filename), "r") as f:
+                cached = json.load(f)
+            if cached["key"] != self.cache_key(filename):
+                return False
+            caves = []
+            for cavedata in cached["caves"]:
+                cave = BdcffCave()
+                del cave.properties
+                cave.map.maplines = cavedata.pop("maplines")
+                cave.map.postprocess()
+                cave.__dict__.update(cavedata)
+                caves.append(cave)
+        except (OSError, ValueError, LookupError, TypeError):
+            return False
+        self.__dict__.update(cached["game"])
+        self.caves = caves
+        del self.game_properties
+        del self.current_cave
+        del self.state
+        for message in self.warnings:
+            print(message)
+        return True
+
+    def save_cache(self, filename: str) -> None:
+        caves = []
+        for cave in self.caves:
+            cavedata = {name: value for name, value in vars(cave).items() if name != "map"}
+            cavedata["maplines"] = cave.map.maplines
+            caves.append(cavedata)
+        game = {name: value for name, value in vars(self).items() if name != "caves"}
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            cachefile = self.cache_filename(filename)
+            with open(cachefile + ".tmp", "w") as f:
+                json.dump({"key": self.cache_key(filename), "game": game, "caves": caves}, f, separators=(",", ":"))
+            os.replace(cachefile + ".tmp", cachefile)
+        except OSError:
+            pass    # caching is just an optimization
 
     def write(self, out: TextIO) -> None:
         if self.num_levels != 1:
@@ -310,6 +397,16 @@ class BdcffParser:
         out.write("\n[/game]\n[/BDCFF]\n")
 
     def postprocess(self) -> None:
+        self.postprocess_game_properties()
+        for cave in self.caves:
+            cave.postprocess()
+            cave.validate()
+            self.warnings.extend(cave.warnings)
+        self.num_caves = self.num_caves or len(self.caves)
+        del self.current_cave
+        del self.state
+
+    def postprocess_game_properties(self) -> None:
         self.num_levels = int(self.game_properties.pop("levels", 1))
         self.num_caves = int(self.game_properties.pop("caves", 0))
         self.name = self.game_properties.pop("name")
@@ -323,15 +420,8 @@ class BdcffParser:
         self.fontset = self.game_properties.pop("fontset", "Original")
         self.bonus_life_points = int(self.game_properties.pop("bonuslife", 500))
         if self.game_properties:
-            print("\nWARNING: unrecognised bdcff properties:")
-            print(self.game_properties, "\n")
+            warn(self.warnings, "\nWARNING: unrecognised bdcff properties:\n" + str(self.game_properties) + " \n")
         del self.game_properties
-        for cave in self.caves:
-            cave.postprocess()
-            cave.validate()
-        self.num_caves = self.num_caves or len(self.caves)
-        del self.current_cave
-        del self.state
 
     def validate(self) -> None:
         if self.charset != "Original" or self.fontset != "Original":
@@ -339,7 +429,7 @@ class BdcffParser:
         if self.num_caves <= 0 or self.num_caves != len(self.caves):
             raise BdcffFormatError("invalid number of caves")
         if self.num_levels != 1:
-            print("WARNING: only supports loading the first difficulty level")
+            warn(self.warnings, "WARNING: only supports loading the first difficulty level")
 
     def parse(self, line: str) -> None:
         if line == '[BDCFF]' and self.state == 0:
@@ -416,6 +506,100 @@ class BdcffParser:
             raise BdcffFormatError("bdcff parse error, state=" + str(self.state) + " line=" + line)
 
 
+class BdcffCaveIndex:
+    # Indexes a BDCFF file without parsing all of its caves. Only the game header is parsed; for every [cave] block
+    # just its name and byte range in the (memory mapped) file are recorded. A cave is parsed when it's needed,
+    # and a few of the parsed caves are kept in a LRU cache. This makes loading independent of the number of caves.
+    # If the parse cache has the file (the launcher's cave index and the validator fill it), the caves come from there.
+    cave_start_tag = re.compile(rb"^\[cave\][ \t]*\r?$", re.MULTILINE)
+    cave_end_tag = re.compile(rb"^\[/cave\][ \t]*\r?$", re.MULTILINE)
+    cave_name = re.compile(rb"^name=(.*?)\r?$", re.MULTILINE | re.IGNORECASE)
+    lru_size = 4
+    header_attributes = ("bdcff_version", "num_levels", "num_caves", "charset", "fontset",
+                         "author", "www", "date", "name", "description", "bonus_life_points")
+
+    def __init__(self, filename: str, use_cache: bool=True) -> None:
+        self.filename = filename
+        self.use_cache = use_cache
+        self.encoding = locale.getpreferredencoding(False)  # the same as when the file is read in text mode
+        self._build_index()
+
+    def _build_index(self) -> None:
+        self.cave_ranges = []   # type: List[Tuple[int, int]]
+        self.cave_names = []    # type: List[str]
+        self.parsed_caves = collections.OrderedDict()   # type: collections.OrderedDict
+        self.cached_caves = None    # type: Optional[List[BdcffCave]]
+        self.file_key = BdcffParser.cache_key(self.filename)
+        if self.use_cache and cache_enabled:
+            cached = BdcffParser()
+            if cached.load_cache(self.filename):
+                for attr in self.header_attributes:
+                    setattr(self, attr, getattr(cached, attr))
+                self.cached_caves = cached.caves
+                self.cave_names = [cave.name for cave in cached.caves]
+                return
+        with open(self.filename, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                raise BdcffFormatError("empty cave file")
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                self.index(mm)
+
+    def index(self, mm: mmap.mmap) -> None:
+        header = BdcffParser()
+        position = 0
+        while True:
+            match = self.cave_start_tag.search(mm, position)
+            if not match:
+                break
+            self.parse_lines(header, mm[position:match.start()])
+            end_match = self.cave_end_tag.search(mm, match.end())
+            if not end_match:
+                raise BdcffFormatError("unterminated [cave] block")
+            name_match = self.cave_name.search(mm, match.end(), end_match.start())
+            self.cave_names.append(name_match.group(1).decode(self.encoding) if name_match else "")
+            self.cave_ranges.append((match.start(), end_match.end()))
+            position = end_match.end()
+        self.parse_lines(header, mm[position:])
+        header.postprocess_game_properties()
+        header.num_caves = header.num_caves or len(self.cave_ranges)
+        for attr in self.header_attributes:
+            setattr(self, attr, getattr(header, attr))
+        if self.charset != "Original" or self.fontset != "Original":
+            raise BdcffFormatError("invalid or unsupported cave data")
+        if self.num_caves <= 0 or self.num_caves != len(self.cave_ranges):
+            raise BdcffFormatError("invalid number of caves")
+        if self.num_levels != 1:
+            print("WARNING: only supports loading the first difficulty level")
+
+    def parse_lines(self, parser: 'BdcffParser', data: bytes) -> None:
+        for line in io.StringIO(data.decode(self.encoding), newline=None):
+            line = line.rstrip('\n')
+            if line and not line.startswith(';'):
+                parser.parse(line)
+
+    def cave(self, index: int) -> BdcffCave:
+        if index in self.parsed_caves:
+            self.parsed_caves.move_to_end(index)
+            return self.parsed_caves[index]
+        if BdcffParser.cache_key(self.filename) != self.file_key:
+            # the file has changed since it was indexed (the number of caves may have changed too)
+            self._build_index()
+        if self.cached_caves is not None:
+            return self.cached_caves[index]
+        start, end = self.cave_ranges[index]
+        parser = BdcffParser()
+        parser.state = parser.SECT_GAME
+        with open(self.filename, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            self.parse_lines(parser, mm[start:end])
+        cave = parser.caves[0]
+        cave.postprocess()
+        cave.validate()
+        self.parsed_caves[index] = cave
+        if len(self.parsed_caves) > self.lru_size:
+            self.parsed_caves.popitem(last=False)
+        return cave
+
+
 if __name__ == "__main__":
     cave = BdcffParser(sys.argv[1])
     cave.write(sys.stdout)
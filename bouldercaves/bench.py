@@ -0,0 +1,269 @@
+"""
+Boulder Caves+ - a Boulder Dash (tm) clone.
+Krissz Engine-compatible remake based on Boulder Caves 5.7.2.
+
+Headless benchmarks.
+'logic' runs GameState.update without a window on every built-in BD1 cave and every cave
+in the given cave files/directories (default: caves/), for a fixed number of frames with a seeded
+input script, and reports the updates per second and microseconds per cell for every cave.
+The results are written as JSON and can be compared against a stored baseline.
+
+$ python3 -m bouldercaves.bench logic -o bench.json
+$ python3 -m bouldercaves.bench logic --baseline bench.json
+
+Extended version by Michael Kamensky
+
+License: GNU GPL 3.0, see LICENSE
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import platform
+import statistics
+import contextlib
+from typing import Dict, List, Tuple, Any, Optional, Sequence
+from . import gamelogic, caves, tiles, objects, bdcff, audio
+from .game import sample_files, __version__
+from .validate import find_cave_files
+
+
+class HeadlessGame:
+    # Stands in for the BoulderWindow: GameState draws into plain tilesheets, everything else is ignored.
+    visible_columns = 40
+    visible_rows = 22
+    mirrored_border_size = 0
+    stippled_mirrored_border = False
+    smallwindow = False
+    window30x18 = False
+    c64colors = False
+    update_fps = 60
+    tile_image_numcolumns = 8
+
+    def __init__(self, krissz_engine_compat: bool=False) -> None:
+        self.krissz_engine_compat = krissz_engine_compat
+        self.tilesheet = tiles.Tilesheet(self.visible_columns, self.visible_rows, self.visible_columns, self.visible_rows)
+        self.tilesheet_score = tiles.Tilesheet(self.visible_columns, 2, self.visible_columns, 2)
+        self.view_x = self.view_y = 0
+        self.graphics_frame = self.popup_frame = 0
+        self.canvas = None
+
+    def create_canvas_playfield_and_tilesheet(self, width: int, height: int) -> None:
+        self.tilesheet = tiles.Tilesheet(width, height, self.visible_columns, self.visible_rows)
+
+    def set_canvas_tile(self, x: int, y: int, obj: objects.GameObject) -> None:
+        self.tilesheet[x, y] = obj.tile()
+
+    def set_scorebar_tiles(self, x: int, y: int, tiles: Sequence[int]) -> None:
+        self.tilesheet_score.set_tiles(x, y, tiles)
+
+    def clear_tilesheet(self) -> None:
+        self.tilesheet.set_tiles(0, 0, [objects.DIRT2.tile()] * self.tilesheet.width * self.tilesheet.height)
+
+    def scrollxypixels(self, x: float, y: float) -> None:
+        self.view_x, self.view_y = int(x), int(y)
+
+    def scroll_focuscell_into_view(self, immediate: bool=False, center: bool=False) -> None:
+        pass
+
+    def popup(self, *args, **kwargs) -> None:
+        pass
+
+    def popup_close(self) -> None:
+        pass
+
+    def create_colored_tiles(self, colors: caves.Palette, source_images: Sequence[bytes]=None) -> None:
+        pass
+
+    def prepare_colored_tiles(self, colors: caves.Palette) -> Optional[Sequence[bytes]]:
+        return None
+
+    def set_screen_colors(self, screen: Any, border: Any) -> None:
+        pass
+
+    def prepare_reveal(self) -> None:
+        pass
+
+    def ask_highscore_name(self, score_pos: int, score: int) -> str:
+        return ""
+
+
+def input_script(seed: int, frames: int, hold: int=4) -> List[Optional[str]]:
+    # a direction (or None to stand still) for every frame, changing every few frames
+    rnd = random.Random(seed)
+    script = []     # type: List[Optional[str]]
+    for frame in range(frames):
+        if frame % hold == 0:
+            direction = rnd.choice(("up", "down", "left", "right", "left", "right", None))
+        script.append(direction)
+    return script
+
+
+def run_cave(gamestate: gamelogic.GameState, levelnumber: int, frames: int, warmup: int, seed: int) -> float:
+    # Plays the cave for warmup + frames updates and returns the time spent in the timed updates.
+    # When the cave ends (won or lost) it is loaded again; that isn't timed. The level changes are
+    # collected in deferred_actions (as with the logic worker) and never done.
+    def load() -> None:
+        with contextlib.redirect_stdout(io.StringIO()):
+            gamestate.load_level(levelnumber, level_intro_popup=False)
+        gamestate.game_status = gamelogic.GameStatus.PLAYING
+
+    random.seed(seed)
+    script = input_script(seed, warmup + frames)
+    load()
+    gamestate.deferred_actions = []
+    duration = 0.0
+    try:
+        for frame, direction in enumerate(script):
+            movement = gamestate.movement
+            movement.stop_all()
+            if direction:
+                getattr(movement, "start_" + direction)()
+            start = time.perf_counter()
+            gamestate.update(frame)
+            if frame >= warmup:
+                duration += time.perf_counter() - start
+            if gamestate.deferred_actions or gamestate.level_won or gamestate.game_status != gamelogic.GameStatus.PLAYING:
+                gamestate.deferred_actions.clear()
+                load()
+    finally:
+        gamestate.deferred_actions = None
+    return duration
+
+
+def bench_caveset(caveset_name: str, filename: Optional[str], frames: int, warmup: int, repeats: int,
+                  seed: int, krissz: bool) -> List[Dict[str, Any]]:
+    gamestate = gamelogic.GameState(HeadlessGame(krissz))
+    results = []
+    try:
+        if filename:
+            with contextlib.redirect_stdout(io.StringIO()):
+                gamestate.use_bdcff(filename)
+    except (bdcff.BdcffFormatError, ValueError, LookupError, OSError, UnicodeDecodeError) as x:
+        return [{"caveset": caveset_name, "cave": 0, "error": "{}: {}".format(type(x).__name__, x)}]
+    for levelnumber in range(1, gamestate.caveset.num_caves + 1):
+        result = {"caveset": caveset_name, "cave": levelnumber}     # type: Dict[str, Any]
+        try:
+            durations = [run_cave(gamestate, levelnumber, frames, warmup, seed) for _ in range(repeats)]
+        except Exception as x:
+            result["error"] = "{}: {}".format(type(x).__name__, x)
+            results.append(result)
+            continue
+        cells = len(gamestate.cave)
+        best = min(durations)
+        result.update({
+            "name": gamestate.level_name,
+            "width": gamestate.width,
+            "height": gamestate.height,
+            "cells": cells,
+            "frames": frames,
+            "fps": frames / best,
+            "median_fps": frames / statistics.median(durations),
+            "us_per_cell": best / frames / cells * 1e6
+        })
+        results.append(result)
+    return results
+
+
+def cave_files(paths: Sequence[str]) -> List[Tuple[str, str]]:
+    # (name, filename) of the cave files; the name is the path relative to the scanned directory,
+    # so that results from runs in different working directories can be compared
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend((os.path.relpath(filename, path).replace(os.sep, "/"), filename) for filename in find_cave_files([path]))
+        else:
+            files.append((os.path.basename(path), path))
+    return files
+
+
+def bench_logic(paths: Sequence[str], bd1: bool=True, frames: int=300, warmup: int=30, repeats: int=3,
+                seed: int=1, krissz: bool=False, progress: bool=True) -> Dict[str, Any]:
+    cavesets = [("BD1", None)] if bd1 else []
+    cavesets += cave_files(paths)
+    results = []
+    for number, (name, filename) in enumerate(cavesets, start=1):
+        if progress:
+            print("[{:d}/{:d}] {:s}".format(number, len(cavesets), name), file=sys.stderr)
+        results.extend(bench_caveset(name, filename, frames, warmup, repeats, seed, krissz))
+    measured = [result for result in results if "error" not in result]
+    return {
+        "suite": "logic",
+        "version": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {"frames": frames, "warmup": warmup, "repeats": repeats, "seed": seed, "krissz": krissz},
+        "summary": {
+            "caves": len(measured),
+            "errors": len(results) - len(measured),
+            "geomean_fps": statistics.geometric_mean([result["fps"] for result in measured]) if measured else 0.0,
+            "median_us_per_cell": statistics.median([result["us_per_cell"] for result in measured]) if measured else 0.0
+        },
+        "caves": results
+    }
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any]) -> Tuple[float, int]:
+    # Prints the caves that changed more than 10%, and the caves that were measured in only one of the two runs.
+    # Returns the geometric mean of the fps ratios and the number of baseline caves that weren't measured now.
+    baseline_fps = {(result["caveset"], result["cave"]): result["fps"] for result in baseline["caves"] if "fps" in result}
+    new_fps = {(result["caveset"], result["cave"]): result["fps"] for result in results["caves"] if "fps" in result}
+    ratios = []
+    for (caveset, cave), fps in new_fps.items():
+        old_fps = baseline_fps.get((caveset, cave))
+        if old_fps is None:
+            print("{:s} cave {:d}: not in the baseline".format(caveset, cave))
+            continue
+        ratio = fps / old_fps
+        ratios.append(ratio)
+        if abs(ratio - 1) > 0.1:
+            print("{:s} cave {:d}: {:.0f} -> {:.0f} fps ({:+.0f}%)".format(caveset, cave, old_fps, fps, (ratio - 1) * 100))
+    missing = [key for key in baseline_fps if key not in new_fps]
+    for caveset, cave in missing:
+        print("{:s} cave {:d}: missing (failed or not found)".format(caveset, cave))
+    return (statistics.geometric_mean(ratios) if ratios else 1.0), len(missing)
+
+
+def main(sargs: Sequence[str]=None) -> int:
+    if sargs is None:
+        sargs = sys.argv[1:]
+    import argparse
+    ap = argparse.ArgumentParser(description="Boulder Caves+ - headless benchmarks")
+    ap.add_argument("suite", choices=("logic",), help="the benchmark to run: 'logic' runs the game logic updates.")
+    ap.add_argument("paths", nargs="*", help="cave files and/or directories with caves (default=caves).")
+    ap.add_argument("--no-bd1", help="skip the built-in BD1 caves.", action="store_true")
+    ap.add_argument("-n", "--frames", type=int, help="timed updates per cave (default=%(default)d).", default=300)
+    ap.add_argument("-w", "--warmup", type=int, help="untimed updates before the timed ones (default=%(default)d).", default=30)
+    ap.add_argument("-r", "--repeats", type=int, help="runs per cave, the fastest counts (default=%(default)d).", default=3)
+    ap.add_argument("-s", "--seed", type=int, help="seed for the input script and the game's random numbers (default=%(default)d).", default=1)
+    ap.add_argument("-k", "--krissz", help="use the Krissz Engine compatibility mode.", action="store_true")
+    ap.add_argument("-o", "--output", help="write the results as JSON to this file.")
+    ap.add_argument("--baseline", help="compare against the results in this JSON file.")
+    ap.add_argument("--max-slowdown", type=float, help="with --baseline, fail if the average fps dropped by more than this fraction (default=%(default)s).", default=0.1)
+    args = ap.parse_intermixed_args(sargs)
+    paths = args.paths or (["caves"] if os.path.isdir("caves") else [])
+    audio.init_audio(sample_files(args.krissz), "null")
+    results = bench_logic(paths, not args.no_bd1, args.frames, args.warmup, args.repeats, args.seed, args.krissz)
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump(results, out, indent=1)
+    summary = results["summary"]
+    print("{caves:d} caves ({errors:d} errors): {geomean_fps:.0f} updates/s (geometric mean), "
+          "{median_us_per_cell:.2f} us per cell (median).".format(**summary))
+    for result in results["caves"]:
+        if "error" in result:
+            print("{:s} cave {:d}: {:s}".format(result["caveset"], result["cave"], result["error"]))
+    failed = summary["errors"] > 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            ratio, missing = compare(results, json.load(f))
+        print("Compared to the baseline: {:+.1f}% fps, {:d} caves missing.".format((ratio - 1) * 100, missing))
+        failed = failed or missing > 0 or ratio < 1 - args.max_slowdown
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
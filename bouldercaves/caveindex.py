@@ -0,0 +1,190 @@
+"""
+Boulder Caves+ - a Boulder Dash (tm) clone.
+Krissz Engine-compatible remake based on Boulder Caves 5.7.2.
+
+Metadata index of the cave files in the cave library (the caves/ directory), used by the launcher.
+The index is stored under the user data dir and refreshed incrementally: only files that are
+new or whose modification time or size changed are parsed again.
+
+Extended version by Michael Kamensky
+
+License: GNU GPL 3.0, see LICENSE
+"""
+
+import os
+import json
+import threading
+from typing import Dict, List, Any, Optional, Callable
+from . import bdcff, caves, objects, user_data_dir
+
+
+INDEX_VERSION = 2
+CAVEFILE_EXTENSIONS = (".bd", ".bdcff")
+
+
+def cave_flags(cave: bdcff.BdcffCave) -> List[str]:
+    # the substandard (Krissz Engine) and other special properties that a cave uses
+    flags = {
+        "intermission": cave.intermission,
+        "wraparound": cave.wraparound,
+        "no lineshift": not cave.lineshift,
+        "target fps": float(cave.target_fps) != 7.0,
+        "magic wall stops amoeba": cave.magic_wall_stops_amoeba,
+        "amoeba grows before spawn": cave.amoeba_grows_before_spawn,
+        "rockford birth time": cave.rockford_birth_time != -1,
+        "amoeba limit": cave.amoeba_limit != -1,
+        "no time limit": cave.no_time_limit,
+        "reverse time": cave.reverse_time,
+        "open horizontal borders": cave.open_horizontal_borders,
+        "open vertical borders": cave.open_vertical_borders,
+        "value of a second": cave.value_of_a_second != 1,
+        "single life": cave.single_life,
+        "krissz slime permeability": cave.krissz_slime_permeability >= 0
+    }
+    return [flag for flag, used in flags.items() if used]
+
+
+# flags for notable objects on the cave maps, from the cave histograms
+OBJECT_FLAGS = {
+    "amoeba": (objects.AMOEBA,),
+    "slime": (objects.SLIME,),
+    "magic wall": (objects.MAGICWALL,),
+    "expanding wall": (objects.EXPANDINGWALL, objects.HEXPANDINGWALL, objects.VEXPANDINGWALL),
+    "voodoo": (objects.VOODOO,),
+    "fireflies": (objects.FIREFLY, objects.ALTFIREFLY),
+    "butterflies": (objects.BUTTERFLY, objects.ALTBUTTERFLY)
+}
+
+
+def cave_file_metadata(filename: str) -> Dict[str, Any]:
+    try:
+        parser = bdcff.BdcffParser(filename)
+        caveset = caves.CaveSet(parser)
+        histograms = [caves.cave_histogram(caveset.cave(levelnumber)) for levelnumber in range(1, caveset.num_caves + 1)]
+    except (bdcff.BdcffFormatError, ValueError, LookupError, OSError, UnicodeDecodeError) as x:
+        return {"name": os.path.splitext(os.path.basename(filename))[0], "author": "", "date": "", "num_caves": 0,
+                "sizes": [], "diamonds_required": [], "diamonds_on_map": [], "time": [], "flags": [], "error": str(x)}
+    flags = set()
+    for cave in parser.caves:
+        flags.update(cave_flags(cave))
+    for histogram in histograms:
+        flags.update(flag for flag, objs in OBJECT_FLAGS.items() if histogram.count(*objs))
+    return {
+        "name": parser.name,
+        "author": parser.author,
+        "date": parser.date,
+        "num_caves": parser.num_caves,
+        "sizes": [[cave.width, cave.height] for cave in parser.caves],
+        "diamonds_required": [cave.diamonds_required for cave in parser.caves],
+        "diamonds_on_map": [histogram.count(objects.DIAMOND) for histogram in histograms],
+        "time": [cave.cavetime for cave in parser.caves],
+        "flags": sorted(flags),
+        "error": None
+    }
+
+
+class CaveLibraryIndex:
+    sort_keys = {
+        "file": lambda entry: entry["file"].lower(),
+        "name": lambda entry: entry["name"].lower(),
+        "author": lambda entry: entry["author"].lower(),
+        "date": lambda entry: entry["date"],
+        "caves": lambda entry: entry["num_caves"],
+        "size": lambda entry: max((w * h for w, h in entry["sizes"]), default=0),
+        "diamonds": lambda entry: sum(entry["diamonds_required"]),
+        "diamonds on map": lambda entry: sum(entry["diamonds_on_map"]),
+        "time": lambda entry: sum(entry["time"])
+    }   # type: Dict[str, Callable[[Dict[str, Any]], Any]]
+
+    def __init__(self, root: str="caves", index_filename: str=os.path.join(user_data_dir, "caveindex.json")) -> None:
+        self.root = root
+        self.index_filename = index_filename
+        self.entries = {}       # type: Dict[str, Dict[str, Any]]
+        self.lock = threading.Lock()
+        self.refresh_thread = None      # type: Optional[threading.Thread]
+        self.load()
+
+    def load(self) -> None:
+        try:
+            with open(self.index_filename, "r") as f:
+                index = json.load(f)
+            if index["version"] == INDEX_VERSION and index["root"] == os.path.abspath(self.root):
+                with self.lock:
+                    self.entries = index["entries"]
+        except (OSError, ValueError, LookupError, TypeError):
+            pass    # no (usable) index yet, it will be built by refresh()
+
+    def save(self) -> None:
+        with self.lock:
+            index = {"version": INDEX_VERSION, "root": os.path.abspath(self.root), "entries": self.entries}
+            try:
+                with open(self.index_filename + ".tmp", "w") as f:
+                    json.dump(index, f, separators=(",", ":"))
+                os.replace(self.index_filename + ".tmp", self.index_filename)
+            except OSError:
+                pass
+
+    def cave_files(self) -> Dict[str, os.stat_result]:
+        files = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.lower().endswith(CAVEFILE_EXTENSIONS):
+                    path = os.path.join(dirpath, filename)
+                    files[os.path.relpath(path, self.root).replace(os.sep, "/")] = os.stat(path)
+        return files
+
+    def refresh(self) -> bool:
+        # Brings the index up to date with the files on disk, and returns True if anything changed.
+        # Only new and modified files are parsed. The entries are replaced at once, so queries can run meanwhile.
+        with self.lock:
+            entries = dict(self.entries)
+        changed = False
+        files = self.cave_files()
+        for relpath in list(entries):
+            if relpath not in files:
+                del entries[relpath]
+                changed = True
+        for relpath, stat in sorted(files.items()):
+            entry = entries.get(relpath)
+            if entry and entry["mtime"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+                continue
+            entry = cave_file_metadata(os.path.join(self.root, relpath))
+            entry["file"] = relpath
+            entry["folder"] = relpath.rpartition("/")[0]
+            entry["mtime"] = stat.st_mtime_ns
+            entry["size"] = stat.st_size
+            entries[relpath] = entry
+            changed = True
+        if changed:
+            with self.lock:
+                self.entries = entries
+            self.save()
+        return changed
+
+    def refresh_in_background(self, on_done: Callable[[bool], None]=None) -> None:
+        # on_done is called from the background thread; a GUI should only set a flag there and pick it up in its own thread.
+        if self.refresh_thread and self.refresh_thread.is_alive():
+            return
+
+        def refresh():
+            changed = self.refresh()
+            if on_done:
+                on_done(changed)
+
+        self.refresh_thread = threading.Thread(target=refresh, name="cave index refresh", daemon=True)
+        self.refresh_thread.start()
+
+    def get(self, relpath: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            return self.entries.get(relpath)
+
+    def query(self, folder: Optional[str]=None, text: str="", sort_key: str="file", reverse: bool=False) -> List[Dict[str, Any]]:
+        # the entries in the folder (all folders if None) matching the text in file name, cave set name, author, date or flags
+        text = text.lower().strip()
+        with self.lock:
+            entries = [entry for entry in self.entries.values() if folder is None or entry["folder"] == folder]
+        if text:
+            entries = [entry for entry in entries
+                       if text in " ".join([entry["file"], entry["name"], entry["author"], entry["date"]] + entry["flags"]).lower()]
+        entries.sort(key=self.sort_keys[sort_key], reverse=reverse)
+        return entries
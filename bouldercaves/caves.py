@@ -16,10 +16,18 @@ License: GNU GPL 3.0, see LICENSE
 """
 
 import math
+import copy
+import array
 import random
-from typing import Sequence, List, Tuple, Union
+import threading
+import collections
+from typing import Sequence, List, Tuple, Union, Dict, Optional
 from .objects import Direction, GameObject
 from . import objects, bdcff
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 BD1CAVES = [
@@ -337,6 +345,8 @@ class Cave:
         self.intermission = False
         self.width = width
         self.height = height
+        self.orig_width = width     # the size of the cave as designed, before it is fitted to the playfield
+        self.orig_height = height
         self.map = []       # type: List[Tuple[GameObject, Direction]]
         defaults = bdcff.BdcffCave()
         self.magicwall_millingtime = defaults.magicwalltime
@@ -451,26 +461,36 @@ class C64Cave(Cave):
         return cave
 
     @staticmethod
-    def bdrandom(seeds: List[int]) -> None:
-        # the pseudo random generator that Boulder Dash uses
-        assert len(seeds) == 2, "expected 2 seed numbers"
-        assert 0 <= seeds[0] <= 0xFF, "expected seed 0 to be between 0 and 0xFF"
-        assert 0 <= seeds[1] <= 0xFF, "expected seed 1 to be between 0 and 0xFF"
-        tmp1 = (seeds[0] & 0x0001) * 0x0080
-        tmp2 = (seeds[1] >> 1) & 0x007F
-        result = seeds[1] + (seeds[1] & 0x0001) * 0x0080
+    def bdrandom_step(seed0: int, seed1: int) -> int:
+        # the pseudo random generator that Boulder Dash uses, returns the next 16 bits state (seed0 << 8 | seed1)
+        tmp1 = (seed0 & 0x0001) * 0x0080
+        tmp2 = (seed1 >> 1) & 0x007F
+        result = seed1 + (seed1 & 0x0001) * 0x0080
         carry = (result > 0x00FF)
         result = result & 0x00FF
         result = result + carry + 0x13
         carry = (result > 0x00FF)
-        seeds[1] = result & 0x00FF
-        result = seeds[0] + carry + tmp1
+        seed1 = result & 0x00FF
+        result = seed0 + carry + tmp1
         carry = (result > 0x00FF)
         result = result & 0x00FF
         result = result + carry + tmp2
-        seeds[0] = result & 0x00FF
-        assert 0 <= seeds[0] <= 0xFF, "expected seed 0 to STILL be between 0 and 0xFF"
-        assert 0 <= seeds[1] <= 0xFF, "expected seed 0 to STILL be between 0 and 0xFF"
+        return ((result & 0x00FF) << 8) | seed1
+
+    @staticmethod
+    def bdrandom(seeds: List[int]) -> None:
+        # the pseudo random generator that Boulder Dash uses, via the precomputed table of all 65536 states
+        state = (BDRANDOM_SUCCESSORS or bdrandom_successors())[(seeds[0] << 8) | seeds[1]]
+        seeds[0] = state >> 8
+        seeds[1] = state & 0xFF
+
+    @staticmethod
+    def bdrandom_period(seeds: List[int]) -> Tuple[int, int]:
+        # returns the number of steps before the generator enters its cycle from these seeds, and the length of the cycle
+        cycles, cycle_position, runin_length, runin_target = BDRANDOM_CYCLE_TABLES or bdrandom_cycle_tables()
+        state = (seeds[0] << 8) | seeds[1]
+        cycle, _ = cycle_position[runin_target[state]]
+        return runin_length[state], len(cycles[cycle])
 
     def build_map(self, data: Sequence[int]) -> None:
         seeds = [0, self.randomseed]
@@ -569,16 +589,25 @@ class C64Cave(Cave):
 
 
 class CaveSet:
-    def __init__(self, external_bdcff_file: str=None, caveclass: type=None) -> None:
+    fitted_cache_size = 8
+
+    def __init__(self, external_bdcff_file: Union[str, bdcff.BdcffParser, bdcff.BdcffCaveIndex]=None, caveclass: type=None) -> None:
         self.caveclass = caveclass
+        # caves fitted to the playfield, with their map stored as compact cell codes (index in cell_types)
+        self.fitted_caves = collections.OrderedDict()    # type: collections.OrderedDict
+        self.cell_types = []        # type: List[Tuple[GameObject, Direction]]
+        self.cell_codes = {}        # type: Dict[Tuple[GameObject, Direction], int]
+        self.fitted_lock = threading.Lock()     # the next level can be fitted in a background thread
         if external_bdcff_file:
             self.mode = "bdcff"
-            self.bdcff_caves = bdcff.BdcffParser(external_bdcff_file)
+            if isinstance(external_bdcff_file, (bdcff.BdcffParser, bdcff.BdcffCaveIndex)):
+                self.bdcff_caves = external_bdcff_file      # already parsed or indexed
+            else:
+                self.bdcff_caves = bdcff.BdcffCaveIndex(external_bdcff_file)    # the caves are parsed when they're needed
             self.name = self.bdcff_caves.name
             self.author = self.bdcff_caves.author
             self.date = self.bdcff_caves.date
             self.cave_demo = None
-            self.num_caves = len(self.bdcff_caves.caves)
             self.bonus_life_points = self.bdcff_caves.bonus_life_points
         else:
             self.mode = "builtin"
@@ -586,14 +615,20 @@ class CaveSet:
             self.author = "Peter Liepa"
             self.date = "1984"
             self.cave_demo = CAVE_A_DEMO
-            self.num_caves = len(BD1CAVES)
             self.bonus_life_points = 500
 
+    @property
+    def num_caves(self) -> int:
+        # from the cave index, which is rebuilt if the cave file changes
+        if self.mode == "bdcff":
+            return len(self.bdcff_caves.cave_names)
+        return len(BD1CAVES)
+
     def cave_names(self):
         if self.mode == "builtin":
             return [c[0] for c in BD1CAVES]
         elif self.mode == "bdcff":
-            return [c.name for c in self.bdcff_caves.caves]
+            return list(self.bdcff_caves.cave_names)
         raise ValueError("invalid caveset mode")
 
     def cave(self, levelnumber: int) -> Cave:
@@ -602,9 +637,49 @@ class CaveSet:
                 raise TypeError("for built-in caves you cannot specify a custom cave class")
             return C64Cave.decode_from_lvl(levelnumber)
         elif self.mode == "bdcff":
-            return self.cave_from_bdcff(levelnumber, self.bdcff_caves.caves[levelnumber - 1])
+            return self.cave_from_bdcff(levelnumber, self.bdcff_caves.cave(levelnumber - 1))
         raise ValueError("invalid caveset mode")
 
+    def fitted_cave(self, levelnumber: int, visible_columns: int, visible_rows: int, mirrored_border_size: int) -> Tuple[Cave, int, int]:
+        # Returns the cave fitted to the visible playfield: with mirrored open borders added if it is larger,
+        # and padded with filler walls if it is smaller. Also returns the offset of the original cave in it.
+        # The result is memoized per level and playfield geometry (the open border flags are part of the level),
+        # so a retry or level restart only rebuilds the map list from the stored cell codes.
+        with self.fitted_lock:
+            return self._fitted_cave(levelnumber, visible_columns, visible_rows, mirrored_border_size)
+
+    def _fitted_cave(self, levelnumber: int, visible_columns: int, visible_rows: int, mirrored_border_size: int) -> Tuple[Cave, int, int]:
+        key = (levelnumber, visible_columns, visible_rows, mirrored_border_size)
+        if key in self.fitted_caves:
+            self.fitted_caves.move_to_end(key)
+            cave, codes, delta_x, delta_y = self.fitted_caves[key]
+        else:
+            cave = self.cave(levelnumber)
+            delta_x = delta_y = 0
+            if cave.width > visible_columns or cave.height > visible_rows:
+                dx, dy = cave.add_mirrored_borders(mirrored_border_size, cave.open_horizontal_borders, cave.open_vertical_borders)
+                delta_x += dx
+                delta_y += dy
+            if cave.width < visible_columns or cave.height < visible_rows:
+                dx, dy = cave.resize(visible_columns, visible_rows, objects.FILLERWALL)
+                delta_x += dx
+                delta_y += dy
+            codes = array.array('H', [self.cell_code(cell) for cell in cave.map])
+            cave.map = []
+            self.fitted_caves[key] = (cave, codes, delta_x, delta_y)
+            if len(self.fitted_caves) > self.fitted_cache_size:
+                self.fitted_caves.popitem(last=False)
+        fitted = copy.copy(cave)
+        fitted.map = list(map(self.cell_types.__getitem__, codes))
+        return fitted, delta_x, delta_y
+
+    def cell_code(self, cell: Tuple[GameObject, Direction]) -> int:
+        code = self.cell_codes.get(cell)
+        if code is None:
+            code = self.cell_codes[cell] = len(self.cell_types)
+            self.cell_types.append(cell)
+        return code
+
     def cave_from_bdcff(self, levelnumber: int, bdcff: bdcff.BdcffCave) -> Cave:
         caveclass = self.caveclass or Cave
         cave = caveclass(levelnumber, bdcff.name, bdcff.description, bdcff.width, bdcff.height)
@@ -653,6 +728,107 @@ class CaveSet:
         return cave
 
 
+class CaveHistogram:
+    # object counts of a cave map, indexed by object id, and the fraction of non-empty cells per row and per column
+    def __init__(self, width: int, height: int, counts: List[int], row_density: List[float], column_density: List[float]) -> None:
+        self.width = width
+        self.height = height
+        self.counts = counts
+        self.row_density = row_density
+        self.column_density = column_density
+
+    def count(self, *objs: GameObject) -> int:
+        return sum(self.counts[obj.id] for obj in objs if 0 <= obj.id < len(self.counts))
+
+    def as_dict(self) -> Dict[str, int]:
+        # counts of the objects that occur in the cave, by object name
+        return {OBJECTS_BY_ID[oid].name: count for oid, count in enumerate(self.counts) if count and oid in OBJECTS_BY_ID}
+
+
+OBJECTS_BY_ID = {obj.id: obj for obj in vars(objects).values() if isinstance(obj, GameObject) and obj.id >= 0}
+NUM_OBJECT_IDS = max(OBJECTS_BY_ID) + 1
+
+
+def cave_histogram(cave: Cave) -> CaveHistogram:
+    # counts all objects in the cave map in one go (the map is converted to an array of object ids first).
+    # Works for the game caves as well as for the editor's cave.
+    width, height = cave.width, cave.height
+    ids = [cell[0].id for cell in cave.map]
+    if numpy is not None:
+        idarray = numpy.array(ids, dtype=numpy.int16).reshape(height, width)
+        counts = numpy.bincount(idarray.ravel(), minlength=NUM_OBJECT_IDS).tolist()
+        nonempty = idarray != objects.EMPTY.id
+        row_density = nonempty.mean(axis=1).tolist()
+        column_density = nonempty.mean(axis=0).tolist()
+    else:
+        counts = [0] * max(NUM_OBJECT_IDS, max(ids, default=0) + 1)
+        for oid, count in collections.Counter(ids).items():
+            counts[oid] = count
+        empty = objects.EMPTY.id
+        row_density = [1.0 - ids[y * width: y * width + width].count(empty) / width for y in range(height)]
+        column_density = [1.0 - ids[x::width].count(empty) / height for x in range(width)]
+    return CaveHistogram(width, height, counts, row_density, column_density)
+
+
+# Successor of every 16 bits state (seed0 << 8 | seed1) of the Boulder Dash random generator, and its cycles:
+# (cycles, position of each cycle state, run-in length and first cycle state reached of every state).
+# Both are built on first use, and only published when complete because other threads may use the generator too.
+BDRANDOM_SUCCESSORS = None      # type: Optional[array.array]
+BDRANDOM_CYCLE_TABLES = None    # type: Optional[Tuple[List[array.array], Dict[int, Tuple[int, int]], array.array, array.array]]
+bdrandom_tables_lock = threading.Lock()
+
+
+def bdrandom_successors() -> array.array:
+    global BDRANDOM_SUCCESSORS
+    with bdrandom_tables_lock:
+        if BDRANDOM_SUCCESSORS is None:
+            BDRANDOM_SUCCESSORS = array.array('H', [C64Cave.bdrandom_step(state >> 8, state & 0xFF) for state in range(65536)])
+        return BDRANDOM_SUCCESSORS
+
+
+def bdrandom_cycle_tables() -> Tuple[List[array.array], Dict[int, Tuple[int, int]], array.array, array.array]:
+    global BDRANDOM_CYCLE_TABLES
+    successors = bdrandom_successors()
+    with bdrandom_tables_lock:
+        if BDRANDOM_CYCLE_TABLES is not None:
+            return BDRANDOM_CYCLE_TABLES
+        cycles = []             # type: List[array.array]
+        cycle_position = {}     # type: Dict[int, Tuple[int, int]]
+        visited_by = [-1] * 65536
+        for start in range(65536):
+            state = start
+            while visited_by[state] < 0:
+                visited_by[state] = start
+                state = successors[state]
+            if visited_by[state] == start and state not in cycle_position:
+                # found a new cycle
+                cycle = array.array('H')
+                while state not in cycle_position:
+                    cycle_position[state] = (len(cycles), len(cycle))
+                    cycle.append(state)
+                    state = successors[state]
+                cycles.append(cycle)
+        runin_length = array.array('H', [0]) * 65536     # number of steps before a state reaches a cycle
+        runin_target = array.array('H', range(65536))    # the first state on the cycle that is reached
+        resolved = bytearray(65536)
+        for state in cycle_position:
+            resolved[state] = 1
+        for start in range(65536):
+            path = []
+            state = start
+            while not resolved[state]:
+                path.append(state)
+                state = successors[state]
+            length, target = runin_length[state], runin_target[state]
+            for state in reversed(path):
+                length += 1
+                runin_length[state] = length
+                runin_target[state] = target
+                resolved[state] = 1
+        BDRANDOM_CYCLE_TABLES = (cycles, cycle_position, runin_length, runin_target)
+        return BDRANDOM_CYCLE_TABLES
+
+
 # BDCFF map symbols
 # !! note !! : make sure every symbol maps to a unique value (don't reuse obj+direction),
 # otherwise saving the cave map will output the wrong characters for those cells.
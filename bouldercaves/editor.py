@@ -1204,7 +1204,8 @@ class CaveSelectionDialog(Dialog):
         self.result = (selection[0] + 1) if selection else None
 
 
-def start() -> None:
+def start(profile_file: Optional[str]=None) -> None:
+    # profile_file is given when the game starts the editor (--editor --profile [FILE])
     print(f"BoulderCaves+ Construction Kit v. {__version__}. Original by Irmen de Jong, extended by Michael Kamensky.")
     print("This software is licensed under the GNU GPL 3.0, see https://www.gnu.org/licenses/gpl.html")
 
@@ -1212,15 +1213,25 @@ def start() -> None:
     show_active_elem = "-a" in sys.argv or "--active" in sys.argv
     use_krissz_engine_defs = "-k" in sys.argv or "--krissz" in sys.argv
     show_help = "-h" in sys.argv or "--help" in sys.argv
+    if profile_file is None and "--profile" in sys.argv:
+        # --profile [FILE], like the game's option
+        index = sys.argv.index("--profile") + 1
+        has_file = index < len(sys.argv) and not sys.argv[index].startswith("-")
+        profile_file = sys.argv[index] if has_file else "bouldercaves-editor-profile.folded"
     
     if show_help:
         print("\nAvailable options:\n")
         print("  -a (--active) - enable the visibility of the active selected element under cursor")
         print("  -h (--help) - show this help")
+        print("  --profile [FILE] - run a sampling profiler, the profile is written to FILE on exit (default=bouldercaves-editor-profile.folded)")
         exit(0)
     
     window = EditorWindow(show_active_elem, use_krissz_engine_defs)
-    window.mainloop()
+    if profile_file:
+        from . import profiler
+        profiler.run_profiled(window.mainloop, profile_file)
+    else:
+        window.mainloop()
 
 
 if __name__ == "__main__":
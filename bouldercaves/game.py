@@ -20,11 +20,12 @@ import tkinter.messagebox
 from tkinter import simpledialog
 import pkgutil
 import time
-from typing import Tuple, Sequence, List, Iterable, Callable, Optional
-from .gamelogic import GameState, Direction, GameStatus, HighScores
+from typing import Tuple, Sequence, List, Iterable, Callable, Optional, Dict
+from .gamelogic import GameState, Direction, GameStatus, HighScores, LogicWorker
 from .caves import colorpalette, Palette
-from .helpers import TextHelper, KeyHelper
-from . import audio, synthsamples, tiles, objects, bdcff
+from .helpers import TextHelper, KeyHelper, FramePacer, OptimizationController
+from .telemetry import Telemetry
+from . import audio, synthsamples, tiles, objects, bdcff, tracing
 
 __version__ = "1.1.4"
 
@@ -35,13 +36,16 @@ class BoulderWindow(tkinter.Tk):
     visible_columns = 40
     visible_rows = 22
     scalexy = 2
+    tick_fps = 60
+    max_catchup_updates = 3     # game updates to run at most in one tick after a stall, the rest is dropped
 
     def __init__(self, title: str, fps: int=30, scale: int=2,
                  c64colors: bool=False, c64_alternate_tiles: bool=False, smallwindow: bool=False,
                  hidexwalls: bool=False, window30x18: bool=False, animatereveal: bool=False, 
                  krisszcompat: bool=False, krissztileset: bool=False, fullscreen: bool=False,
                  size_defined: bool=False, optimize: int=0, mirror_size: int=0, 
-                 stipple_mirror: bool=False) -> None:
+                 stipple_mirror: bool=False, interpolate_scroll: bool=False, logic_thread: bool=False,
+                 auto_optimize: bool=False, telemetry_file: str=None, trace_file: str=None) -> None:
         self.smallwindow = smallwindow
         self.fullscreen = fullscreen
         self.window30x18 = window30x18
@@ -57,6 +61,16 @@ class BoulderWindow(tkinter.Tk):
         self.update_fps = fps
         self.update_timestep = 1 / fps
         self.perf_optimization_level = optimize # 0 = no optimization, 1 = light optimization, 2 = moderate optimization, 3 = heavy optimization
+        self.optimization_controller = OptimizationController(fps, optimize) if auto_optimize else None
+        self.frame_work_time = 0.0      # time spent on game updates and drawing since the last repaint
+        self.telemetry_file = telemetry_file
+        self.telemetry = Telemetry() if telemetry_file else None
+        self.trace_file = trace_file
+        if trace_file:
+            tracing.start()
+            if not self.telemetry:
+                self.telemetry = Telemetry(size=256)    # the telemetry phases are also the repaint phases in the trace
+        self.perf_overlay = None     # type: Optional[tkinter.Label]
         self.scalexy = scale
         self.c64colors = c64colors
         self.c64_alternate_tiles = c64_alternate_tiles
@@ -111,14 +125,18 @@ class BoulderWindow(tkinter.Tk):
         self.playfield_rows = 0
         self.create_tile_images()
         self.create_canvas_playfield_and_tilesheet(40, 22)
-        self.bind("<KeyPress>", self.keypress)
-        self.bind("<KeyRelease>", self.keyrelease)
+        self.bind("<KeyPress>", self.keypress_locked)
+        self.bind("<KeyRelease>", self.keyrelease_locked)
         self.protocol("WM_DELETE_WINDOW", self.destroy)
         self.scorecanvas.pack(pady=(0, 10))
         self.canvas.pack()
-        self.gfxupdate_starttime = 0.0
-        self.game_update_dt = 0.0
-        self.graphics_update_dt = 0.0
+        self.tick_pacer = FramePacer(self.tick_fps)
+        self.frame_pacer = FramePacer(self.update_fps)
+        self.update_pacer = FramePacer(self.update_fps, max_catchup=self.max_catchup_updates)   # period follows the cave speed
+        self.interpolate_scroll = interpolate_scroll
+        self.logic_thread = logic_thread
+        self.previous_focus_xy = None   # type: Optional[Tuple[int, int]]
+        self.published_focus_xy = None  # type: Optional[Tuple[int, int]]
         self.graphics_frame = 0
         self.popup_frame = 0
         self.last_demo_or_highscore_frame = 0
@@ -130,6 +148,8 @@ class BoulderWindow(tkinter.Tk):
         self.last_rockford_sprite = None # for end of level continuous animation
         self.keymap = KeyHelper.load_key_definitions() # load a custom key map if available
         self.gamestate = GameState(self)
+        if trace_file:
+            tracing.trace_gamestate(self.gamestate)
 
     def determine_optimal_scale(self) -> int:
         screen_width = tkinter.Tk.winfo_screenwidth(self)
@@ -142,15 +162,32 @@ class BoulderWindow(tkinter.Tk):
         return 10
 
     def destroy(self) -> None:
-        audio.shutdown_audio()
-        self.gamestate.destroy()
-        super().destroy()
+        # the reports are written first, but a failing report mustn't keep the audio and the game state running
+        try:
+            if self.trace_file:
+                tracing.stop(self.trace_file)
+                print("Trace events written to", self.trace_file)
+            if self.frame_pacer.dropped or self.update_pacer.dropped:
+                print("Frame pacing: dropped {:d} of {:d} frames and {:d} of {:d} game updates."
+                      .format(self.frame_pacer.dropped, self.frame_pacer.frames + self.frame_pacer.dropped,
+                              self.update_pacer.dropped, self.update_pacer.frames + self.update_pacer.dropped))
+            if self.telemetry_file:
+                self.telemetry.write(self.telemetry_file)
+                print("Frame-time telemetry written to", self.telemetry_file)
+        finally:
+            audio.shutdown_audio()
+            self.gamestate.destroy()
+            super().destroy()
             
     def start(self) -> None:
-        self.gfxupdate_starttime = time.perf_counter()
-        self.game_update_dt = 0.0
-        self.graphics_update_dt = 0.0
+        now = time.perf_counter()
+        self.tick_pacer.reset(now)
+        self.frame_pacer.reset(now)
+        self.update_pacer.reset(now)
         self.graphics_frame = 0
+        if self.logic_thread:
+            self.gamestate.logic_worker = LogicWorker(self.gamestate)
+            self.gamestate.logic_worker.start()
         alignment = 22
         if self.smallwindow:
             alignment = 16
@@ -170,23 +207,74 @@ class BoulderWindow(tkinter.Tk):
         self.gamestate.update_scorebar()
         self.tick_loop()
     
+    @tracing.traced("tick_loop", "loop")
     def tick_loop(self) -> None:
+        # Ticks, game updates and graphics frames each run on their own fixed timestep deadlines.
+        # A stall doesn't cause a burst of catch-up updates: the pacers drop what's too far behind.
         now = time.perf_counter()
-        dt = now - self.gfxupdate_starttime
-        self.game_update_dt += dt
-        while self.game_update_dt > self.gamestate.update_timestep:
-            self.game_update_dt -= self.gamestate.update_timestep
+        self.tick_pacer.due(now)
+        self.update_pacer.period = self.gamestate.update_timestep
+        if self.gamestate.logic_worker:
+            self.draw_logic_worker_frames()
+        for _ in range(self.update_pacer.due(now)):
+            if self.interpolate_scroll and not self.gamestate.logic_worker:
+                focus_cell = self.gamestate.focus_cell()
+                self.previous_focus_xy = (focus_cell.x, focus_cell.y) if focus_cell else None
             self.update_game()
-        self.graphics_update_dt += dt
         if self.gamestate.game_status in (GameStatus.REVEALING_DEMO, GameStatus.REVEALING_PLAY) and not self.popup_tiles_save:
+            start = time.perf_counter()
             self.do_reveal()
-        if self.graphics_update_dt > self.update_timestep:
-            self.graphics_update_dt -= self.update_timestep
-            #if self.graphics_update_dt >= self.update_timestep:
-                #print("Gfx update too slow to reach {:d} fps!".format(self.update_fps))
-            self.repaint()
-        self.gfxupdate_starttime = now
-        self.after(1000 // 60, self.tick_loop)
+            if self.telemetry:
+                self.telemetry.lap("reveal", start)
+        repainted = self.frame_pacer.due(now) > 0
+        if repainted:
+            # dropped frames still count, so that animations and popups keep their pace
+            self.graphics_frame += self.frame_pacer.skipped
+            if self.gamestate.lock.acquire(blocking=False):
+                try:
+                    self.repaint()
+                finally:
+                    self.gamestate.lock.release()
+            else:
+                self.repaint_published()
+        if self.perf_overlay and repainted and self.graphics_frame % max(1, self.update_fps // 4) == 0:
+            self.update_perf_overlay()
+        end = time.perf_counter()
+        if self.optimization_controller:
+            self.frame_work_time += end - now
+            if repainted:
+                level = self.optimization_controller.add_frame(self.frame_work_time, end)
+                if level is not None:
+                    self.perf_optimization_level = level
+                self.frame_work_time = 0.0
+        self.after(self.tick_pacer.delay_ms(end), self.tick_loop)
+
+    def draw_logic_worker_frames(self) -> None:
+        # draw the tile changes that the logic worker published, and do the actions it handed over
+        for snapshot in self.gamestate.logic_worker.take_snapshots():
+            for x, y, obj in snapshot.tile_changes:
+                self.set_canvas_tile(x, y, obj)
+            if self.telemetry:
+                self.telemetry.record("logic", snapshot.update_time)
+                self.telemetry.record("cells_scanned", snapshot.cells_scanned)
+                self.telemetry.record("cells_updated", snapshot.cells_updated)
+                self.telemetry.record("sounds", snapshot.sounds)
+            if self.interpolate_scroll:
+                self.previous_focus_xy = self.published_focus_xy
+            self.published_focus_xy = snapshot.focus_xy
+            if snapshot.deferred_actions:
+                with self.gamestate.lock:
+                    for action in snapshot.deferred_actions:
+                        action()
+                    self.gamestate.logic_worker.actions_pending = False
+
+    def keypress_locked(self, event) -> None:
+        with self.gamestate.lock:
+            self.keypress(event)
+
+    def keyrelease_locked(self, event) -> None:
+        with self.gamestate.lock:
+            self.keyrelease(event)
 
     def restart(self):
         if self.gamestate.playtesting:
@@ -271,6 +359,8 @@ class BoulderWindow(tkinter.Tk):
             self.tilesheet.all_dirty()
         elif event.keysym == "F4":
             self.gamestate.show_highscores()
+        elif event.keysym == "F3":
+            self.toggle_perf_overlay()
         elif event.keysym == "F9":
             self.gamestate.start_demo()
         elif event.keysym == "F10":
@@ -284,6 +374,65 @@ class BoulderWindow(tkinter.Tk):
             env["PYTHONPATH"] = sys.path[0]
             subprocess.Popen([sys.executable, "-m", editor.__name__], env=env)
 
+    def toggle_perf_overlay(self) -> None:
+        # The performance overlay is a label on top of the playfield, it doesn't use the tilesheets.
+        # It shows the telemetry, which is only recorded while the overlay is shown (or with --telemetry or --trace).
+        if self.perf_overlay:
+            self.perf_overlay.destroy()
+            self.perf_overlay = None
+            if not self.telemetry_file and not self.trace_file:
+                self.telemetry = None
+        else:
+            if not self.telemetry:
+                self.telemetry = Telemetry(size=256)
+            self.perf_overlay = tkinter.Label(self, font=("Courier", 4 + 2 * self.scalexy, "bold"), justify=tkinter.LEFT,
+                                              foreground="white", background="black", borderwidth=4)
+            self.perf_overlay.place(in_=self.canvas, x=0, y=0)
+            self.update_perf_overlay()
+
+    def update_perf_overlay(self) -> None:
+        telemetry = self.telemetry
+        render_time = telemetry.recent_mean("animation") + telemetry.recent_mean("tiles") + telemetry.recent_mean("mirror")
+        lines = [
+            "logic  {:6.2f} ms".format(telemetry.recent_mean("logic", 10) * 1000),
+            "render {:6.2f} ms / {:.1f}".format(render_time * 1000, self.update_timestep * 1000),
+            "dirty  {:6.0f} tiles".format(telemetry.recent_mean("tiles_pushed")),
+            "active {:6.0f} cells".format(telemetry.recent_mean("cells_updated", 10)),
+            "anim   {:6.0f} cells".format(telemetry.recent_mean("animated_cells")),
+            "amoeba {:6d} cells".format(self.gamestate.population_count(objects.AMOEBA)),
+            "opt    {:6d}{:s}".format(self.perf_optimization_level, " auto" if self.optimization_controller else ""),
+            "drops  {:6d} frames".format(self.frame_pacer.dropped)
+        ]
+        self.perf_overlay.configure(text="\n".join(lines))
+
+    def update_canvas_scroll(self) -> None:
+        # smooth scroll
+        if self.canvas.view_x != self.view_x:       # type: ignore
+            self.canvas.xview_moveto(0)
+            self.canvas.xview_scroll(self.view_x, tkinter.UNITS)
+            self.canvas.view_x = self.view_x        # type: ignore
+        if self.canvas.view_y != self.view_y:       # type: ignore
+            self.canvas.yview_moveto(0)
+            self.canvas.yview_scroll(self.view_y, tkinter.UNITS)
+            self.canvas.view_y = self.view_y        # type: ignore
+        self.tilesheet.set_view(self.view_x // 16, self.view_y // 16)
+
+    def repaint_published(self) -> None:
+        # repaint while the logic worker is in the middle of an update: only scroll and draw the published
+        # tile changes, the animations continue with the next full repaint
+        self.graphics_frame += 1
+        if not self.gamestate.intermission and self.published_focus_xy:
+            self.scroll_focuscell_into_view(focus_xy=self.published_focus_xy)
+        self.update_canvas_scroll()
+        start = time.perf_counter()
+        dirty = self.tilesheet.dirty()
+        for index, tile in dirty:
+            self.canvas.itemconfigure(self.c_tiles[index], image=self.tile_images[tile])
+        if self.telemetry:
+            self.telemetry.lap("tiles", start)
+            self.telemetry.record("tiles_pushed", len(dirty))
+
+    @tracing.traced("repaint", "render")
     def repaint(self) -> None:
         self.graphics_frame += 1
         if not self.gamestate.intermission:
@@ -299,16 +448,7 @@ class BoulderWindow(tkinter.Tk):
                 self.scorecanvas.itemconfigure(self.cscore_tiles[index], image=self.tile_images[tile])
             except:
                 pass
-        # smooth scroll
-        if self.canvas.view_x != self.view_x:       # type: ignore
-            self.canvas.xview_moveto(0)
-            self.canvas.xview_scroll(self.view_x, tkinter.UNITS)
-            self.canvas.view_x = self.view_x        # type: ignore
-        if self.canvas.view_y != self.view_y:       # type: ignore
-            self.canvas.yview_moveto(0)
-            self.canvas.yview_scroll(self.view_y, tkinter.UNITS)
-            self.canvas.view_y = self.view_y        # type: ignore
-        self.tilesheet.set_view(self.view_x // 16, self.view_y // 16)
+        self.update_canvas_scroll()
 
         if self.popup_frame > self.graphics_frame:
             for index, tile in self.tilesheet.dirty():
@@ -341,6 +481,9 @@ class BoulderWindow(tkinter.Tk):
                     self.canvas.itemconfigure(self.c_tiles[index], image=self.tile_images[tile])
             return
 
+        telemetry = self.telemetry
+        if telemetry:
+            start = time.perf_counter()
         if self.gamestate.rockford_cell:
             # is rockford moving or pushing left/right?
             rockford_sprite = objects.ROCKFORD   # type: objects.GameObject
@@ -376,7 +519,8 @@ class BoulderWindow(tkinter.Tk):
                                 (self.graphics_frame - self.gamestate.rockford_cell.anim_start_gfx_frame))
                 self.tilesheet[self.gamestate.rockford_cell.x, self.gamestate.rockford_cell.y] = rockford_sprite.tile(animframe)
         # other animations:
-        for cell in self.gamestate.cells_with_animations():
+        animated_cells = self.gamestate.cells_with_animations()
+        for cell in animated_cells:
             obj = cell.obj
             if obj.id == objects.MAGICWALL.id:
                 if not self.gamestate.magicwall["active"]:
@@ -391,20 +535,41 @@ class BoulderWindow(tkinter.Tk):
             self.gamestate.flash = self.gamestate.frame - 1
             self.canvas.create_rectangle(0, 0, self.gamestate.width * 16 * self.scalexy, self.gamestate.height * 16 * self.scalexy, fill='white', tags='flash')
             self.after(int(self.update_fps), lambda: self.canvas.delete('flash'))
+        if telemetry:
+            start = telemetry.lap("animation", start)
+            telemetry.record("animated_cells", len(animated_cells))
         # update all the tiles that were marked as modified (dirty)
-        for index, tile in self.tilesheet.dirty():
+        dirty = self.tilesheet.dirty()
+        for index, tile in dirty:
             self.canvas.itemconfigure(self.c_tiles[index], image=self.tile_images[tile])
+        if telemetry:
+            start = telemetry.lap("tiles", start)
+            telemetry.record("tiles_pushed", len(dirty))
         # update the mirrors
         if self.mirrored_border_size > 0:
             self.update_mirrored_border()
+            if telemetry:
+                telemetry.lap("mirror", start)
 
-    def create_colored_tiles(self, colors: Palette) -> None:
+    def prepare_colored_tiles(self, colors: Palette) -> Optional[Sequence[bytes]]:
+        # tints the sprites for the given colors ahead of time (this is safe to call from a background thread),
+        # so that create_colored_tiles only has to create the tkinter images.
         if self.c64colors:
-            source_images = tiles.load_sprites(colors if self.c64colors else None, scale=self.scalexy,
-                                               alt_c64tileset=self.c64_alternate_tiles, krissz_c64tileset=self.krissz_tileset)
+            return tiles.load_sprites(colors, scale=self.scalexy, alt_c64tileset=self.c64_alternate_tiles,
+                                      krissz_c64tileset=self.krissz_tileset)
+        return None
+
+    @tracing.traced("create_colored_tiles", "sprites")
+    def create_colored_tiles(self, colors: Palette, source_images: Sequence[bytes]=None) -> None:
+        # source_images are the sprites from prepare_colored_tiles, if they were prepared for these colors
+        if self.c64colors:
+            if source_images is None:
+                source_images = tiles.load_sprites(colors if self.c64colors else None, scale=self.scalexy,
+                                                   alt_c64tileset=self.c64_alternate_tiles, krissz_c64tileset=self.krissz_tileset)
             for i, image in enumerate(source_images):
                 self.tile_images[i] = tkinter.PhotoImage(data=image)
 
+    @tracing.traced("create_tile_images", "sprites")
     def create_tile_images(self) -> None:
         palette_choice = random.randint(1, 2)
         if palette_choice == 1:
@@ -547,20 +712,43 @@ class BoulderWindow(tkinter.Tk):
         xlimit, ylimit = tiles.tile2pixels(self.playfield_columns - self.visible_columns, self.playfield_rows - self.visible_rows)
         return min(max(0, round(x)), xlimit), min(max(0, round(y)), ylimit)
 
+    @tracing.traced("update_game", "logic")
     def update_game(self) -> None:
-        if self.popup_frame < self.graphics_frame:
-            self.gamestate.update(self.graphics_frame)
+        worker = self.gamestate.logic_worker
+        # check the worker before taking the lock, or the Tk thread would wait for the worker's update in progress
+        if self.popup_frame < self.graphics_frame and not (worker and worker.active()):
+            with self.gamestate.lock:
+                if not (worker and worker.active()):
+                    start = time.perf_counter()
+                    self.gamestate.update(self.graphics_frame)
+                    if self.telemetry:
+                        self.telemetry.lap("logic", start)
+                        self.telemetry.record("cells_scanned", self.gamestate.cells_scanned)
+                        self.telemetry.record("cells_updated", self.gamestate.cells_updated)
+                        self.telemetry.record("sounds", self.gamestate.sounds.frame_sounds)
+        start = time.perf_counter()
         self.gamestate.update_scorebar()
+        if self.telemetry:
+            self.telemetry.lap("scorebar", start)
         music_sample = audio.samples["music"]
         if self.gamestate.game_status == GameStatus.WAITING and \
                 self.last_demo_or_highscore_frame + self.update_fps * max(15, music_sample.duration) < self.graphics_frame:
             self.gamestate.tile_music_ended()
             self.last_demo_or_highscore_frame = self.graphics_frame
 
-    def scroll_focuscell_into_view(self, immediate: bool=False, center: bool=False) -> None:
-        focus_cell = self.gamestate.focus_cell()
-        if focus_cell:
-            x, y = focus_cell.x, focus_cell.y
+    def scroll_focuscell_into_view(self, immediate: bool=False, center: bool=False, focus_xy: Tuple[int, int]=None) -> None:
+        if focus_xy is None:
+            focus_cell = self.gamestate.focus_cell()
+            focus_xy = (focus_cell.x, focus_cell.y) if focus_cell else None
+        if focus_xy:
+            x, y = focus_xy     # type: float, float
+            if self.interpolate_scroll and self.previous_focus_xy and not immediate:
+                # follow the focus cell from its previous position smoothly in between game updates
+                prevx, prevy = self.previous_focus_xy
+                if abs(x - prevx) <= 1 and abs(y - prevy) <= 1:
+                    pacer = self.gamestate.logic_worker.pacer if self.gamestate.logic_worker else self.update_pacer
+                    alpha = pacer.alpha(time.perf_counter())
+                    x, y = prevx + (x - prevx) * alpha, prevy + (y - prevy) * alpha
             curx, cury = self.view_x / 16 + self.visible_columns / 2, self.view_y / 16 + self.visible_rows / 2
             viewx, viewy = tiles.tile2pixels(x - self.visible_columns // 2, y - self.visible_rows // 2)
             if not self.scrolling_into_view and abs(curx - x) < self.visible_columns // 3 and abs(cury - y) < self.visible_rows // 3:
@@ -694,6 +882,44 @@ class BoulderWindow(tkinter.Tk):
             return ""
 
 
+def sample_files(krissz: bool=False) -> Dict[str, Tuple[str, int]]:
+    # the sound samples: name -> (sample file, max number of simultaneous plays)
+    return {
+        "music": ("bdmusic.ogg", 1),
+        "cover": ("cover.ogg", 1),
+        "crack": ("crack.ogg", 2),
+        "boulder": ("boulder.ogg", 16 if krissz else 4),
+        "boulder2": ("boulder2.ogg", 16 if krissz else 4),
+        "finished": ("finished.ogg", 1),
+        "explosion": ("explosion.ogg", 2),
+        "voodoo_explosion": ("voodoo_explosion.ogg", 2),
+        "extra_life": ("bonus_life.ogg", 1),
+        "walk_empty": ("walk_empty.ogg", 2),
+        "walk_dirt": ("walk_dirt.ogg", 2),
+        "collect_diamond": ("collectdiamond.ogg", 1),
+        "box_push": ("box_push.ogg", 2),
+        "amoeba": ("amoeba.ogg", 1),
+        "slime": ("slime.ogg", 1),
+        "magic_wall": ("magic_wall.ogg", 1),
+        "game_over": ("game_over.ogg", 1),
+        "diamond1": ("diamond1.ogg", 16 if krissz else 2),
+        "diamond2": ("diamond2.ogg", 16 if krissz else 2),
+        "diamond3": ("diamond3.ogg", 16 if krissz else 2),
+        "diamond4": ("diamond4.ogg", 16 if krissz else 2),
+        "diamond5": ("diamond5.ogg", 16 if krissz else 2),
+        "diamond6": ("diamond6.ogg", 16 if krissz else 2),
+        "timeout1": ("timeout1.ogg", 1),
+        "timeout2": ("timeout2.ogg", 1),
+        "timeout3": ("timeout3.ogg", 1),
+        "timeout4": ("timeout4.ogg", 1),
+        "timeout5": ("timeout5.ogg", 1),
+        "timeout6": ("timeout6.ogg", 1),
+        "timeout7": ("timeout7.ogg", 1),
+        "timeout8": ("timeout8.ogg", 1),
+        "timeout9": ("timeout9.ogg", 1),
+    }
+
+
 def start(sargs: Sequence[str]=None) -> None:
     if sargs is None:
         sargs = sys.argv[1:]
@@ -717,7 +943,13 @@ def start(sargs: Sequence[str]=None) -> None:
     ap.add_argument("-M", "--stipplemirror", help="Indicate the open border boundary with a stipple pattern when using a see-through mirror mode (-m)", action="store_true")
     ap.add_argument("-T", "--nokrissztiles", help="Do not use the Krissz Engine-like tile set even if in Krissz Engine compatibility mode", action="store_true")
     ap.add_argument("-F", "--fullscreen", help="Start BoulderCaves+ in full screen mode", action="store_true")
-    ap.add_argument("-O", "--optimize", type=int, help="Set optimization level (from 0 to 3), each level reduces visual accuracy in favor of performance gains.", default=0, choices=(0, 1, 2, 3))
+    ap.add_argument("-O", "--optimize", help="Set optimization level (from 0 to 3), each level reduces visual accuracy in favor of performance gains. 'auto' adjusts the level to the measured frame time.", default="0", choices=("0", "1", "2", "3", "auto"))
+    ap.add_argument("--logicthread", help="run the game logic on its own thread, separate from the screen updates.", action="store_true")
+    ap.add_argument("--telemetry", metavar="FILE", help="record frame-time telemetry and write it to this file on exit (.csv for a summary, otherwise JSON).")
+    ap.add_argument("--trace", metavar="FILE", help="record trace events of the game loop and write them to this file on exit (Chrome trace event format).")
+    ap.add_argument("--profile", metavar="FILE", nargs="?", const="bouldercaves-profile.folded", help="run a sampling profiler and write the collapsed stacks (and a summary) to this file on exit, default=%(const)s.")
+    ap.add_argument("--smoothscroll", help="interpolate the scroll position in between game updates.", action="store_true")
+    ap.add_argument("--audio", help="audio output backend, 'null' runs without any sound (default=%(default)s).", default="default", choices=audio.backends)
     ap.add_argument("--editor", help="run the Construction Kit instead of the game.", action="store_true")
     ap.add_argument("--playtest", help="playtest the cave.", action="store_true")
     args = ap.parse_args(sargs)
@@ -727,11 +959,11 @@ def start(sargs: Sequence[str]=None) -> None:
         
     if args.editor:
         from . import editor
-        editor.start()
+        editor.start(args.profile)
         raise SystemExit
 
     # validate required libraries
-    audio.check_api()
+    audio.check_api(args.audio)
     args.c64colors |= args.authentic
     if args.c64colors or args.krissz:
         print("Using the original Commodore-64 colors.")
@@ -744,42 +976,9 @@ def start(sargs: Sequence[str]=None) -> None:
         print("Enabling Krissz Engine-like game engine parameters.")
         
     # initialize the audio system
-    samples = {
-        "music": ("bdmusic.ogg", 1),
-        "cover": ("cover.ogg", 1),
-        "crack": ("crack.ogg", 2),
-        "boulder": ("boulder.ogg", 16 if args.krissz else 4),
-        "boulder2": ("boulder2.ogg", 16 if args.krissz else 4),
-        "finished": ("finished.ogg", 1),
-        "explosion": ("explosion.ogg", 2),
-        "voodoo_explosion": ("voodoo_explosion.ogg", 2),
-        "extra_life": ("bonus_life.ogg", 1),
-        "walk_empty": ("walk_empty.ogg", 2),
-        "walk_dirt": ("walk_dirt.ogg", 2),
-        "collect_diamond": ("collectdiamond.ogg", 1),
-        "box_push": ("box_push.ogg", 2),
-        "amoeba": ("amoeba.ogg", 1),
-        "slime": ("slime.ogg", 1),
-        "magic_wall": ("magic_wall.ogg", 1),
-        "game_over": ("game_over.ogg", 1),
-        "diamond1": ("diamond1.ogg", 16 if args.krissz else 2),
-        "diamond2": ("diamond2.ogg", 16 if args.krissz else 2),
-        "diamond3": ("diamond3.ogg", 16 if args.krissz else 2),
-        "diamond4": ("diamond4.ogg", 16 if args.krissz else 2),
-        "diamond5": ("diamond5.ogg", 16 if args.krissz else 2),
-        "diamond6": ("diamond6.ogg", 16 if args.krissz else 2),
-        "timeout1": ("timeout1.ogg", 1),
-        "timeout2": ("timeout2.ogg", 1),
-        "timeout3": ("timeout3.ogg", 1),
-        "timeout4": ("timeout4.ogg", 1),
-        "timeout5": ("timeout5.ogg", 1),
-        "timeout6": ("timeout6.ogg", 1),
-        "timeout7": ("timeout7.ogg", 1),
-        "timeout8": ("timeout8.ogg", 1),
-        "timeout9": ("timeout9.ogg", 1),
-    }
+    samples = sample_files(args.krissz)
 
-    if args.synth:
+    if args.synth and args.audio != "null":
         print("Pre-synthesizing sounds...")
         diamond = synthsamples.Diamond()   # is randomized everytime it is played
         synthesized = {
@@ -829,7 +1028,7 @@ def start(sargs: Sequence[str]=None) -> None:
 
     if os.name == "nt":
         audio.prepare_oggdec_exe()
-    audio.init_audio(samples)
+    audio.init_audio(samples, args.audio)
     title = "BoulderCaves+ {version:s} {sound:s} {playtest:s} - by Irmen de Jong, extended by Michael Kamensky"\
         .format(version=__version__,
                 sound="[synth]" if args.synth else "",
@@ -845,9 +1044,14 @@ def start(sargs: Sequence[str]=None) -> None:
                            krissztileset=args.krissz and not args.nokrissztiles,
                            fullscreen=args.fullscreen,
                            size_defined=size_defined,
-                           optimize=args.optimize,
+                           optimize=0 if args.optimize == "auto" else int(args.optimize),
+                           auto_optimize=args.optimize == "auto",
+                           telemetry_file=args.telemetry,
+                           trace_file=args.trace,
                            mirror_size=args.mirrorborder,
-                           stipple_mirror=args.stipplemirror)
+                           stipple_mirror=args.stipplemirror,
+                           interpolate_scroll=args.smoothscroll,
+                           logic_thread=args.logicthread)
     if args.game:
         window.gamestate.use_bdcff(args.game)
     if args.level:
@@ -859,7 +1063,11 @@ def start(sargs: Sequence[str]=None) -> None:
     if args.othertiles:
         print("Using alternate tileset (created by Marcel Sásik)")
     window.start()
-    window.mainloop()
+    if args.profile:
+        from . import profiler
+        profiler.run_profiled(window.mainloop, args.profile)
+    else:
+        window.mainloop()
 
 
 if __name__ == "__main__":
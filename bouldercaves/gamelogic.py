@@ -14,12 +14,15 @@ import datetime
 import math
 import random
 import json
+import time
+import threading
+import traceback
 from .caves import C64Cave
 from enum import Enum
-from typing import List, Optional, Sequence, Generator
+from typing import List, Optional, Sequence, Generator, Dict, Set, Tuple, Callable
 from .objects import Direction
-from .helpers import TextHelper
-from . import caves, audio, user_data_dir, tiles, objects
+from .helpers import TextHelper, FramePacer
+from . import caves, audio, user_data_dir, tiles, objects, tracing
 
 
 class GameStatus(Enum):
@@ -193,6 +196,7 @@ class GameState:
         self.rockford_birth_stages = (objects.ROCKFORDBIRTH_1, objects.ROCKFORDBIRTH_2, objects.ROCKFORDBIRTH_3, objects.ROCKFORDBIRTH_4)
         self.highscores = HighScores(self.caveset.name)
         self.playtesting = False
+        self.sounds = audio.SoundQueue()   # sounds are collected per logic frame and played in one batch at the end
         # set the anim end callbacks:
         # animation callbacks are ONLY used when the level is won/lost in order to finish pending animations
         # they should not be tied to game logic during the regular cave scans when playing the game, or it
@@ -201,6 +205,17 @@ class GameState:
         objects.DIAMONDBIRTH.anim_end_callback = self.end_diamondbirth_animation
         # will be used when resizing smaller caves to fit nearly into a larger visible playfield
         self.cave_orig_width = self.cave_orig_height = 0
+        # the next level is prepared in a background thread during the final score count
+        # (level, width, height, cells, tinted sprites), handed over under the lock
+        self.preloaded_level = 0
+        self.preloaded = None       # type: Optional[Tuple[int, int, int, List[Cell], Optional[Sequence[bytes]]]]
+        # optional logic worker thread, see LogicWorker. While it runs an update, tile changes and
+        # actions that need the window are collected in these lists instead of being done directly.
+        self.lock = threading.RLock()
+        self.logic_worker = None        # type: Optional[LogicWorker]
+        self.tile_changes = None        # type: Optional[List[Tuple[int, int, objects.GameObject]]]
+        self.deferred_actions = None    # type: Optional[List[Callable[[], None]]]
+        self.cells_scanned = self.cells_updated = 0     # telemetry: cells looked at and handed to an update handler in the last update
         # and start the game on the title screen.
         self.restart()
 
@@ -237,8 +252,18 @@ class GameState:
         objects.ROCKFORD.stirring.sfps = update_speed
 
     def destroy(self) -> None:
+        if self.logic_worker:
+            self.logic_worker.stop()
         self.highscores.save()
 
+    def run_or_defer(self, action: Callable[[], None]) -> None:
+        # actions that touch the window (level changes, scrolling) are handed over to the Tk thread
+        # when the update runs on the logic worker
+        if self.deferred_actions is None:
+            action()
+        else:
+            self.deferred_actions.append(action)
+
     def end_explosion_animation(self, cell: Cell) -> None:
         if self.level_won:
             self.clear_cell(cell)
@@ -248,8 +273,10 @@ class GameState:
             self.draw_single_cell(cell, objects.DIAMOND)
 
     def restart(self) -> None:
-        audio.silence_audio()
-        audio.play_sample("music", repeat=True, after=1)
+        if self.logic_worker:
+            self.logic_worker.discard_snapshots()  # the previous cave's tile changes that weren't drawn yet
+        self.sounds.silence()
+        self.sounds.play("music", repeat=True, after=1)
         self.frame = 0
         self.initial_update_frame = 0
         self.demo_or_highscore = True
@@ -353,7 +380,7 @@ WWWWWWWWWWWWWWWWWWWWWWWWWWWWWW
             self.draw_single(objects.DIRTSLOPEDUPRIGHT, self.width - 4, self.height - 3)
             self.draw_single(objects.DIRTSLOPEDUPRIGHT, self.width - 3, self.height - 2)
 
-    def _create_cave(self, width: int, height: int) -> None:
+    def _create_cave(self, width: int, height: int, cells: List[Cell]=None) -> None:
         self.width = width
         self.height = height
         self._dirxy = {
@@ -367,27 +394,36 @@ WWWWWWWWWWWWWWWWWWWWWWWWWWWWWW
             Direction.LEFTDOWN: self.width - 1,
             Direction.RIGHTDOWN: self.width + 1
         }
-        self.cave = []   # type: List[Cell]
-        for y in range(self.height):
-            for x in range(self.width):
-                self.cave.append(Cell(objects.EMPTY, x, y))
+        if cells is not None:
+            self.cave = cells
+        else:
+            self.cave = []   # type: List[Cell]
+            for y in range(self.height):
+                for x in range(self.width):
+                    self.cave.append(Cell(objects.EMPTY, x, y))
+        # live number of cells per object id, and the cell indices of a few objects that are looked up often.
+        # these are kept up to date by draw_single_cell so the whole cave doesn't have to be scanned for them.
+        self.population = [0] * caves.NUM_OBJECT_IDS
+        self.population[objects.EMPTY.id] = len(self.cave)
+        self.population_cells = {oid: set() for oid in self.population_tracked_ids}    # type: Dict[int, Set[int]]
+
+    # not the background objects (empty space, dirt, walls): most cell writes involve those, and nothing looks them up
+    population_tracked_ids = (objects.INBOXBLINKING.id, objects.AMOEBA.id, objects.AMOEBARECTANGLE.id)
+
+    def population_count(self, *objs: objects.GameObject) -> int:
+        return sum(self.population[obj.id] for obj in objs)
+
+    def first_cell(self, obj: objects.GameObject) -> Optional[Cell]:
+        # the first cell (in scan order) that contains the object; only for the objects in population_tracked_ids
+        indices = self.population_cells[obj.id]
+        return self.cave[min(indices)] if indices else None
 
     def draw_new_cave(self, levelnumber):
         # clear the previous cave data and replace with data from new cave
         self.game.clear_tilesheet()
         self.draw_rectangle(objects.FILLERWALL, 0, 0, self.width, self.height, objects.FILLERWALL)
-        cave = self.caveset.cave(levelnumber)
-        self.cave_delta_x = self.cave_delta_y = 0
-        if cave.width > self.game.visible_columns or cave.height > self.game.visible_rows:
-            delta_x, delta_y = cave.add_mirrored_borders(self.game.mirrored_border_size, \
-                self.open_horizontal_borders, self.open_vertical_borders)
-            self.cave_delta_x += delta_x
-            self.cave_delta_y += delta_y
-        if cave.width < self.game.visible_columns or cave.height < self.game.visible_rows:
-            filler = objects.FILLERWALL
-            delta_x, delta_y = cave.resize(self.game.visible_columns, self.game.visible_rows, filler)
-            self.cave_delta_x += delta_x
-            self.cave_delta_y += delta_y
+        cave, self.cave_delta_x, self.cave_delta_y = self.caveset.fitted_cave(levelnumber, self.game.visible_columns,
+                                                                              self.game.visible_rows, self.game.mirrored_border_size)
         for i, (gobj, direction) in enumerate(cave.map):
             y, x = divmod(i, cave.width)
             self.draw_single(gobj, x, y, initial_direction=direction)
@@ -413,33 +449,26 @@ WWWWWWWWWWWWWWWWWWWWWWWWWWWWWW
         self.reveal_duration = 0.0
         self.load_next_level(False)
 
+    @tracing.traced("load_level")
     def load_level(self, levelnumber: int, level_intro_popup: bool=True) -> None:
         if levelnumber == 1 or self.start_level_number == levelnumber:
-            audio.silence_audio() # silence all sounds for the first level, to ensure music is stopped
+            self.sounds.silence() # silence all sounds for the first level, to ensure music is stopped
         else:
-            audio.silence_audio("amoeba") # otherwise, at least finish playing the sounds that are on repeat
-            audio.silence_audio("magic_wall")
+            self.sounds.silence("amoeba") # otherwise, at least finish playing the sounds that are on repeat
+            self.sounds.silence("magic_wall")
+        if self.logic_worker:
+            self.logic_worker.discard_snapshots()  # the previous cave's tile changes that weren't drawn yet
         self.game.popup_close()    # make sure any open popup won't restore the old tiles
         self.cheat_used = self.cheat_used or (self.start_level_number > 1)
-        cave = self.caveset.cave(levelnumber)
-        self.cave_orig_width = cave.width
-        self.cave_orig_height = cave.height
-        self.cave_orig_len = len(self.cave)
-        self.cave_delta_x = 0
-        self.cave_delta_y = 0
         if self.game.mirrored_border_size > self.game.visible_columns // 2 + 3:
             self.game.mirrored_border_size = self.game.visible_columns // 2 + 3
-        if cave.width > self.game.visible_columns or cave.height > self.game.visible_rows:
-            delta_x, delta_y = cave.add_mirrored_borders(self.game.mirrored_border_size, \
-                cave.open_horizontal_borders, cave.open_vertical_borders)
-            self.cave_delta_x += delta_x
-            self.cave_delta_y += delta_y
-        if cave.width < self.game.visible_columns or cave.height < self.game.visible_rows:
-            filler = objects.FILLERWALL
-            delta_x, delta_y = cave.resize(self.game.visible_columns, self.game.visible_rows, filler)
-            self.cave_delta_x += delta_x
-            self.cave_delta_y += delta_y
-        self._create_cave(cave.width, cave.height)
+        cave, self.cave_delta_x, self.cave_delta_y = self.caveset.fitted_cave(levelnumber, self.game.visible_columns,
+                                                                              self.game.visible_rows, self.game.mirrored_border_size)
+        self.cave_orig_width = cave.orig_width
+        self.cave_orig_height = cave.orig_height
+        self.cave_orig_len = len(self.cave)
+        preloaded = self.take_preloaded_level(levelnumber, cave.width, cave.height)
+        self._create_cave(cave.width, cave.height, preloaded[3] if preloaded else None)
         self.game.create_canvas_playfield_and_tilesheet(cave.width, cave.height)
         self.level_name = cave.name
         self.level_description = cave.description
@@ -510,20 +539,16 @@ WWWWWWWWWWWWWWWWWWWWWWWWWWWWWW
             self.game.clear_tilesheet()
         else:
             self.draw_new_cave(self.level)
-        self.game.create_colored_tiles(cave.colors)
+        self.game.create_colored_tiles(cave.colors, preloaded[4] if preloaded else None)
         self.game.set_screen_colors(cave.colors.rgb_screen, cave.colors.rgb_border)
         self.check_initial_amoeba_dormant()
 
         def prepare_reveal() -> None:
             self.game.prepare_reveal()
-            audio.play_sample("cover", repeat=True)
+            self.sounds.play("cover", repeat=True)
 
         if self.game.krissz_engine_compat:
-            inbox_location = None
-            for cell in self.cave:
-                if cell.obj.id == objects.INBOXBLINKING.id:
-                    inbox_location = cell
-                    break
+            inbox_location = self.first_cell(objects.INBOXBLINKING)
             # on Krissz Engine, always seems to scroll from the vicinity of the inbox. In our implementation,
             # scroll from the vicinity of the inbox when the inbox is too far from the origin point (0, 0)
             if inbox_location and (inbox_location.x > self.game.visible_columns * 2 or inbox_location.y > self.game.visible_rows * 2):
@@ -542,18 +567,19 @@ WWWWWWWWWWWWWWWWWWWWWWWWWWWWWW
 
     def check_initial_amoeba_dormant(self) -> None:
         if self.amoeba["dormant"]:
-            for cell in self.cave:
-                if cell.isamoeba():
-                    cell_up = self.get(cell, Direction.UP)
-                    cell_down = self.get(cell, Direction.DOWN)
-                    cell_left = self.get(cell, Direction.LEFT)
-                    cell_right = self.get(cell, Direction.RIGHT)
-                    if cell_up.isempty() or cell_down.isempty() or cell_right.isempty() or cell_left.isempty() \
-                            or cell_up.isdirt() or cell_down.isdirt() or cell_right.isdirt() or cell_left.isdirt():
-                        # amoeba can grow, so is not dormant
-                        self.amoeba["dormant"] = False
-                        audio.play_sample("amoeba", repeat=True)  # start playing amoeba sound
-                        return
+            amoeba_cells = self.population_cells[objects.AMOEBA.id] | self.population_cells[objects.AMOEBARECTANGLE.id]
+            for index in sorted(amoeba_cells):
+                cell = self.cave[index]
+                cell_up = self.get(cell, Direction.UP)
+                cell_down = self.get(cell, Direction.DOWN)
+                cell_left = self.get(cell, Direction.LEFT)
+                cell_right = self.get(cell, Direction.RIGHT)
+                if cell_up.isempty() or cell_down.isempty() or cell_right.isempty() or cell_left.isempty() \
+                        or cell_up.isdirt() or cell_down.isdirt() or cell_right.isdirt() or cell_left.isdirt():
+                    # amoeba can grow, so is not dormant
+                    self.amoeba["dormant"] = False
+                    self.sounds.play("amoeba", repeat=True)  # start playing amoeba sound
+                    return
 
     def tile_music_ended(self) -> None:
         # do one of two things: play the demo, or show the highscore list for a short time
@@ -644,6 +670,13 @@ WWWWWWWWWWWWWWWWWWWWWWWWWWWWWW
         self.draw_single_cell(self.cave[x + y * self.width], obj, initial_direction)
 
     def draw_single_cell(self, cell: Cell, obj: objects.GameObject, initial_direction: Direction=Direction.NOWHERE) -> None:
+        if cell.obj.id != obj.id:
+            self.population[cell.obj.id] -= 1
+            self.population[obj.id] += 1
+            if cell.obj.id in self.population_cells:
+                self.population_cells[cell.obj.id].discard(cell.x + cell.y * self.width)
+            if obj.id in self.population_cells:
+                self.population_cells[obj.id].add(cell.x + cell.y * self.width)
         cell.obj = obj
         cell.direction = initial_direction
         cell.frame = self.frame   # make sure the new cell is not immediately scanned
@@ -659,7 +692,10 @@ WWWWWWWWWWWWWWWWWWWWWWWWWWWWWW
             # RockfordBirth1 is set to look the same as the inbox, since first the crack sound is heard, and then next frame,
             # the actual rockford birth animation is played
             obj = objects.INBOXBLINKING_1 if self.inbox_outbox_blink_state else objects.INBOXBLINKING_2
-        self.game.set_canvas_tile(cell.x, cell.y, obj)
+        if self.tile_changes is None:
+            self.game.set_canvas_tile(cell.x, cell.y, obj)
+        else:
+            self.tile_changes.append((cell.x, cell.y, obj))
         # animation is handled by the graphics refresh
 
     def clear_cell(self, cell: Cell) -> None:
@@ -744,14 +780,20 @@ WWWWWWWWWWWWWWWWWWWWWWWWWWWWWW
 
     def update(self, graphics_frame_counter: int) -> None:
         self.graphics_frame_counter = graphics_frame_counter           # we store this to properly sync up animation frames
-        self.diamond_sound_played = self.boulder_sound_played = False  # prevent grindy sounds on maps like Blifil
         self.inbox_outbox_blink_state = not self.inbox_outbox_blink_state # for inbox and outbox blinking animation
+        self.sounds.begin_frame()
+        try:
+            self.update_frame()
+        finally:
+            self.sounds.end_frame()
+
+    def update_frame(self) -> None:
         self.frame_start()
         if self.game_status in (GameStatus.REVEALING_DEMO, GameStatus. REVEALING_PLAY):
             if self.reveal_frame > self.frame:
                 return
             # reveal period has ended
-            audio.silence_audio("cover")
+            self.sounds.silence("cover")
             self.game.tilesheet.all_dirty()  # force full redraw
             if self.game_status == GameStatus.REVEALING_DEMO:
                 self.game_status = GameStatus.DEMO
@@ -761,6 +803,7 @@ WWWWWWWWWWWWWWWWWWWWWWWWWWWWWW
             return
         if not self.level_won:
             # sweep the cave
+            cells_updated = 0
             for cell in self.cave:
                 if cell.obj.id == objects.BORDER_MIRROR.id or cell.obj.id == objects.FILLERWALL.id:
                     continue # not processed in the cave scanning order
@@ -797,11 +840,17 @@ WWWWWWWWWWWWWWWWWWWWWWWWWWWWWW
                     elif cell.obj.id in (objects.ROCKFORDBIRTH_1.id, objects.ROCKFORDBIRTH_2.id, objects.ROCKFORDBIRTH_3.id,
                                          objects.ROCKFORDBIRTH_4.id):
                         self.update_rockfordbirth(cell)
+                    else:
+                        continue    # nothing to do for this cell (dirt, walls...)
+                    cells_updated += 1
+            self.cells_scanned = len(self.cave)
+            self.cells_updated = cells_updated
         self.frame_end()
 
     def frame_start(self) -> None:
         # called at beginning of every game logic update
         self.frame += 1
+        self.cells_scanned = self.cells_updated = 0
         self.movement.pushing = False
         if not self.movement.moving and self.rockford_cell:
             # TODO: fix the blinking animation somehow
@@ -815,7 +864,7 @@ WWWWWWWWWWWWWWWWWWWWWWWWWWWWWW
         if self.amoeba["dead"] == objects.DIAMOND and self.magic_wall_stops_amoeba_phase == 1:
             if self.amoeba["size"] > self.amoeba["max"]: # overwrite conversion to diamonds (CSO 206)
                 self.amoeba["dead"] = objects.BOULDER
-                audio.play_sample("boulder")
+                self.sounds.play("boulder")
                 self.magic_wall_stops_amoeba_phase = 2
         if not self.level_won and not self.game_status == GameStatus.OUT_OF_TIME:
             self.rockford_cell = None
@@ -825,12 +874,12 @@ WWWWWWWWWWWWWWWWWWWWWWWWWWWWWW
         if self.amoeba["dead"] is None:
             if self.amoeba["enclosed"] and not self.amoeba["dormant"]:
                 self.amoeba["dead"] = objects.DIAMOND       # type: ignore
-                audio.silence_audio("amoeba")
-                audio.play_sample("diamond1")
+                self.sounds.silence("amoeba")
+                self.sounds.play("diamond1")
             elif self.amoeba["size"] > self.amoeba["max"]:  # type: ignore
                 self.amoeba["dead"] = objects.BOULDER       # type: ignore
-                audio.silence_audio("amoeba")
-                audio.play_sample("boulder")
+                self.sounds.silence("amoeba")
+                self.sounds.play("boulder")
             elif self.amoeba["slow"] > 0 and self.start_signal_frame != -1: # type: ignore
                 self.amoeba["slow"] -= 1                    # type: ignore
         if self.magicwall["active"]:
@@ -838,7 +887,7 @@ WWWWWWWWWWWWWWWWWWWWWWWWWWWWWW
             still_magic = self.magicwall["time"] > 0
             if self.magicwall["active"] and not still_magic:
                 # magic wall has stopped! stop playing the milling sound
-                audio.silence_audio("magic_wall")
+                self.sounds.silence("magic_wall")
             self.magicwall["active"] = still_magic
         secs_before = self.timeremaining.seconds if not self.reverse_time else int(self.reverse_timer)
         if self.timelimit and not self.level_won and self.rockford_cell:
@@ -854,8 +903,9 @@ WWWWWWWWWWWWWWWWWWWWWWWWWWWWWW
         secs_after = self.timeremaining.seconds if not self.reverse_time else int(self.reverse_timer)
         if 1 <= secs_after <= 9:
             if self.level_won or secs_after < secs_before:
-                audio.play_timeout_sample(10 - secs_after)
+                self.sounds.play_timeout(10 - secs_after)
         if self.level_won:
+            self.preload_next_level()
             original_update_timestep = self.update_timestep
             #self.update_timestep = 1 / self.game.update_fps
             self.update_timestep = 1 / 20.0 # FIXME: update at 20 fps during the final score count - check Krissz
@@ -874,19 +924,19 @@ WWWWWWWWWWWWWWWWWWWWWWWWWWWWWW
                 if self.reverse_timer < 0:
                     self.reverse_timer = 0
                 if self.reverse_timer == 0:
-                    audio.silence_audio("finished")
+                    self.sounds.silence("finished")
             elif self.no_time_limit and self.timeremaining.seconds > 0:
                 self.timeremaining -= datetime.timedelta(seconds=1)
             else:
                 self.update_timestep = original_update_timestep
                 if self.game_status == GameStatus.DEMO:
-                    self.restart()  # go back to title screen when demo finishes
+                    self.run_or_defer(self.restart)  # go back to title screen when demo finishes
                 else:
-                    self.load_next_level()
+                    self.run_or_defer(self.load_next_level)
         elif self.timelimit and self.update_timestep * (self.frame - self.rockford_found_frame) > 10 \
             and not (self.rockford_cell or self.inbox_cell):
             # after 10 seconds with dead rockford we reload the current level
-            self.life_lost()
+            self.run_or_defer(self.life_lost)
 
     def focus_cell(self) -> Optional[Cell]:
         focus_cell = self.rockford_cell or self.inbox_cell or self.last_focus_cell
@@ -895,10 +945,7 @@ WWWWWWWWWWWWWWWWWWWWWWWWWWWWWW
             return focus_cell
         # search for the inbox when the game isn't running yet
         if self.level > 0:
-            for cell in self.cave:
-                if cell.obj.id == objects.INBOXBLINKING.id:
-                    self.last_focus_cell = cell
-                    break
+            self.last_focus_cell = self.first_cell(objects.INBOXBLINKING) or self.last_focus_cell
         return self.last_focus_cell
 
     def life_lost(self) -> None:
@@ -920,11 +967,11 @@ WWWWWWWWWWWWWWWWWWWWWWWWWWWWWW
         if self.game.mirrored_border_size > 0 and self.game.stippled_mirrored_border:
             self.game.canvas.delete('mirrorborder') # remove the stippled border overlay if it was present
         if status == GameStatus.LOST:
-            audio.play_sample("game_over")
+            self.sounds.play("game_over")
             popuptxt = "Game Over.\n\nScore: {:d}".format(self.score)
         elif status == GameStatus.WON:
             self.lives = 0
-            audio.silence_audio("finished")
+            self.sounds.silence("finished")
             popuptxt = "Congratulations, you finished the game!\n\nScore: {:d}".format(self.score)
         else:
             popuptxt = "??invalid status??"
@@ -947,12 +994,47 @@ WWWWWWWWWWWWWWWWWWWWWWWWWWWWWW
                     self.highscores.add(name, score)
         self.game.popup(popuptxt, on_close=lambda: ask_highscore_name(score_pos, self.score))
 
+    def preload_next_level(self) -> None:
+        # Prepares the next level in a background thread while the score is counted down: the fitted cave map
+        # (memoized in the caveset), a fresh set of cells and the tinted sprites. load_level then picks these up.
+        level = self.level + 1
+        if level > self.caveset.num_caves or self.preloaded_level == level:
+            return
+        self.preloaded_level = level
+        visible_columns, visible_rows = self.game.visible_columns, self.game.visible_rows
+        mirrored_border_size = min(self.game.mirrored_border_size, self.game.visible_columns // 2 + 3)
+
+        def preload() -> None:
+            try:
+                cave, _, _ = self.caveset.fitted_cave(level, visible_columns, visible_rows, mirrored_border_size)
+                sprites = self.game.prepare_colored_tiles(cave.colors)
+                cells = [Cell(objects.EMPTY, x, y) for y in range(cave.height) for x in range(cave.width)]
+            except Exception as x:
+                print("Could not preload the next level:", x)   # it will be loaded the normal way
+                return
+            with self.lock:
+                if self.preloaded_level == level:   # otherwise a level was loaded in the meantime, this is too late
+                    self.preloaded = (level, cave.width, cave.height, cells, sprites)
+
+        threading.Thread(target=preload, name="preload level", daemon=True).start()
+
+    def take_preloaded_level(self, levelnumber: int, width: int, height: int) -> \
+            Optional[Tuple[int, int, int, List[Cell], Optional[Sequence[bytes]]]]:
+        # what the preload thread prepared, if that was for this level (and playfield). A preload that is still
+        # running is abandoned: it will see that preloaded_level changed and drop its result.
+        with self.lock:
+            preloaded, self.preloaded = self.preloaded, None
+            self.preloaded_level = 0
+        if preloaded and preloaded[:3] == (levelnumber, width, height):
+            return preloaded
+        return None
+
     def load_next_level(self, intro_popup: bool=True) -> None:
         level = self.level + 1
         if level > self.caveset.num_caves:
             self.stop_game(GameStatus.WON)
         else:
-            audio.silence_audio("finished")
+            self.sounds.silence("finished")
             self.load_level(level, level_intro_popup=intro_popup)
 
     def update_canfall(self, cell: Cell) -> None:
@@ -1035,7 +1117,7 @@ WWWWWWWWWWWWWWWWWWWWWWWWWWWWWW
             cell_under_slime = self.get(cell, Direction.DOWN)
             if cell_under_slime.isempty() and cell_above_slime.canfall():
                 if not self.game.krissz_engine_compat: # no slime sound is played in Krissz Engine
-                    audio.play_sample("slime")
+                    self.sounds.play("slime")
                 obj = cell_above_slime.obj
                 self.clear_cell(cell_above_slime)
                 self.draw_single_cell(cell_under_slime, obj)
@@ -1101,7 +1183,7 @@ WWWWWWWWWWWWWWWWWWWWWWWWWWWWWW
                 self.reverse_timer += 1.0
             if self.diamonds_needed <= 0:
                 # need to subtract this from the current number of diamonds in the cave
-                numdiamonds = sum([1 for c in self.cave if c.isdiamond()])
+                numdiamonds = self.population_count(objects.DIAMOND, objects.FLYINGDIAMOND)
                 self.diamonds_needed = max(0, numdiamonds + self.diamonds_needed)
         elif cell.update_stage == 4: # the fourth stage is when the birth object is switched to proper Rockford
             if self.game_status in (GameStatus.PLAYING, GameStatus.DEMO):
@@ -1130,7 +1212,7 @@ WWWWWWWWWWWWWWWWWWWWWWWWWWWWWW
         if update_condition:
             self.inbox_outbox_blink_state = not self.inbox_outbox_blink_state # flip the state right before transitioning
             self.draw_single_cell(cell, objects.ROCKFORDBIRTH_1)
-            audio.play_sample("crack")
+            self.sounds.play("crack")
         else:
             self.draw_single_cell(cell, objects.INBOXBLINKING_2 if self.inbox_outbox_blink_state else objects.INBOXBLINKING_1)
         # Krissz Engine: if Voodoo Rockford is killed before the level starts, the inbox blows up
@@ -1144,7 +1226,7 @@ WWWWWWWWWWWWWWWWWWWWWWWWWWWWWW
             return   # do nothing if rockford hasn't appeared yet
         if self.diamonds >= self.diamonds_needed:
             if cell.obj.id != objects.OUTBOXBLINKING.id:
-                audio.play_sample("crack")
+                self.sounds.play("crack")
                 self.draw_single_cell(cell, objects.OUTBOXBLINKING_2 if self.inbox_outbox_blink_state else objects.OUTBOXBLINKING_1)
     
     def update_outboxblinking(self, cell: Cell) -> None:
@@ -1155,7 +1237,7 @@ WWWWWWWWWWWWWWWWWWWWWWWWWWWWWW
             return   # do nothing if rockford hasn't appeared yet
         if self.diamonds >= self.diamonds_needed:
             if cell.obj.id != objects.OUTBOXHIDDENOPEN.id:
-                audio.play_sample("crack")
+                self.sounds.play("crack")
             self.draw_single_cell(cell, objects.OUTBOXHIDDENOPEN)
 
     def update_amoeba(self, cell: Cell) -> None:
@@ -1173,7 +1255,7 @@ WWWWWWWWWWWWWWWWWWWWWWWWWWWWWW
                 if self.amoeba["dormant"]:
                     # amoeba can grow, so is not dormant anymore
                     self.amoeba["dormant"] = False
-                    audio.play_sample("amoeba", repeat=True)  # start playing amoeba sound
+                    self.sounds.play("amoeba", repeat=True)  # start playing amoeba sound
             if self.timelimit or self.amoeba_grows_before_spawn:
                 grow = random.randint(1, 128) <= 4 if self.amoeba["slow"] > 0 else random.randint(1, 4) == 1
                 target_cell = random.choice([cell_up, cell_down, cell_left, cell_right])
@@ -1200,7 +1282,7 @@ WWWWWWWWWWWWWWWWWWWWWWWWWWWWWW
                 if self.movement.grab:
                     if targetcell.isdirt():
                         if not approaching_timeout:
-                            audio.play_sample("walk_dirt")
+                            self.sounds.play("walk_dirt")
                         self.clear_cell(targetcell)
                     elif targetcell.isdiamond():
                         self.collect_diamond()
@@ -1208,23 +1290,23 @@ WWWWWWWWWWWWWWWWWWWWWWWWWWWWWW
                     elif targetcell.isoutbox():
                         self.level_won = True   # exit found!
                         self.clear_cell(targetcell)
-                        audio.silence_audio()
+                        self.sounds.silence()
                         if not self.no_time_limit or self.reverse_time:
-                            audio.play_sample("finished", repeat=True)
+                            self.sounds.play("finished", repeat=True)
                         self.movement.stop_all()
                     elif self.movement.direction in (Direction.LEFT, Direction.RIGHT) and targetcell.isboulder() \
                         and not targetcell.isheavy():
                         self.push(cell, self.movement.direction)
                     elif targetcell.isempty():
                         if not approaching_timeout:
-                            audio.play_sample("walk_empty")
+                            self.sounds.play("walk_empty")
                 elif targetcell.isempty():
                     if not approaching_timeout:
-                        audio.play_sample("walk_empty")
+                        self.sounds.play("walk_empty")
                     new_cell = self.move(cell, self.movement.direction)
                 elif targetcell.isdirt():
                     if not approaching_timeout:
-                        audio.play_sample("walk_dirt")
+                        self.sounds.play("walk_dirt")
                     new_cell = self.move(cell, self.movement.direction)
                 elif targetcell.isboulder() and self.movement.direction in (Direction.LEFT, Direction.RIGHT) \
                     and not targetcell.isheavy():
@@ -1235,9 +1317,9 @@ WWWWWWWWWWWWWWWWWWWWWWWWWWWWWW
                 elif targetcell.isoutbox():
                     new_cell = self.move(cell, self.movement.direction)
                     self.level_won = True   # exit found!
-                    audio.silence_audio()
+                    self.sounds.silence()
                     if not self.no_time_limit or self.reverse_time:
-                        audio.play_sample("finished", repeat=True)
+                        self.sounds.play("finished", repeat=True)
                     self.movement.stop_all()
             self.movement.move_done()
         if new_cell and new_cell is not self.rockford_cell:
@@ -1246,9 +1328,9 @@ WWWWWWWWWWWWWWWWWWWWWWWWWWWWWW
         self.rockford_cell = new_cell
         # Open borders: jump into view immediately to imitate smooth transition
         if self.open_horizontal_borders and ((cell.x == self.cave_delta_x and self.movement.direction == Direction.LEFT) or (cell.x == self.cave_orig_width - 1 + self.cave_delta_x and self.movement.direction == Direction.RIGHT)):
-            self.game.scroll_focuscell_into_view(immediate=True)
+            self.run_or_defer(lambda: self.game.scroll_focuscell_into_view(immediate=True))
         if self.open_vertical_borders and ((cell.y == self.cave_delta_y and self.movement.direction == Direction.UP) or (cell.y == self.cave_orig_height - 1 + self.cave_delta_y and self.movement.direction == Direction.DOWN)):
-            self.game.scroll_focuscell_into_view(immediate=True)
+            self.run_or_defer(lambda: self.game.scroll_focuscell_into_view(immediate=True))
         # - Open borders -
 
     def update_expandingwall(self, cell: Cell) -> None:
@@ -1272,19 +1354,18 @@ WWWWWWWWWWWWWWWWWWWWWWWWWWWWWW
             if down.isempty():
                 self.draw_single_cell(down, cell.obj)
                 expanded = True
-        if expanded and not self.boulder_sound_played:
-            audio.play_sample("boulder")
-            self.boulder_sound_played = True
+        if expanded:
+            self.sounds.play("boulder", group="boulder")
 
     def do_magic(self, cell: Cell) -> None:
         # something (diamond, boulder) is falling on a magic wall
         if self.magicwall["time"] > 0:
             if not self.magicwall["active"]:
                 # magic wall activates! play sound. Will be silenced once the milling timer runs out.
-                audio.play_sample("magic_wall", repeat=True)
+                self.sounds.play("magic_wall", repeat=True)
                 # substandard: if magic wall stops amoeba, switch all amoeba into diamonds upon activation.
                 if self.magic_wall_stops_amoeba and self.magic_wall_stops_amoeba_phase == 0:
-                    audio.silence_audio("amoeba")
+                    self.sounds.silence("amoeba")
                     self.amoeba["dead"] = objects.DIAMOND
                     self.magic_wall_stops_amoeba_phase = 1 # trigger Magic Wall Stops Amoeba starting this moment.
             self.magicwall["active"] = True
@@ -1301,12 +1382,7 @@ WWWWWWWWWWWWWWWWWWWWWWWWWWWWWW
             # magic wall is disabled, stuff falling on it just disappears (a sound is already played)
             self.clear_cell(cell)
         # play the diamond sound regardless of what happens (per Krissz Engine, GDash, BDCFF specs)
-        if not self.diamond_sound_played:
-            if self.game.krissz_engine_compat:
-                audio.play_krissz_diamond_sample()
-            else:
-                audio.play_sample("diamond" + str(random.randint(1, 6)))
-            self.diamond_sound_played = True
+        self.diamond_sound()
 
     def update_scorebar(self) -> None:
         # draw the score bar.
@@ -1423,27 +1499,26 @@ WWWWWWWWWWWWWWWWWWWWWWWWWWWWWW
         self.game.set_scorebar_tiles(0, 1, line_tiles[:40] if not self.game.window30x18 else line_tiles[:30]) # line 2
 
     def fall_sound(self, cell: Cell, pushing: bool=False) -> None:
+        # only one boulder and one diamond sound per frame, to prevent grindy sounds on maps like Blifil
         if cell.isboulder() or cell.iswall():
             if pushing:
-                audio.play_sample("box_push")
+                self.sounds.play("box_push")
+            elif self.game.krissz_engine_compat:
+                self.sounds.play_krissz_boulder()
             else:
-                if not self.boulder_sound_played:
-                    if self.game.krissz_engine_compat:
-                        audio.play_krissz_boulder_sample()
-                    else:
-                        audio.play_sample("boulder")
-                    self.boulder_sound_played = True
+                self.sounds.play("boulder", group="boulder")
         elif cell.isdiamond():
-            if not self.diamond_sound_played:
-                if self.game.krissz_engine_compat:
-                    audio.play_krissz_diamond_sample()
-                else:
-                    audio.play_sample("diamond" + str(random.randint(1, 6)))
-                self.diamond_sound_played = True
+            self.diamond_sound()
+
+    def diamond_sound(self) -> None:
+        if self.game.krissz_engine_compat:
+            self.sounds.play_krissz_diamond()
+        else:
+            self.sounds.play("diamond" + str(random.randint(1, 6)), group="diamond")
 
     def collect_diamond(self) -> None:
-        audio.silence_audio("collect_diamond")
-        audio.play_sample("collect_diamond")
+        self.sounds.silence("collect_diamond")
+        self.sounds.play("collect_diamond")
         self.diamonds += 1
         points = self.diamondvalue_extra if self.diamonds > self.diamonds_needed else self.diamondvalue_initial
         self.score += points
@@ -1461,7 +1536,7 @@ WWWWWWWWWWWWWWWWWWWWWWWWWWWWWW
     def add_extra_life(self) -> None:
         if self.lives < 9 and not self.single_life:   # 9 is the maximum number of lives
             self.lives += 1
-            audio.play_sample("extra_life")
+            self.sounds.play("extra_life")
             for cell in self.cave:
                 if cell.obj.id == objects.EMPTY.id:
                     self.draw_single_cell(cell, objects.BONUSBG)
@@ -1496,7 +1571,7 @@ WWWWWWWWWWWWWWWWWWWWWWWWWWWWWW
                         self.draw_single_cell(cell, explode_obj)
             except:
                 pass # prevent crashes when e.g. exploding in the bottom row
-        audio.play_sample(explosion_sample)
+        self.sounds.play(explosion_sample)
 
 
 class MovementInfo:
@@ -1626,3 +1701,90 @@ class DemoMovementInfo(MovementInfo):
             }[d]
             for _ in range(step >> 4):
                 yield direction
+
+
+class FrameSnapshot:
+    # what the logic worker publishes at the end of a game update: the tile changes, the actions
+    # for the Tk thread and the position of the focus cell
+    __slots__ = ("frame", "tile_changes", "deferred_actions", "focus_xy", "update_time", "cells_scanned", "cells_updated", "sounds")
+
+    def __init__(self, frame: int, tile_changes: Sequence[Tuple[int, int, objects.GameObject]],
+                 deferred_actions: Sequence[Callable[[], None]], focus_xy: Optional[Tuple[int, int]]) -> None:
+        self.frame = frame
+        self.tile_changes = tuple(tile_changes)
+        self.deferred_actions = tuple(deferred_actions)
+        self.focus_xy = focus_xy
+        # telemetry of the update
+        self.update_time = 0.0
+        self.cells_scanned = self.cells_updated = self.sounds = 0
+
+
+class LogicWorker:
+    # Runs GameState.update on its own thread at the update timestep while a cave is being played, so that
+    # a heavy logic frame doesn't hold up the repaints. The tile changes of each update are collected in a
+    # back buffer and published as a FrameSnapshot, the Tk thread takes the published snapshots and draws them.
+    # The Tk thread holds the gamestate lock whenever it touches the game state itself (input, popups,
+    # level changes), so input is handed over in between updates. The worker never calls into tkinter.
+    def __init__(self, gamestate: GameState) -> None:
+        self.gamestate = gamestate
+        self.pacer = FramePacer(1 / gamestate.update_timestep)
+        self.snapshots = []         # type: List[FrameSnapshot]
+        self.snapshots_lock = threading.Lock()
+        self.actions_pending = False    # the worker waits until the Tk thread did the deferred actions
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="game logic", daemon=True)
+
+    def start(self) -> None:
+        self.pacer.reset()
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+    def active(self) -> bool:
+        # is the worker doing the game updates? Otherwise (title screen, reveal, popups) the Tk thread does them.
+        game = self.gamestate.game
+        return self.gamestate.game_status in (GameStatus.PLAYING, GameStatus.DEMO) and \
+            not self.actions_pending and game.popup_frame < game.graphics_frame
+
+    def run(self) -> None:
+        gamestate = self.gamestate
+        while not self.stopped.is_set():
+            self.pacer.period = gamestate.update_timestep
+            delay = self.pacer.deadline - time.perf_counter()
+            if delay > 0:
+                self.stopped.wait(delay)
+            if not self.pacer.due(time.perf_counter()):
+                continue
+            with gamestate.lock:
+                if not self.active():
+                    continue
+                gamestate.tile_changes = []
+                gamestate.deferred_actions = []
+                start = time.perf_counter()
+                try:
+                    gamestate.update(gamestate.game.graphics_frame)
+                except Exception:
+                    traceback.print_exc()
+                focus_cell = gamestate.rockford_cell or gamestate.inbox_cell or gamestate.last_focus_cell
+                snapshot = FrameSnapshot(gamestate.frame, gamestate.tile_changes, gamestate.deferred_actions,
+                                         (focus_cell.x, focus_cell.y) if focus_cell else None)
+                snapshot.update_time = time.perf_counter() - start
+                snapshot.cells_scanned = gamestate.cells_scanned
+                snapshot.cells_updated = gamestate.cells_updated
+                snapshot.sounds = gamestate.sounds.frame_sounds
+                gamestate.tile_changes = gamestate.deferred_actions = None
+                self.actions_pending = bool(snapshot.deferred_actions)
+                with self.snapshots_lock:
+                    self.snapshots.append(snapshot)
+
+    def take_snapshots(self) -> List[FrameSnapshot]:
+        # the snapshots published since the previous call, oldest first
+        with self.snapshots_lock:
+            snapshots, self.snapshots = self.snapshots, []
+        return snapshots
+
+    def discard_snapshots(self) -> None:
+        with self.snapshots_lock:
+            self.snapshots = []
+            self.actions_pending = False
@@ -9,8 +9,13 @@ License: GNU GPL 3.0, see LICENSE
 """
 
 import os
+import math
+import time
+import collections
 import tkinter
-from .caves import C64Cave
+import functools
+from typing import List, Tuple, Optional
+from .caves import C64Cave, cave_histogram
 from . import objects
 
 class KeyHelper():
@@ -71,85 +76,71 @@ class KeyHelper():
 
 
 class CaveStatsHelper():
+    slime_permeability_patterns = [0b00000000, 0b00010000, 0b00011000,
+                                   0b00111000, 0b00111100, 0b01111100,
+                                   0b01111110, 0b11111110, 0b11111111]
+
     def get_c64_permeability(x, y, cave, permeability, return_all = False):
         if not 0 <= permeability <= 8:
             return True
-        
-        seeds = [0x00, 0x1E]
-        slime_permeability_patterns = [0b00000000, 0b00010000, 0b00011000, 
-                                       0b00111000, 0b00111100, 0b01111100,
-                                       0b01111110, 0b11111110, 0b11111111]
-
-        num_passes = 949        # 949 passes total
         detected_slimes = []
         for scan_y in range(cave.height):
             for scan_x in range(cave.width):
                 if cave.map[scan_y * cave.width + scan_x][0].id == objects.SLIME.id:
                     detected_slimes.append( (scan_x, scan_y) )
-        
-        detected_permeability = {}
-        permeability_pattern = slime_permeability_patterns[permeability]
-        for p in range(num_passes):
-            for slime in detected_slimes:
-                # generate a new random number for the slime
-                C64Cave.bdrandom(seeds)
-                rand_value = seeds[0]
-                # test permeability and output if permeable
-                if (slime in detected_permeability.keys()):
-                    detected_permeability[slime] |= (rand_value & permeability_pattern) == 0
-                else:
-                    detected_permeability[slime] = (rand_value & permeability_pattern) == 0
-        
+        slime_permeable = CaveStatsHelper.c64_slime_permeability(len(detected_slimes), permeability)
+        detected_permeability = dict(zip(detected_slimes, slime_permeable))
         if (return_all):
             return detected_permeability
         return detected_permeability[ (x, y) ]
-    
+
+    @functools.lru_cache(maxsize=64)
+    def c64_slime_permeability(num_slimes: int, permeability: int) -> Tuple[bool, ...]:
+        # Whether each slime (in cave scan order) lets things through at least once during 949 passes of the cave scan.
+        # Every slime draws a new number from the C-64 random generator (seeds 0x00, 0x1E) on each pass, so slime i
+        # gets the numbers at steps p * num_slimes + i + 1. After a short run-in the generator repeats a 949 step cycle,
+        # which is exactly the number of passes. So apart from the first few steps, slime i sees all cycle positions
+        # congruent to its own (i + 1 - runin) modulo gcd(num_slimes, 949), and those are checked just once per class.
+        # The result only depends on the number of slimes and the permeability, so it is cached on those.
+        num_passes = 949        # 949 passes total
+        seeds = [0x00, 0x1E]
+        permeability_pattern = CaveStatsHelper.slime_permeability_patterns[permeability]
+        runin, cycle_length = C64Cave.bdrandom_period(seeds)
+        assert cycle_length == num_passes
+        passes_ok = []      # type: List[bool]
+        for _ in range(runin + cycle_length):
+            C64Cave.bdrandom(seeds)
+            passes_ok.append((seeds[0] & permeability_pattern) == 0)
+        # passes_ok[k - 1] is for the number at step k; steps from runin on are on the cycle
+        cycle_ok = passes_ok[runin - 1:runin - 1 + cycle_length] if runin > 0 else passes_ok[cycle_length - 1:] + passes_ok[:cycle_length - 1]
+        classes = math.gcd(num_slimes, cycle_length) if num_slimes else 1
+        class_ok = [any(cycle_ok[c::classes]) for c in range(classes)]
+        result = []     # type: List[bool]
+        for i in range(num_slimes):
+            if i + 1 >= runin:
+                result.append(class_ok[(i + 1 - runin) % classes])
+            else:
+                # the first passes of this slime still draw numbers from the run-in, evaluate them one by one
+                result.append(any(passes_ok[k - 1] if k < runin + cycle_length else cycle_ok[(k - runin) % cycle_length]
+                                  for k in range(i + 1, num_passes * num_slimes + 1, num_slimes)))
+        return tuple(result)
+
     def show_cave_stats(cave, c64_permeability, float_permeability):
-        detected_diamonds = 0
-        detected_slimes = 0
-        detected_amoeba = 0
-        detected_fireflies = 0
-        detected_butterflies = 0
-        detected_boulders = 0
-        detected_lightboulders = 0
-        detected_heavyboulders = 0
-        impermeable_slimes = 0
-        
-        permeability_data = CaveStatsHelper.get_c64_permeability(-1, -1, cave, c64_permeability, True)
+        histogram = cave_histogram(cave)
+        detected_slimes = histogram.count(objects.SLIME)
+        if 0 <= c64_permeability <= 8:
+            permeability_data = CaveStatsHelper.get_c64_permeability(-1, -1, cave, c64_permeability, True)
+            impermeable_slimes = sum(1 for permeable in permeability_data.values() if not permeable)
+        else:
+            impermeable_slimes = 0 if float_permeability > 0 else detected_slimes
 
-        for scan_y in range(cave.height):
-            for scan_x in range(cave.width):
-                object = cave.map[scan_y * cave.width + scan_x][0]
-                if object.id == objects.SLIME.id:
-                    detected_slimes += 1
-                    if 0 <= c64_permeability <= 8:
-                        permeability_check = permeability_data[(scan_x, scan_y)]
-                    else:
-                        permeability_check = float_permeability > 0
-                    if not permeability_check:
-                        impermeable_slimes += 1
-                elif object.id == objects.DIAMOND.id:
-                    detected_diamonds += 1
-                elif object.id == objects.AMOEBA.id:
-                    detected_amoeba += 1
-                elif object.id == objects.FIREFLY.id or object.id == objects.ALTFIREFLY.id:
-                    detected_fireflies += 1
-                elif object.id == objects.BUTTERFLY.id or object.id == objects.ALTBUTTERFLY.id:
-                    detected_butterflies += 1
-                elif object.id == objects.BOULDER.id:
-                    detected_boulders += 1
-                elif object.id == objects.MEGABOULDER.id:
-                    detected_heavyboulders += 1
-                elif object.id == objects.LIGHTBOULDER.id:
-                    detected_lightboulders += 1
-
-        cave_stats = f"Diamonds: {detected_diamonds}\n"
-        cave_stats += f"Boulders: {detected_boulders}\n"
-        cave_stats += f"Heavy Boulders: {detected_heavyboulders}\n"
-        cave_stats += f"Light Boulders: {detected_lightboulders}\n"
-        cave_stats += f"Fireflies: {detected_fireflies}\n"
-        cave_stats += f"Butterflies: {detected_fireflies}\n"
-        cave_stats += f"Amoeba: {detected_amoeba}\n"
+        cave_stats = f"Diamonds: {histogram.count(objects.DIAMOND)}\n"
+        cave_stats += f"Boulders: {histogram.count(objects.BOULDER)}\n"
+        cave_stats += f"Heavy Boulders: {histogram.count(objects.MEGABOULDER)}\n"
+        cave_stats += f"Light Boulders: {histogram.count(objects.LIGHTBOULDER)}\n"
+        cave_stats += f"Fireflies: {histogram.count(objects.FIREFLY, objects.ALTFIREFLY)}\n"
+        cave_stats += f"Butterflies: {histogram.count(objects.BUTTERFLY, objects.ALTBUTTERFLY)}\n"
+        cave_stats += f"Amoeba: {histogram.count(objects.AMOEBA)}\n"
         cave_stats += f"Total slime: {detected_slimes}\n"
         cave_stats += f"Impermeable slime: {impermeable_slimes}"
         tkinter.messagebox.showinfo("Cave statistics", cave_stats)
@@ -170,4 +161,78 @@ class TextHelper:
         if len(string_L) > width or len(string_R) > width:
             string_L = string[0:midpoint]
             string_R = string[midpoint:]            
-        return f"{string_L}\n{string_R}"
\ No newline at end of file
+        return f"{string_L}\n{string_R}"
+
+
+class FramePacer:
+    # Fixed timestep frames paced against absolute deadlines on a monotonic clock, so that rounding
+    # of the timer delay and scheduling jitter don't add up. After a stall, at most max_catchup frames
+    # are run at once; the rest of the backlog is dropped (and counted) instead of run in a burst.
+    def __init__(self, fps: float, max_catchup: int=1, slack: float=0.002) -> None:
+        self.period = 1 / fps
+        self.max_catchup = max_catchup
+        self.slack = slack      # a frame is due when its deadline is at most this close, timers may fire a bit early
+        self.deadline = 0.0
+        self.frames = 0
+        self.dropped = 0
+        self.skipped = 0        # the number of frames dropped by the last due() call
+
+    def reset(self, now: float=None) -> None:
+        self.deadline = time.perf_counter() if now is None else now
+
+    def due(self, now: float) -> int:
+        # the number of frames to run now, 0 if the next deadline hasn't been reached yet
+        self.skipped = 0
+        if now + self.slack < self.deadline:
+            return 0
+        elapsed = int((now + self.slack - self.deadline) / self.period) + 1
+        self.deadline += elapsed * self.period
+        frames = min(elapsed, self.max_catchup)
+        self.skipped = elapsed - frames
+        self.frames += frames
+        self.dropped += self.skipped
+        return frames
+
+    def alpha(self, now: float) -> float:
+        # how far we are from the last deadline to the next one, 0..1
+        return min(1.0, max(0.0, 1.0 - (self.deadline - now) / self.period))
+
+    def delay_ms(self, now: float) -> int:
+        # the timer delay until the next deadline
+        return max(1, int((self.deadline - now) * 1000))
+
+
+class OptimizationController:
+    # Automatic optimization level: steps the level (0 to 3) up when the rolling average frame time
+    # comes close to the frame budget, and back down when there is plenty of time left. The gap between
+    # the two thresholds and the minimum time between changes keep it from flipping back and forth.
+    max_level = 3
+
+    def __init__(self, fps: float, level: int=0, window: int=60, raise_above: float=0.8,
+                 lower_below: float=0.4, hold_time: float=3.0) -> None:
+        self.budget = 1 / fps
+        self.level = level
+        self.frametimes = collections.deque(maxlen=window)    # type: collections.deque
+        self.raise_above = raise_above
+        self.lower_below = lower_below
+        self.hold_time = hold_time
+        self.last_change = time.perf_counter()
+
+    def add_frame(self, frametime: float, now: float) -> Optional[int]:
+        # frametime is the time spent on the frame (game updates and repaint). Returns the new level if it changed.
+        self.frametimes.append(frametime)
+        if len(self.frametimes) < self.frametimes.maxlen or now - self.last_change < self.hold_time:
+            return None
+        average = sum(self.frametimes) / len(self.frametimes)
+        if average > self.budget * self.raise_above and self.level < self.max_level:
+            level = self.level + 1
+        elif average < self.budget * self.lower_below and self.level > 0:
+            level = self.level - 1
+        else:
+            return None
+        print("Optimization level {:d} -> {:d}: frame time {:.1f} ms of {:.1f} ms."
+              .format(self.level, level, average * 1000, self.budget * 1000))
+        self.level = level
+        self.last_change = now
+        self.frametimes.clear()
+        return level
@@ -0,0 +1,145 @@
+"""
+Boulder Caves+ - a Boulder Dash (tm) clone.
+Krissz Engine-compatible remake based on Boulder Caves 5.7.2.
+
+Statistical (sampling) profiler for the game and the editor.
+A background thread takes the stack of the Tk thread every few milliseconds. Unlike cProfile this
+doesn't slow down every function call, so the per-cell handlers of the cave scan keep their real cost.
+At exit it writes the samples as collapsed stacks (one "frame;frame;frame count" line per distinct
+stack, for flamegraph.pl, speedscope or inferno) and a summary per subsystem.
+
+Extended version by Michael Kamensky
+
+License: GNU GPL 3.0, see LICENSE
+"""
+
+import sys
+import time
+import threading
+import collections
+from typing import Dict, List, Tuple, Callable, Optional
+
+
+# the subsystem that a sample is attributed to, by the innermost bouldercaves module on the stack
+# (the profiler's own run_profiled() frame at the bottom of the stack doesn't count)
+SUBSYSTEMS = {
+    "bouldercaves.gamelogic": "gamelogic",
+    "bouldercaves.objects": "gamelogic",
+    "bouldercaves.tiles": "tiles",
+    "bouldercaves.game": "game render",
+    "bouldercaves.audio": "audio",
+    "bouldercaves.synthsamples": "audio",
+    "bouldercaves.caves": "caves",
+    "bouldercaves.bdcff": "bdcff",
+    "bouldercaves.editor": "editor"
+}
+IDLE = "idle (tkinter mainloop)"
+
+Stack = Tuple[Tuple[str, str], ...]     # (module, function) pairs, outermost first
+
+
+class SamplingProfiler:
+    def __init__(self, interval: float=0.005, max_depth: int=64) -> None:
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = collections.Counter()     # type: collections.Counter
+        self.thread_ident = 0
+        self.stopped = threading.Event()
+        self.sampler = None     # type: Optional[threading.Thread]
+        self.duration = 0.0
+
+    def start(self) -> None:
+        # profiles the thread that calls this
+        self.thread_ident = threading.get_ident()
+        self.stopped.clear()
+        self.duration = time.perf_counter()
+        self.sampler = threading.Thread(target=self.run, name="profiler", daemon=True)
+        self.sampler.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.sampler:
+            self.sampler.join()
+            self.sampler = None
+        self.duration = time.perf_counter() - self.duration
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_ident)
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                stack.append((self.module_name(frame.f_globals), frame.f_code.co_name))
+                frame = frame.f_back
+            if stack:
+                stack.reverse()
+                self.samples[tuple(stack)] += 1
+
+    @staticmethod
+    def module_name(f_globals: Dict) -> str:
+        # a module run with python -m (such as the editor) is called __main__, its spec has the real name
+        name = f_globals.get("__name__", "?")
+        if name == "__main__" and f_globals.get("__spec__"):
+            return f_globals["__spec__"].name
+        return name
+
+    def collapsed_stacks(self) -> List[str]:
+        return ["{} {:d}".format(";".join(module + ":" + function for module, function in stack), count)
+                for stack, count in self.samples.most_common()]
+
+    @staticmethod
+    def subsystem(stack: Stack) -> str:
+        for module, function in reversed(stack):
+            if module.startswith("bouldercaves.") and module != __name__:
+                return SUBSYSTEMS.get(module, module[13:])
+        return IDLE
+
+    def summary(self) -> Dict[str, int]:
+        # the number of samples per subsystem, attributed to the innermost bouldercaves code on the stack
+        totals = collections.Counter()     # type: collections.Counter
+        for stack, count in self.samples.items():
+            if stack[-1] == ("tkinter", "mainloop"):
+                totals[IDLE] += count
+            else:
+                totals[self.subsystem(stack)] += count
+        return dict(totals.most_common())
+
+    def top_functions(self, num: int=15) -> List[Tuple[str, int]]:
+        # the bouldercaves functions with the most samples of their own (not counting the functions they call)
+        totals = collections.Counter()     # type: collections.Counter
+        for stack, count in self.samples.items():
+            for module, function in reversed(stack):
+                if module.startswith("bouldercaves.") and module != __name__:
+                    totals[module + ":" + function] += count
+                    break
+        return totals.most_common(num)
+
+    def summary_text(self) -> str:
+        total = sum(self.samples.values()) or 1
+        lines = ["Profile: {:d} samples in {:.1f} seconds, every {:.1f} ms."
+                 .format(sum(self.samples.values()), self.duration, self.interval * 1000), "", "Per subsystem:"]
+        for subsystem, count in self.summary().items():
+            lines.append("  {:24s} {:7d}  {:5.1f}%".format(subsystem, count, count * 100 / total))
+        lines.extend(["", "Top functions (own samples):"])
+        for function, count in self.top_functions():
+            lines.append("  {:48s} {:7d}  {:5.1f}%".format(function, count, count * 100 / total))
+        return "\n".join(lines)
+
+    def write(self, filename: str) -> None:
+        # the collapsed stacks go into filename, the summary into filename.summary.txt
+        with open(filename, "w") as out:
+            out.write("\n".join(self.collapsed_stacks()) + "\n")
+        with open(filename + ".summary.txt", "w") as out:
+            out.write(self.summary_text() + "\n")
+
+
+def run_profiled(mainloop: Callable[[], None], filename: str, interval: float=0.005) -> None:
+    # runs the (tkinter) main loop while sampling it, and writes the profile when it ends
+    profiler = SamplingProfiler(interval)
+    profiler.start()
+    try:
+        mainloop()
+    finally:
+        profiler.stop()
+        profiler.write(filename)
+        print(profiler.summary_text())
+        print("Collapsed stacks written to", filename)
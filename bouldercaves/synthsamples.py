@@ -10,10 +10,11 @@ Extended version by Michael Kamensky
 License: GNU GPL 3.0, see LICENSE
 """
 
+import sys
 import time
 import random
 import itertools
-from typing import Callable, Generator
+from typing import Callable, Generator, Union
 from synthplayer import params as synth_params
 from synthplayer.sample import Sample
 from synthplayer.oscillators import *
@@ -28,8 +29,60 @@ class NoteFinished(Exception):
 
 
 def sample_from_osc(osc: Oscillator) -> Sample:
-    s = Sample.from_oscillator(osc, 5)     # 5 seconds is the maximum it will be.
-    return s.stereo()
+    return Sample.from_oscillator(osc, 5)     # 5 seconds is the maximum it will be. Mono.
+
+
+class SynthesizedSample(Sample):
+    # A pre-synthesized sound effect. These are kept in mono, the sound engine expands them to stereo while mixing.
+    def __init__(self, name: str) -> None:
+        super().__init__(name=name, nchannels=1)
+
+
+class FrameRingBuffer:
+    """
+    Preallocated, reusable buffer that turns a stream of rendered frame data into fixed size chunks.
+    The chunks are memoryview slices into the buffer itself, so nothing is copied or reallocated per chunk.
+    A chunk is only valid until the next write() into the buffer; the realtime mixer consumes
+    every chunk before it asks the sample generator for the next one, so that is fine there.
+    """
+    def __init__(self, chunksize: int, capacity: int = 0) -> None:
+        self.chunksize = chunksize
+        self._buffer = bytearray(max(capacity, chunksize * 4))
+        self._view = memoryview(self._buffer)
+        self._start = self._end = 0
+
+    def __len__(self) -> int:
+        return self._end - self._start
+
+    def write(self, data: Union[bytes, bytearray, memoryview]) -> None:
+        size = len(data)
+        if self._end + size > len(self._buffer):
+            pending = self._view[self._start:self._end].tobytes()    # never more than a chunk's worth
+            if len(pending) + size > len(self._buffer):
+                # a block larger than anything seen before: grow once, the buffer is reused afterwards.
+                # (outstanding chunk views keep the old buffer alive, so we can't resize it in place)
+                self._buffer = bytearray(max(len(self._buffer) * 2, len(pending) + size))
+                self._view = memoryview(self._buffer)
+            self._buffer[:len(pending)] = pending
+            self._start, self._end = 0, len(pending)
+        self._buffer[self._end:self._end + size] = data
+        self._end += size
+
+    def chunks(self) -> Generator[memoryview, None, None]:
+        # yields all complete chunks that are currently available
+        chunksize = self.chunksize
+        while self._end - self._start >= chunksize:
+            start = self._start
+            self._start += chunksize
+            yield self._view[start:start + chunksize]
+        if self._start == self._end:
+            self._start = self._end = 0
+
+    def remainder(self) -> memoryview:
+        # returns the last partial chunk (if any) and empties the buffer
+        rest = self._view[self._start:self._end]
+        self._start = self._end = 0
+        return rest
 
 
 class TitleMusic(Sample):
@@ -77,8 +130,7 @@ class TitleMusic(Sample):
         notes = itertools.cycle(self.title_music) if repeat else iter(self.title_music)
         attack, decay, sustain, release = self.adsr_times
 
-        num_frames = chunksize // synth_params.norm_samplewidth // synth_params.norm_nchannels
-        sample_residue = Sample(None, nchannels=2)
+        ringbuffer = FrameRingBuffer(chunksize)
         for v1, v2 in notes:
             if stopcondition():
                 break
@@ -90,14 +142,10 @@ class TitleMusic(Sample):
             f2 = EnvelopeFilter(osc2, attack, decay, sustain, 1.0, release, stop_at_end=True)
             sample1 = Sample.from_oscillator(f1, 1, synth_params.norm_samplerate)       # length is max. 1 second
             sample2 = Sample.from_oscillator(f2, 1, synth_params.norm_samplerate)       # length is max. 1 second
-            sample_residue.join(sample1.stereo_mix(sample2, "R"))
-            while len(sample_residue) >= num_frames:
-                # TODO optimize this a bit by not using Samples but instead by looping over a memoryview of the frames (just like the super class does)
-                yield sample_residue.view_frame_data()[:chunksize]
-                sample_residue = Sample.from_raw_frames(sample_residue.view_frame_data()[chunksize:],
-                                                        sample_residue.samplewidth, sample_residue.samplerate, sample_residue.nchannels)
-        if len(sample_residue):
-            yield sample_residue.view_frame_data()
+            ringbuffer.write(sample1.stereo_mix(sample2, "R").view_frame_data())
+            yield from ringbuffer.chunks()
+        if len(ringbuffer):
+            yield ringbuffer.remainder()
 
 
 class RealtimeSynthesizedSample(Sample):
@@ -108,10 +156,11 @@ class RealtimeSynthesizedSample(Sample):
                            stopcondition: Callable[[], bool]=lambda: False) -> Generator[memoryview, None, None]:
         raise NotImplementedError("subclass should implement this")
 
-    def render_samples(self, osc: Oscillator, sample_residue: Sample,
-                       sample_chunksize: int, stopcondition: Callable[[], bool] = lambda: False,
-                       return_residue: bool = False) -> Generator[memoryview, None, Sample]:
-        num_frames = sample_chunksize // synth_params.norm_samplewidth // synth_params.norm_nchannels
+    def render_samples(self, osc: Oscillator, ringbuffer: FrameRingBuffer,
+                       stopcondition: Callable[[], bool] = lambda: False,
+                       keep_residue: bool = False) -> Generator[memoryview, None, None]:
+        # renders the oscillator into the (reused) ring buffer of the stream and yields the complete chunks.
+        # the leftover partial chunk stays in the buffer if keep_residue is set, so the next sound can continue it.
         blocks = osc.blocks()
         while not stopcondition():
             try:
@@ -119,15 +168,10 @@ class RealtimeSynthesizedSample(Sample):
             except StopIteration:
                 break
             sample = Sample.from_osc_block(block, osc.samplerate, 2 ** (8 * synth_params.norm_samplewidth - 1)).stereo()
-            sample_residue.join(sample)
-            while len(sample_residue) >= num_frames:
-                yield sample_residue.view_frame_data()[:sample_chunksize]
-                sample_residue = Sample.from_raw_frames(sample_residue.view_frame_data()[sample_chunksize:],
-                                                        sample_residue.samplewidth, sample_residue.samplerate, sample_residue.nchannels)
-        if return_residue:
-            return sample_residue
-        yield sample_residue.view_frame_data()
-        return sample_residue
+            ringbuffer.write(sample.view_frame_data())
+            yield from ringbuffer.chunks()
+        if not keep_residue:
+            yield ringbuffer.remainder()
 
 
 class Amoeba(RealtimeSynthesizedSample):
@@ -137,12 +181,12 @@ class Amoeba(RealtimeSynthesizedSample):
     def chunked_frame_data(self, chunksize: int, repeat: bool=False,
                            stopcondition: Callable[[], bool]=lambda: False) -> Generator[memoryview, None, None]:
         assert repeat, "amoeba is a repeating sound"
-        sample_residue = Sample(nchannels=2)
+        ringbuffer = FrameRingBuffer(chunksize)
         while not stopcondition():
             freq = random.randint(0x0800, 0x1200)
             osc = FastTriangle(freq * _sidfreq, amplitude=0.75)
             filtered = EnvelopeFilter(osc, 0.024, 0.006, 0.0, 0.5, 0.003, stop_at_end=True)
-            sample_residue = yield from self.render_samples(filtered, sample_residue, chunksize, return_residue=True)
+            yield from self.render_samples(filtered, ringbuffer, keep_residue=True)
 
 
 class MagicWall(RealtimeSynthesizedSample):
@@ -152,14 +196,14 @@ class MagicWall(RealtimeSynthesizedSample):
     def chunked_frame_data(self, chunksize: int, repeat: bool=False,
                            stopcondition: Callable[[], bool]=lambda: False) -> Generator[memoryview, None, None]:
         assert repeat, "magic_wall is a repeating sound"
-        sample_residue = Sample(nchannels=2)
+        ringbuffer = FrameRingBuffer(chunksize)
         while not stopcondition():
             freq = random.randint(0x8600, 0x9f00)
             freq &= 0b0001100100000000
             freq |= 0b1000011000000000
             osc = FastTriangle(freq * _sidfreq, amplitude=0.4)
             filtered = EnvelopeFilter(osc, 0.002, 0.008, 0.0, 0.6, 0.03, stop_at_end=True)
-            sample_residue = yield from self.render_samples(filtered, sample_residue, chunksize, return_residue=True)
+            yield from self.render_samples(filtered, ringbuffer, keep_residue=True)
 
 
 class Cover(RealtimeSynthesizedSample):
@@ -169,12 +213,12 @@ class Cover(RealtimeSynthesizedSample):
     def chunked_frame_data(self, chunksize: int, repeat: bool=False,
                            stopcondition: Callable[[], bool]=lambda: False) -> Generator[memoryview, None, None]:
         assert repeat, "cover is a repeating sound"
-        sample_residue = Sample(nchannels=2)
+        ringbuffer = FrameRingBuffer(chunksize)
         while not stopcondition():
             freq = random.randint(0x6000, 0xd800)
             osc = FastTriangle(freq * _sidfreq, amplitude=0.7)
             filtered = EnvelopeFilter(osc, 0.002, 0.02, 0.0, 0.5, 0.02, stop_at_end=True)
-            sample_residue = yield from self.render_samples(filtered, sample_residue, chunksize, return_residue=True)
+            yield from self.render_samples(filtered, ringbuffer, keep_residue=True)
 
 
 class Finished(RealtimeSynthesizedSample):
@@ -184,19 +228,19 @@ class Finished(RealtimeSynthesizedSample):
     def chunked_frame_data(self, chunksize: int, repeat: bool=False,
                            stopcondition: Callable[[], bool]=lambda: False) -> Generator[memoryview, None, None]:
         assert not repeat
-        sample_residue = Sample(nchannels=2)
+        ringbuffer = FrameRingBuffer(chunksize)
         for n in range(0, 180):
             if stopcondition():
                 break
             freq = 0x8000 - n * 180
             osc = FastTriangle(freq * _sidfreq, amplitude=0.8)
             filtered = EnvelopeFilter(osc, 0.002, 0.004, 0.0, 0.6, 0.02, stop_at_end=True)
-            sample_residue = yield from self.render_samples(filtered, sample_residue, chunksize, return_residue=True)
-        if len(sample_residue) > 0:
-            yield sample_residue.view_frame_data()
+            yield from self.render_samples(filtered, ringbuffer, keep_residue=True)
+        if len(ringbuffer) > 0:
+            yield ringbuffer.remainder()
 
 
-class ExtraLife(Sample):
+class ExtraLife(SynthesizedSample):
     def __init__(self) -> None:
         super().__init__(name="extra_life")
         for n in range(0, 16):
@@ -218,11 +262,10 @@ class GameOver(RealtimeSynthesizedSample):
         filtered = EnvelopeFilter(osc, 0.1, 0.3, 1.5, 1.0, 0.07, stop_at_end=True)
         ampmod = SquareH(10, 9, amplitude=0.5, bias=0.5)
         modulated = AmpModulationFilter(filtered, ampmod)
-        sample_residue = Sample(nchannels=2)
-        yield from self.render_samples(modulated, sample_residue, chunksize, stopcondition=stopcondition)
+        yield from self.render_samples(modulated, FrameRingBuffer(chunksize), stopcondition=stopcondition)
 
 
-class WalkDirt(Sample):
+class WalkDirt(SynthesizedSample):
     def __init__(self) -> None:
         super().__init__(name="walk_dirt")
         osc = WhiteNoise(0x5000, amplitude=0.3)
@@ -230,7 +273,7 @@ class WalkDirt(Sample):
         self.join(sample_from_osc(filtered))
 
 
-class WalkEmpty(Sample):
+class WalkEmpty(SynthesizedSample):
     def __init__(self) -> None:
         super().__init__(name="walk_empty")
         osc = WhiteNoise(0x1200, amplitude=0.2)
@@ -238,7 +281,7 @@ class WalkEmpty(Sample):
         self.join(sample_from_osc(filtered))
 
 
-class Explosion(Sample):
+class Explosion(SynthesizedSample):
     def __init__(self) -> None:
         super().__init__(name="explosion")
         osc = WhiteNoise(0x1432, amplitude=0.8)
@@ -246,7 +289,7 @@ class Explosion(Sample):
         self.join(sample_from_osc(filtered))
 
 
-class VoodooExplosion(Sample):
+class VoodooExplosion(SynthesizedSample):
     def __init__(self) -> None:
         super().__init__(name="voodoo_explosion")
         osc5 = WhiteNoise(1200, amplitude=0.4)
@@ -258,7 +301,7 @@ class VoodooExplosion(Sample):
         self.join(sample_from_osc(filtered))
 
 
-class CollectDiamond(Sample):
+class CollectDiamond(SynthesizedSample):
     def __init__(self) -> None:
         super().__init__(name="collect_diamond")
         osc = FastTriangle(0x1478 * _sidfreq, amplitude=0.8)
@@ -266,7 +309,7 @@ class CollectDiamond(Sample):
         self.join(sample_from_osc(filtered))
 
 
-class Boulder(Sample):
+class Boulder(SynthesizedSample):
     def __init__(self) -> None:
         super().__init__(name="boulder")
         osc = WhiteNoise(0x0932, amplitude=0.8)
@@ -274,7 +317,7 @@ class Boulder(Sample):
         self.join(sample_from_osc(filtered))
 
 
-class Crack(Sample):
+class Crack(SynthesizedSample):
     def __init__(self) -> None:
         super().__init__(name="crack")
         osc = WhiteNoise(0x2F32, amplitude=0.8)
@@ -282,7 +325,7 @@ class Crack(Sample):
         self.join(sample_from_osc(filtered))
 
 
-class BoxPush(Sample):
+class BoxPush(SynthesizedSample):
     def __init__(self) -> None:
         super().__init__(name="boxpush")
         osc = WhiteNoise(2637, amplitude=0.6)
@@ -302,11 +345,10 @@ class Diamond(RealtimeSynthesizedSample):
         freq |= 0b1000011000000000
         osc = FastTriangle(freq * _sidfreq, amplitude=0.7)
         filtered = EnvelopeFilter(osc, 0.002, 0.006, 0.0, 0.7, 0.6, stop_at_end=True)
-        sample_residue = Sample(nchannels=2)
-        yield from self.render_samples(filtered, sample_residue, chunksize, stopcondition=stopcondition)
+        yield from self.render_samples(filtered, FrameRingBuffer(chunksize), stopcondition=stopcondition)
 
 
-class Timeout(Sample):
+class Timeout(SynthesizedSample):
     def __init__(self, timeout: int) -> None:
         super().__init__(name="timeout_" + str(timeout))
         self._timeout = timeout
@@ -320,7 +362,7 @@ class Timeout(Sample):
         return cpy
 
 
-class Slime(Sample):
+class Slime(SynthesizedSample):
     def __init__(self) -> None:
         super().__init__(name="slime")
         fm = FastTriangle(5, 0.5)
@@ -335,71 +377,71 @@ def demo():
     # ----- slime
     print("Slime")
     sample = Slime()
-    api.play(sample)
+    api.play(audio.playable(sample))
     time.sleep(sample.duration + 0.1)
 
     # ------ explosion
     print("Explosion")
     sample = Explosion()
-    api.play(sample)
+    api.play(audio.playable(sample))
     time.sleep(sample.duration + 0.1)
 
     # ------ voodoo explosion
     print("Voodoo Explosion")
     sample = VoodooExplosion()
-    api.play(sample)
+    api.play(audio.playable(sample))
     time.sleep(sample.duration + 0.1)
 
     # ------ diamond
     print("Diamonds")
     for _ in range(10):
         sample = Diamond()
-        api.play(sample)
+        api.play(audio.playable(sample))
         time.sleep(0.3)
 
     # ---- collect diamond
     print("Collect diamond")
     sample = CollectDiamond()
-    api.play(sample)
+    api.play(audio.playable(sample))
     time.sleep(sample.duration + 0.1)
 
     # ------ boulder
     print("Boulder")
     sample = Boulder()
-    api.play(sample)
+    api.play(audio.playable(sample))
     time.sleep(sample.duration + 0.1)
 
     # ------ crack
     print("Crack")
     sample = Crack()
-    api.play(sample)
+    api.play(audio.playable(sample))
     time.sleep(sample.duration + 0.1)
 
     # ---- out of time
     print("Out of time")
     for n in range(1, 10):
         sample = Timeout(n)
-        api.play(sample)
+        api.play(audio.playable(sample))
         time.sleep(sample.duration + 0.02)
 
     # ---- (un)cover
     print("(Un)cover")
     sample = Cover()
-    api.play(sample, repeat=True)
+    api.play(audio.playable(sample), repeat=True)
     time.sleep(max(4, sample.duration + 0.5))
     api.silence()
 
     # ------ Amoeba
     print("Amoeba")
     sample = Amoeba()
-    api.play(sample, repeat=True)
+    api.play(audio.playable(sample), repeat=True)
     time.sleep(max(4, sample.duration + 0.5))
     api.silence()
 
     # ------- Magic wall
     print("Magic wall")
     sample = MagicWall()
-    api.play(sample, repeat=True)
+    api.play(audio.playable(sample), repeat=True)
     time.sleep(max(4, sample.duration + 0.5))
     api.silence()
 
@@ -407,47 +449,60 @@ def demo():
     print("Move (dirt)")
     sample = WalkDirt()
     for _ in range(10):
-        api.play(sample)
+        api.play(audio.playable(sample))
         time.sleep(sample.duration + 0.1)
     print("Move (space)")
     sample = WalkEmpty()
     for _ in range(10):
-        api.play(sample)
+        api.play(audio.playable(sample))
         time.sleep(sample.duration + 0.1)
 
     # ----- box push
     print("Box Push")
     sample = BoxPush()
-    api.play(sample)
+    api.play(audio.playable(sample))
     time.sleep(sample.duration)
 
     # ----- extra life
     print("Extra life")
     sample = ExtraLife()
-    api.play(sample)
+    api.play(audio.playable(sample))
     time.sleep(sample.duration + 0.5)
 
     # ----- game over
     print("Game over")
     sample = GameOver()
-    api.play(sample)
+    api.play(audio.playable(sample))
     time.sleep(max(3, sample.duration + 0.5))
 
     # ----- finished
     print("Finished")
     sample = Finished()
-    api.play(sample)
+    api.play(audio.playable(sample))
     time.sleep(max(5, sample.duration + 0.5))
 
     # ----- title music
     print("Title music")
     sample = TitleMusic()
-    api.play(sample, repeat=True)
+    api.play(audio.playable(sample), repeat=True)
     time.sleep(min(5, sample.duration + 0.1))
 
     print("CLOSING!")
     api.close()
 
 
+def benchmark(numchunks: int = 300) -> None:
+    # measures the raw chunk generation throughput of the realtime synthesized samples (no audio output)
+    chunksize = synth_params.norm_frames_per_chunk * synth_params.norm_samplewidth * synth_params.norm_nchannels
+    for sample, repeat in ((TitleMusic(), True), (Amoeba(), True), (MagicWall(), True), (Cover(), True), (Finished(), False)):
+        start = time.perf_counter()
+        count = sum(1 for _ in itertools.islice(sample.chunked_frame_data(chunksize, repeat=repeat), numchunks))
+        duration = time.perf_counter() - start
+        print("{:12s} {:4d} chunks  {:8.1f} chunks/sec".format(sample.name, count, count / duration))
+
+
 if __name__ == "__main__":
-    demo()
+    if "bench" in sys.argv[1:]:
+        benchmark()
+    else:
+        demo()
@@ -0,0 +1,115 @@
+"""
+Boulder Caves+ - a Boulder Dash (tm) clone.
+Krissz Engine-compatible remake based on Boulder Caves 5.7.2.
+
+Frame-time telemetry for the game loop.
+Every metric (the duration of a phase of the game loop, or a count such as the number of
+tiles pushed to tkinter) keeps its most recent samples in a fixed-size ring buffer.
+The summary has the mean and the 50th/95th/99th percentiles, and can be written as JSON or CSV.
+
+Extended version by Michael Kamensky
+
+License: GNU GPL 3.0, see LICENSE
+"""
+
+import csv
+import json
+import time
+import array
+from typing import Dict, List, Any
+from . import tracing
+
+
+# the durations (in seconds) and counts that the game loop records
+TIMINGS = ("logic", "animation", "tiles", "mirror", "reveal", "scorebar")
+COUNTS = ("cells_scanned", "cells_updated", "animated_cells", "tiles_pushed", "sounds")
+
+
+class RingBuffer:
+    def __init__(self, size: int) -> None:
+        self.values = array.array('d', [0.0] * size)
+        self.size = size
+        self.index = 0
+        self.count = 0      # total number of samples ever added
+
+    def add(self, value: float) -> None:
+        self.values[self.index] = value
+        self.index = (self.index + 1) % self.size
+        self.count += 1
+
+    def samples(self) -> List[float]:
+        # the samples that are still in the buffer, oldest first
+        if self.count < self.size:
+            return self.values[:self.count].tolist()
+        return self.values[self.index:].tolist() + self.values[:self.index].tolist()
+
+    def recent_mean(self, n: int) -> float:
+        # the average of the last n samples
+        n = min(n, self.count, self.size)
+        if not n:
+            return 0.0
+        if n <= self.index:
+            return sum(self.values[self.index - n:self.index]) / n
+        return (sum(self.values[:self.index]) + sum(self.values[self.size - (n - self.index):])) / n
+
+    def summary(self) -> Dict[str, float]:
+        values = sorted(self.samples())
+        if not values:
+            return {"count": 0, "mean": 0.0, "p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+
+        def percentile(p: float) -> float:
+            return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+        return {
+            "count": self.count,
+            "mean": sum(values) / len(values),
+            "p50": percentile(50),
+            "p95": percentile(95),
+            "p99": percentile(99),
+            "max": values[-1]
+        }
+
+
+class Telemetry:
+    def __init__(self, size: int=3600) -> None:
+        self.metrics = {name: RingBuffer(size) for name in TIMINGS + COUNTS}     # type: Dict[str, RingBuffer]
+        self.started = time.perf_counter()
+
+    def record(self, name: str, value: float) -> None:
+        self.metrics[name].add(value)
+
+    def lap(self, name: str, start: float) -> float:
+        # records the time since start as the duration of the named phase, and returns the current time
+        now = time.perf_counter()
+        self.metrics[name].add(now - start)
+        tracer = tracing.tracer     # read once, tracing can be stopped in another thread
+        if tracer:
+            tracer.complete(name, "phase", start, now)
+        return now
+
+    def recent_mean(self, name: str, n: int=30) -> float:
+        return self.metrics[name].recent_mean(n)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        return {name: ring.summary() for name, ring in self.metrics.items()}
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "duration": time.perf_counter() - self.started,
+            "units": {name: "s" if name in TIMINGS else "count" for name in self.metrics},
+            "summary": self.summary(),
+            "samples": {name: ring.samples() for name, ring in self.metrics.items()}
+        }
+
+    def write(self, filename: str) -> None:
+        # a .csv file gets one row with the summary per metric, anything else gets everything as JSON
+        if filename.lower().endswith(".csv"):
+            with open(filename, "w", newline="") as out:
+                writer = csv.writer(out)
+                writer.writerow(["metric", "unit", "count", "mean", "p50", "p95", "p99", "max"])
+                for name, summary in self.summary().items():
+                    writer.writerow([name, "s" if name in TIMINGS else "count", summary["count"], summary["mean"],
+                                     summary["p50"], summary["p95"], summary["p99"], summary["max"]])
+        else:
+            with open(filename, "w") as out:
+                json.dump(self.as_dict(), out, indent=1)
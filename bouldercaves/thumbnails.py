@@ -0,0 +1,120 @@
+"""
+Boulder Caves+ - a Boulder Dash (tm) clone.
+Krissz Engine-compatible remake based on Boulder Caves 5.7.2.
+
+Cave preview images (thumbnails) for the launcher.
+The cave map is rendered at 1/4 scale with the game's sprite sheet, and stored as PNG
+in a cache under the user data dir, keyed on the contents of the cave file.
+
+Extended version by Michael Kamensky
+
+License: GNU GPL 3.0, see LICENSE
+"""
+
+import os
+import hashlib
+import threading
+import concurrent.futures
+from typing import Dict, List, Tuple, Sequence, Callable, Optional
+from PIL import Image
+from . import tiles, caves, user_data_dir
+
+
+cache_dir = os.path.join(user_data_dir, "thumbnails")
+RENDER_VERSION = 1
+TILESETS = {
+    # name: (use cave colors, alternate c64 tiles, krissz c64 tiles)
+    "krissz": (True, False, True),
+    "c64": (True, False, False),
+    "c64alt": (True, True, False),
+    "boulderrush": (False, False, False)
+}
+
+
+class TileAtlas:
+    # The sprite sheet scaled down once, with every tile as rows of raw RGB bytes,
+    # so that a whole cave image can be assembled with a few byte joins instead of a paste per cell.
+    def __init__(self, palette: Optional[caves.Palette], tileset: str, tilesize: int) -> None:
+        _, alt_c64tileset, krissz_c64tileset = TILESETS[tileset]
+        with tiles.load_sprite_sheet(palette, alt_c64tileset, krissz_c64tileset) as sheet:
+            sheet = sheet.convert("RGB")
+        factor = 16 // tilesize
+        # a box filter with an integer factor averages each block of pixels, without bleeding across tiles
+        atlas = sheet.resize((sheet.width // factor, sheet.height // factor), Image.BOX)
+        self.tilesize = tilesize
+        self.tile_rows = []     # type: List[Tuple[bytes, ...]]
+        data = atlas.tobytes()
+        rowbytes = atlas.width * 3
+        for tile in range(tiles.num_sprites):
+            row, col = divmod(tile, 8)
+            offset = row * tilesize * rowbytes + col * tilesize * 3
+            self.tile_rows.append(tuple(data[offset + y * rowbytes: offset + y * rowbytes + tilesize * 3] for y in range(tilesize)))
+
+    def render(self, tilenumbers: Sequence[int], width: int, height: int) -> Image.Image:
+        tile_rows = self.tile_rows
+        lines = []
+        for y in range(height):
+            row = [tile_rows[t] for t in tilenumbers[y * width: y * width + width]]
+            for pixel_y in range(self.tilesize):
+                lines.append(b"".join(tile[pixel_y] for tile in row))
+        return Image.frombytes("RGB", (width * self.tilesize, height * self.tilesize), b"".join(lines))
+
+
+class ThumbnailRenderer:
+    def __init__(self, tileset: str="krissz", scale: float=0.25, max_workers: int=4) -> None:
+        self.tileset = tileset
+        self.tilesize = int(16 * scale)
+        if self.tilesize not in (1, 2, 4, 8, 16):
+            raise ValueError("scale must divide the 16 pixel tiles evenly")
+        self.atlases = {}     # type: Dict[str, TileAtlas]
+        self.atlases_lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="thumbnail")
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False)
+
+    def cache_filename(self, cavefile: str, levelnumber: int) -> str:
+        with open(cavefile, "rb") as f:
+            content_hash = hashlib.sha1(f.read())
+        content_hash.update("{} {} {} {}".format(RENDER_VERSION, self.tileset, self.tilesize, levelnumber).encode())
+        return os.path.join(cache_dir, content_hash.hexdigest() + ".png")
+
+    def atlas(self, palette: caves.Palette) -> TileAtlas:
+        use_colors = TILESETS[self.tileset][0]
+        key = str(palette) if use_colors else ""
+        with self.atlases_lock:
+            atlas = self.atlases.get(key)
+        if atlas is None:
+            atlas = TileAtlas(palette if use_colors else None, self.tileset, self.tilesize)
+            with self.atlases_lock:
+                self.atlases[key] = atlas
+        return atlas
+
+    def render(self, cavefile: str, levelnumber: int=1) -> str:
+        # returns the filename of the thumbnail PNG, rendering it first if it isn't in the cache yet
+        filename = self.cache_filename(cavefile, levelnumber)
+        if os.path.exists(filename):
+            return filename
+        cave = caves.CaveSet(cavefile).cave(levelnumber)
+        image = self.atlas(cave.colors).render([obj.tile() for obj, _ in cave.map], cave.width, cave.height)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmpname = "{}.{}.tmp".format(filename, threading.get_ident())
+        image.save(tmpname, "png")
+        os.replace(tmpname, filename)
+        return filename
+
+    def submit(self, cavefile: str, levelnumber: int=1, on_done: Callable[[str, Optional[str]], None]=None) -> concurrent.futures.Future:
+        # renders in the thread pool. on_done(cavefile, thumbnailfile or None) is called from the worker thread.
+        def render() -> Optional[str]:
+            try:
+                thumbnail = self.render(cavefile, levelnumber)    # type: Optional[str]
+            except Exception as x:
+                print("Can't render cave thumbnail for {}: {}".format(cavefile, x))
+                thumbnail = None
+            if on_done:
+                on_done(cavefile, thumbnail)
+            return thumbnail
+        return self.executor.submit(render)
+
+    def render_all(self, cavefiles: Sequence[str]) -> List[Optional[str]]:
+        return [future.result() for future in [self.submit(cavefile) for cavefile in cavefiles]]
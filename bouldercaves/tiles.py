@@ -129,36 +129,42 @@ def colorize_digits(text: str):
     return colored
     
 
-def load_sprites(c64colorpalette: Palette=None, scale: float=1.0, alt_c64tileset=False, krissz_c64tileset=False) -> Sequence[bytes]:
+def load_sprite_sheet(c64colorpalette: Palette=None, alt_c64tileset=False, krissz_c64tileset=False) -> Image.Image:
+    # the full sprite sheet image, colored with the given palette for the C-64 tile sets
     if c64colorpalette:
         tiles_filename = "c64_gfx_alt.png" if alt_c64tileset else \
             "c64_gfx_krissz.png" if krissz_c64tileset else "c64_gfx.png"
     else:
         tiles_filename = "boulder_rush.png"
-    sprite_src_images = []
     with Image.open(io.BytesIO(pkgutil.get_data(__name__, "gfx/" + tiles_filename) or b"")) as tile_image:
-        if c64colorpalette:
-            tile_image = tile_image.copy().convert('P', 0)
-            palettevalues = tile_image.getpalette()
-            assert 768 - palettevalues.count(0) <= 16, "must be an image with <= 16 colors"
-            palette = [(r, g, b) for r, g, b in zip(palettevalues[0:16 * 3:3], palettevalues[1:16 * 3:3], palettevalues[2:16 * 3:3])]
-            pc1 = palette.index((255, 0, 0))        # red, foreground 1
-            pc2 = palette.index((255, 0, 255))      # purple, foreground 2
-            pc3 = palette.index((255, 255, 0))      # yellow, foreground 3 (highlight)
-            pc4 = palette.index((0, 255, 0))        # green, amoeba color
-            pc5 = palette.index((0, 0, 255))        # blue, slime color
-            pc_bg = palette.index((0, 0, 0))        # black, background color
-            assert c64colorpalette
-            palette[pc1] = (c64colorpalette.rgb_fg1 >> 16, (c64colorpalette.rgb_fg1 & 0xff00) >> 8, c64colorpalette.rgb_fg1 & 0xff)
-            palette[pc2] = (c64colorpalette.rgb_fg2 >> 16, (c64colorpalette.rgb_fg2 & 0xff00) >> 8, c64colorpalette.rgb_fg2 & 0xff)
-            palette[pc3] = (c64colorpalette.rgb_fg3 >> 16, (c64colorpalette.rgb_fg3 & 0xff00) >> 8, c64colorpalette.rgb_fg3 & 0xff)
-            palette[pc4] = (c64colorpalette.rgb_amoeba >> 16, (c64colorpalette.rgb_amoeba & 0xff00) >> 8, c64colorpalette.rgb_amoeba & 0xff)
-            palette[pc5] = (c64colorpalette.rgb_slime >> 16, (c64colorpalette.rgb_slime & 0xff00) >> 8, c64colorpalette.rgb_slime & 0xff)
-            palette[pc_bg] = (c64colorpalette.rgb_screen >> 16, (c64colorpalette.rgb_screen & 0xff00) >> 8, c64colorpalette.rgb_screen & 0xff)
-            palettevalues = []
-            for rgb in palette:
-                palettevalues.extend(rgb)
-            tile_image.putpalette(palettevalues)
+        if not c64colorpalette:
+            return tile_image.copy()
+        tile_image = tile_image.copy().convert('P', 0)
+        palettevalues = tile_image.getpalette()
+        assert 768 - palettevalues.count(0) <= 16, "must be an image with <= 16 colors"
+        palette = [(r, g, b) for r, g, b in zip(palettevalues[0:16 * 3:3], palettevalues[1:16 * 3:3], palettevalues[2:16 * 3:3])]
+        pc1 = palette.index((255, 0, 0))        # red, foreground 1
+        pc2 = palette.index((255, 0, 255))      # purple, foreground 2
+        pc3 = palette.index((255, 255, 0))      # yellow, foreground 3 (highlight)
+        pc4 = palette.index((0, 255, 0))        # green, amoeba color
+        pc5 = palette.index((0, 0, 255))        # blue, slime color
+        pc_bg = palette.index((0, 0, 0))        # black, background color
+        palette[pc1] = (c64colorpalette.rgb_fg1 >> 16, (c64colorpalette.rgb_fg1 & 0xff00) >> 8, c64colorpalette.rgb_fg1 & 0xff)
+        palette[pc2] = (c64colorpalette.rgb_fg2 >> 16, (c64colorpalette.rgb_fg2 & 0xff00) >> 8, c64colorpalette.rgb_fg2 & 0xff)
+        palette[pc3] = (c64colorpalette.rgb_fg3 >> 16, (c64colorpalette.rgb_fg3 & 0xff00) >> 8, c64colorpalette.rgb_fg3 & 0xff)
+        palette[pc4] = (c64colorpalette.rgb_amoeba >> 16, (c64colorpalette.rgb_amoeba & 0xff00) >> 8, c64colorpalette.rgb_amoeba & 0xff)
+        palette[pc5] = (c64colorpalette.rgb_slime >> 16, (c64colorpalette.rgb_slime & 0xff00) >> 8, c64colorpalette.rgb_slime & 0xff)
+        palette[pc_bg] = (c64colorpalette.rgb_screen >> 16, (c64colorpalette.rgb_screen & 0xff00) >> 8, c64colorpalette.rgb_screen & 0xff)
+        palettevalues = []
+        for rgb in palette:
+            palettevalues.extend(rgb)
+        tile_image.putpalette(palettevalues)
+        return tile_image
+
+
+def load_sprites(c64colorpalette: Palette=None, scale: float=1.0, alt_c64tileset=False, krissz_c64tileset=False) -> Sequence[bytes]:
+    sprite_src_images = []
+    with load_sprite_sheet(c64colorpalette, alt_c64tileset, krissz_c64tileset) as tile_image:
         tile_num = 0
         if tile_image.width != 128:
             raise IOError("sprites image width should be 8 sprites of 16 pixels = 128 pixels")
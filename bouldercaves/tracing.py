@@ -0,0 +1,154 @@
+"""
+Boulder Caves+ - a Boulder Dash (tm) clone.
+Krissz Engine-compatible remake based on Boulder Caves 5.7.2.
+
+Trace-event recording of the game loop, written in the Chrome trace event format
+(JSON, load it in chrome://tracing or https://ui.perfetto.dev).
+The events are kept in a bounded buffer: in long sessions only the most recent events are written.
+Tracing is off unless start() is called; the traced() functions then only check a global.
+
+Extended version by Michael Kamensky
+
+License: GNU GPL 3.0, see LICENSE
+"""
+
+import os
+import json
+import time
+import functools
+import threading
+import collections
+from typing import Dict, List, Any, Callable, Optional
+
+
+class Tracer:
+    def __init__(self, max_events: int=1000000) -> None:
+        self.events = collections.deque(maxlen=max_events)   # type: collections.deque
+        self.started = time.perf_counter()
+        self.pid = os.getpid()
+        self.thread_ids = {}    # type: Dict[int, int]
+        self.lock = threading.Lock()
+        self.handler_times = {}     # type: Dict[str, List[float]]
+        self.handler_depth = 0      # the handlers run in one thread at a time (under the game state's lock)
+
+    def tid(self) -> int:
+        # small thread numbers read better in the trace viewer than the thread idents
+        ident = threading.get_ident()
+        tid = self.thread_ids.get(ident)
+        if tid is None:
+            with self.lock:
+                tid = self.thread_ids[ident] = len(self.thread_ids) + 1
+        return tid
+
+    def complete(self, name: str, category: str, start: float, end: float, args: Dict[str, Any]=None, tid: int=0) -> None:
+        # a complete ("X") event, start and end are perf_counter() times
+        event = {"name": name, "cat": category, "ph": "X", "pid": self.pid, "tid": tid or self.tid(),
+                 "ts": round((start - self.started) * 1e6, 1), "dur": round((end - start) * 1e6, 1)}
+        if args:
+            event["args"] = args
+        self.events.append(event)
+
+    def trace_handlers(self, obj: Any, names: List[str]) -> None:
+        # Wraps the given methods on the instance, to add up their time and number of calls.
+        # flush_handlers() writes the totals as one event per handler, so a cave scan with thousands
+        # of cells gives a dozen events instead of thousands.
+        # Only the outermost handler call is counted: a handler that calls another one (update_canfall calls
+        # update_falling) already includes that time, and the totals are laid out one after another.
+        for name in names:
+            method = getattr(obj, name)
+            totals = self.handler_times[name] = [0.0, 0]
+
+            def wrapper(*args, method=method, totals=totals):
+                if self.handler_depth:
+                    return method(*args)
+                self.handler_depth = 1
+                start = time.perf_counter()
+                try:
+                    return method(*args)
+                finally:
+                    totals[0] += time.perf_counter() - start
+                    totals[1] += 1
+                    self.handler_depth = 0
+            setattr(obj, name, wrapper)
+
+    def flush_handlers(self, start: float, category: str, tid: int) -> None:
+        # the handler totals are laid out one after another from start, on their own thread track
+        for name, totals in self.handler_times.items():
+            if totals[1]:
+                self.complete(name, category, start, start + totals[0], {"calls": totals[1]}, tid=tid)
+                start += totals[0]
+                totals[0] = 0.0
+                totals[1] = 0
+
+    def write(self, filename: str) -> None:
+        metadata = [{"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid, "args": {"name": name}}
+                    for tid, name in self.thread_names().items()]
+        with open(filename, "w") as out:
+            json.dump({"traceEvents": metadata + list(self.events), "displayTimeUnit": "ms"}, out, separators=(",", ":"))
+
+    def thread_names(self) -> Dict[int, str]:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        result = {tid: names.get(ident, "thread {:d}".format(tid)) for ident, tid in self.thread_ids.items()}
+        result[HANDLERS_TID] = "cave scan handlers (per update)"
+        return result
+
+
+HANDLERS_TID = 1000     # the track for the aggregated cave scan handler events
+tracer = None   # type: Optional[Tracer]
+
+
+def start(max_events: int=1000000) -> Tracer:
+    global tracer
+    tracer = Tracer(max_events)
+    return tracer
+
+
+def stop(filename: str) -> None:
+    global tracer
+    if tracer:
+        tracer.write(filename)
+        tracer = None
+
+
+def traced(name: str, category: str="game") -> Callable:
+    # decorator that records a complete event for each call of the function while tracing
+    def decorate(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            active = tracer     # read once, stop() can run in another thread
+            if active is None:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                active.complete(name, category, start, time.perf_counter())
+        return wrapper
+    return decorate
+
+
+def trace_gamestate(gamestate: Any) -> None:
+    # times the cave scan handlers (the GameState.update_* methods called per cell), and the whole update.
+    # The methods are wrapped only once, a second call does nothing.
+    if tracer is None:
+        raise RuntimeError("tracing is not started")
+    if getattr(gamestate, "traced", False):
+        return
+    gamestate.traced = True
+    handlers = [name for name in dir(type(gamestate)) if name.startswith("update_") and
+                name not in ("update_frame", "update_scorebar")]
+    tracer.trace_handlers(gamestate, handlers)
+    update = gamestate.update
+
+    def traced_update(graphics_frame_counter: int) -> None:
+        active = tracer     # read once, stop() can run in another thread
+        if active is None:
+            update(graphics_frame_counter)
+            return
+        start = time.perf_counter()
+        try:
+            update(graphics_frame_counter)
+        finally:
+            active.complete("GameState.update", "logic", start, time.perf_counter(), {"frame": gamestate.frame})
+            active.flush_handlers(start, "logic", HANDLERS_TID)
+    gamestate.update = traced_update
@@ -0,0 +1,217 @@
+"""
+Boulder Caves+ - a Boulder Dash (tm) clone.
+Krissz Engine-compatible remake based on Boulder Caves 5.7.2.
+
+Batch validator for BDCFF cave files.
+Parses every cave file in the given files/directories (in parallel), runs some sanity checks
+on every cave and writes a report with the object statistics per cave, as JSON or CSV.
+
+$ python3 -m bouldercaves.validate caves/
+
+Extended version by Michael Kamensky
+
+License: GNU GPL 3.0, see LICENSE
+"""
+
+import io
+import os
+import sys
+import csv
+import json
+import functools
+import contextlib
+import concurrent.futures
+from typing import Dict, List, Any, Sequence, TextIO
+from . import bdcff, caves, objects
+
+
+CAVEFILE_EXTENSIONS = (".bd", ".bdcff")
+
+
+def find_cave_files(paths: Sequence[str]) -> List[str]:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, filenames in os.walk(path):
+                dirs.sort()
+                files.extend(os.path.join(root, name) for name in sorted(filenames)
+                             if name.lower().endswith(CAVEFILE_EXTENSIONS))
+        else:
+            files.append(path)
+    return files
+
+
+def validate_cave(caveset: caves.CaveSet, levelnumber: int, bdcffcave: bdcff.BdcffCave) -> Dict[str, Any]:
+    result = {
+        "cave": levelnumber,
+        "name": bdcffcave.name,
+        "width": bdcffcave.width,
+        "height": bdcffcave.height,
+        "diamonds_required": bdcffcave.diamonds_required,
+        "time": bdcffcave.cavetime,
+        "errors": [],
+        "warnings": [],
+        "histogram": {}
+    }       # type: Dict[str, Any]
+    errors, warnings = result["errors"], result["warnings"]
+    bad_lines = [y for y, line in enumerate(bdcffcave.map.maplines) if len(line) != bdcffcave.width]
+    if bad_lines:
+        errors.append("map lines {} differ from the cave width {}".format(bad_lines, bdcffcave.width))
+    unknown = sorted(set("".join(bdcffcave.map.maplines)) - set(caves.BDCFFOBJECTS))
+    if unknown:
+        errors.append("unknown map symbols: " + " ".join(repr(symbol) for symbol in unknown))
+    if errors:
+        return result
+    cave = caveset.cave(levelnumber)
+    histogram = caves.cave_histogram(cave)
+    result["histogram"] = histogram.as_dict()
+    if not histogram.count(objects.INBOXBLINKING):
+        errors.append("no inbox")
+    elif histogram.count(objects.INBOXBLINKING) > 1:
+        warnings.append("more than one inbox")
+    if not histogram.count(objects.OUTBOXCLOSED, objects.OUTBOXHIDDEN):
+        errors.append("no outbox")
+    num_slime = histogram.count(objects.SLIME)
+    if num_slime:
+        if 0 <= cave.krissz_slime_permeability <= 8:
+            from .helpers import CaveStatsHelper
+            permeable = CaveStatsHelper.c64_slime_permeability(num_slime, cave.krissz_slime_permeability)
+            impermeable = permeable.count(False)
+        else:
+            impermeable = 0 if cave.slime_permeability > 0 else num_slime
+        result["impermeable_slime"] = impermeable
+        if impermeable:
+            warnings.append("{} of {} slime cells are impermeable".format(impermeable, num_slime))
+    return result
+
+
+def validate_file(filename: str, use_cache: bool=True) -> Dict[str, Any]:
+    # runs in a worker process. The file is parsed once (the parse cache keeps the parser warnings too);
+    # the warnings of a cave go into that cave's report, the rest into the file's report.
+    result = {"file": filename, "errors": [], "warnings": [], "caves": []}     # type: Dict[str, Any]
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            parser = bdcff.BdcffParser(filename, use_cache=use_cache)
+            caveset = caves.CaveSet(parser)
+            for levelnumber, bdcffcave in enumerate(parser.caves, start=1):
+                cave_result = validate_cave(caveset, levelnumber, bdcffcave)
+                cave_result["warnings"][:0] = [warning_text(message) for message in bdcffcave.warnings]
+                result["caves"].append(cave_result)
+    except bdcff.BdcffFormatError as x:
+        # a single bad cave makes the whole file fail to parse, validate the caves one by one to report it there
+        result["caves"] = []
+        validate_caves_separately(filename, result)
+        if not result["errors"] and not any(cave["errors"] for cave in result["caves"]):
+            result["errors"].append("{}: {}".format(type(x).__name__, x))
+        return result
+    except (ValueError, LookupError, OSError, UnicodeDecodeError) as x:
+        result["errors"].append("{}: {}".format(type(x).__name__, x))
+        return result
+    cave_warnings = {message for bdcffcave in parser.caves for message in bdcffcave.warnings}
+    result["warnings"] = [warning_text(message) for message in parser.warnings if message not in cave_warnings]
+    result["name"] = parser.name
+    result["author"] = parser.author
+    result["date"] = parser.date
+    result["num_caves"] = parser.num_caves
+    return result
+
+
+def validate_caves_separately(filename: str, result: Dict[str, Any]) -> None:
+    # uses the cave index, that parses every cave on its own
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            index = bdcff.BdcffCaveIndex(filename, use_cache=False)
+            result["name"] = index.name
+            result["author"] = index.author
+            result["date"] = index.date
+            result["num_caves"] = index.num_caves
+            caveset = caves.CaveSet(index)
+            for levelnumber, name in enumerate(index.cave_names, start=1):
+                try:
+                    bdcffcave = index.cave(levelnumber - 1)
+                except (bdcff.BdcffFormatError, ValueError, LookupError) as x:
+                    result["caves"].append({
+                        "cave": levelnumber, "name": name, "width": None, "height": None,
+                        "diamonds_required": None, "time": None,
+                        "errors": ["{}: {}".format(type(x).__name__, x)], "warnings": [], "histogram": {}
+                    })
+                    continue
+                cave_result = validate_cave(caveset, levelnumber, bdcffcave)
+                cave_result["warnings"][:0] = [warning_text(message) for message in bdcffcave.warnings]
+                result["caves"].append(cave_result)
+    except (bdcff.BdcffFormatError, ValueError, LookupError, OSError, UnicodeDecodeError) as x:
+        result["errors"].append("{}: {}".format(type(x).__name__, x))
+
+
+def warning_text(message: str) -> str:
+    # the parser warnings are written for the console, over several lines
+    return " ".join(message.split())
+
+
+def validate_files(filenames: Sequence[str], jobs: int=0, use_cache: bool=True) -> List[Dict[str, Any]]:
+    if jobs == 1 or len(filenames) <= 1:
+        return [validate_file(filename, use_cache) for filename in filenames]
+    jobs = jobs or os.cpu_count() or 1
+    chunksize = max(1, len(filenames) // (4 * jobs))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(functools.partial(validate_file, use_cache=use_cache), filenames, chunksize=chunksize))
+
+
+def summary(results: List[Dict[str, Any]]) -> Dict[str, int]:
+    cave_results = [cave for result in results for cave in result["caves"]]
+    return {
+        "files": len(results),
+        "files_with_errors": sum(1 for result in results if result["errors"] or any(cave["errors"] for cave in result["caves"])),
+        "caves": len(cave_results),
+        "caves_with_errors": sum(1 for cave in cave_results if cave["errors"]),
+        "caves_with_warnings": sum(1 for cave in cave_results if cave["warnings"])
+    }
+
+
+def write_json(results: List[Dict[str, Any]], out: TextIO) -> None:
+    json.dump({"summary": summary(results), "files": results}, out, indent=1)
+    out.write("\n")
+
+
+def write_csv(results: List[Dict[str, Any]], out: TextIO) -> None:
+    # one row per cave (or per file, if the file couldn't be parsed), with a column for every object that occurs
+    object_names = sorted({name for result in results for cave in result["caves"] for name in cave["histogram"]})
+    writer = csv.writer(out)
+    writer.writerow(["file", "cave", "name", "width", "height", "diamonds_required", "time", "errors", "warnings"] + object_names)
+    for result in results:
+        if not result["caves"]:
+            writer.writerow([result["file"], "", result.get("name", ""), "", "", "", "",
+                             "; ".join(result["errors"]), "; ".join(result["warnings"])] + [""] * len(object_names))
+        for cave in result["caves"]:
+            writer.writerow([result["file"], cave["cave"], cave["name"], cave["width"], cave["height"],
+                             cave["diamonds_required"], cave["time"],
+                             "; ".join(result["errors"] + cave["errors"]), "; ".join(result["warnings"] + cave["warnings"])]
+                            + [cave["histogram"].get(name, 0) for name in object_names])
+
+
+def main(sargs: Sequence[str]=None) -> int:
+    if sargs is None:
+        sargs = sys.argv[1:]
+    import argparse
+    ap = argparse.ArgumentParser(description="Boulder Caves+ - validate BDCFF cave files and report cave statistics")
+    ap.add_argument("paths", nargs="+", help="cave files and/or directories to scan for .bd/.bdcff files")
+    ap.add_argument("-f", "--format", help="report format (default=%(default)s).", choices=("json", "csv"), default="json")
+    ap.add_argument("-o", "--output", help="write the report to this file instead of to the console.")
+    ap.add_argument("-j", "--jobs", type=int, help="number of worker processes (default=number of cpus).", default=0)
+    ap.add_argument("--nocavecache", help="don't use the cache of parsed cave files, always parse the cave file.", action="store_true")
+    args = ap.parse_args(sargs)
+    results = validate_files(find_cave_files(args.paths), args.jobs, not args.nocavecache)
+    writer = write_json if args.format == "json" else write_csv
+    if args.output:
+        with open(args.output, "w", newline="" if args.format == "csv" else None) as out:
+            writer(results, out)
+    else:
+        writer(results, sys.stdout)
+    totals = summary(results)
+    print("Validated {caves} caves in {files} files: {caves_with_errors} caves with errors, {caves_with_warnings} with warnings."
+          .format(**totals), file=sys.stderr)
+    return 1 if totals["files_with_errors"] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -14,18 +14,29 @@ License: GNU GPL 3.0, see LICENSE
 import pkgutil
 import os
 import sys
+import queue
+import threading
 import subprocess
 import tkinter as tk
 import tkinter.messagebox
 from tkinter import ttk
 from bouldercaves.helpers import KeyHelper
+from bouldercaves.caveindex import CaveLibraryIndex
+from bouldercaves.thumbnails import ThumbnailRenderer
 
 VERSION = "1.1.4"
 
 DEFAULT_CAVE = "Boulder Dash I (by Peter Liepa)"
 DEFAULT_FOLDER = "-- no folder --"
+SORT_ORDERS = {"File Name": "file", "Cave Set Name": "name", "Author": "author", "Date": "date",
+               "Number of Caves": "caves", "Cave Size": "size", "Diamonds Required": "diamonds",
+               "Diamonds on Map": "diamonds on map", "Time Limit": "time"}
+
+THUMBNAIL_TILESETS = {"1": "krissz", "2": "c64", "3": "boulderrush"}     # per game variant
 
 window = tk.Tk()
+cave_index = None   # metadata of the cave files, refreshed in the background
+thumbnail_renderers = {}    # per tile set, they render the cave previews in a thread pool
 
 def get_folder_list():
     folder_list = [DEFAULT_FOLDER]
@@ -35,16 +46,61 @@ def get_folder_list():
     folder_list.sort()
     return folder_list
     
-def get_cave_list(folder_name):
+def get_cave_list(folder_name, filter_text="", sort_order="file"):
     cave_list = []
     if folder_name == DEFAULT_FOLDER:
         folder_name = ""
-    for filename in os.listdir(os.path.join("caves", folder_name)):
-        if (filename.endswith(".bd") or filename.endswith(".bdcff")):
-            cave_list.append(filename[0:filename.rfind(".")])
-    cave_list.sort()
+    cave_files = [filename for filename in os.listdir(os.path.join("caves", folder_name))
+                  if filename.endswith(".bd") or filename.endswith(".bdcff")]
+    if cave_index and (filter_text or sort_order != "file"):
+        # filter and sort on the cave metadata; files that aren't indexed yet are matched on their name and listed last
+        indexed = [entry["file"].rpartition("/")[2] for entry in cave_index.query(folder_name, filter_text, sort_order)]
+        not_indexed = [filename for filename in cave_files if not cave_index.get("/".join(filter(None, [folder_name, filename])))]
+        cave_files_set = set(cave_files)
+        cave_files = [filename for filename in indexed if filename in cave_files_set]
+        cave_files += sorted(filename for filename in not_indexed if filter_text.lower().strip() in filename.lower())
+    else:
+        cave_files.sort()
+    for filename in cave_files:
+        cave_list.append(filename[0:filename.rfind(".")])
     return cave_list
 
+def get_cave_filename(folder_name, cave_name):
+    if folder_name == DEFAULT_FOLDER:
+        folder_name = ""
+    if cave_name == DEFAULT_CAVE:
+        return None
+    for extension in (".bd", ".bdcff"):
+        filename = os.path.join("caves", folder_name, cave_name + extension)
+        if os.path.exists(filename):
+            return filename
+    return None
+
+def get_thumbnail_renderer(game_mode):
+    tileset = THUMBNAIL_TILESETS.get(game_mode, "krissz")
+    if tileset not in thumbnail_renderers:
+        thumbnail_renderers[tileset] = ThumbnailRenderer(tileset)
+    return thumbnail_renderers[tileset]
+
+def get_cave_info(folder_name, cave_name):
+    # a short description of the cave file from the metadata index
+    if folder_name == DEFAULT_FOLDER:
+        folder_name = ""
+    if not cave_index or cave_name == DEFAULT_CAVE:
+        return ""
+    for extension in (".bd", ".bdcff"):
+        entry = cave_index.get("/".join(filter(None, [folder_name, cave_name + extension])))
+        if entry:
+            if entry["error"]:
+                return f"Error: {entry['error']}"
+            sizes = sorted({f"{w}x{h}" for w, h in entry["sizes"]})
+            info = f"{entry['name']} by {entry['author']}"
+            info += f" ({entry['date']})" if entry["date"] else ""
+            info += f"\n{entry['num_caves']} cave{'s' if entry['num_caves'] != 1 else ''}, size {', '.join(sizes[:3])}"
+            info += "..." if len(sizes) > 3 else ""
+            return info
+    return ""
+
 def load_settings():
     game_mode = "1"
     target_60fps = False
@@ -334,22 +390,102 @@ def run():
     scrollbar = tk.Scrollbar(frame_caveList)
     scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
 
+    prerendered_folder = None
+    filter_after_id = None
+
     def update_cavelist(eventinfo):
         cave_listbox.delete(0, tk.END)
-        cave_list = get_cave_list(folders_cbbox.get())
-        if folders_cbbox.get() == DEFAULT_FOLDER:
+        cave_list = get_cave_list(folders_cbbox.get(), filter_var.get(), SORT_ORDERS[sort_cbbox.get()])
+        if folders_cbbox.get() == DEFAULT_FOLDER and filter_var.get().lower().strip() in DEFAULT_CAVE.lower():
             cave_listbox.insert(tk.END, DEFAULT_CAVE)
         for cave_file in cave_list:
             cave_listbox.insert(tk.END, cave_file)
         cave_listbox.selection_set(0)
-        
+        update_cave_info(None)
+        # Render the previews of the whole folder in the background, so they show up instantly when selected.
+        # That's only needed once per folder and tile set: filtering or sorting just shows part of the same folder.
+        nonlocal prerendered_folder, filter_after_id
+        filter_after_id = None
+        if prerendered_folder != (folders_cbbox.get(), game_mode.get()):
+            prerendered_folder = (folders_cbbox.get(), game_mode.get())
+            renderer = get_thumbnail_renderer(game_mode.get())
+            for cave_name in get_cave_list(folders_cbbox.get()):
+                cave_file = get_cave_filename(folders_cbbox.get(), cave_name)
+                if cave_file:
+                    renderer.submit(cave_file)
+
+    def filter_changed(eventinfo):
+        # the list is only updated when typing pauses, not for every keystroke
+        nonlocal filter_after_id
+        if filter_after_id:
+            window.after_cancel(filter_after_id)
+        filter_after_id = window.after(250, update_cavelist, None)
+
+    def update_cave_info(eventinfo):
+        selection = cave_listbox.curselection()
+        cave_info_var.set(get_cave_info(folders_cbbox.get(), cave_listbox.get(selection[0])) if selection else "")
+        cave_file = get_cave_filename(folders_cbbox.get(), cave_listbox.get(selection[0])) if selection else None
+        thumbnail_label.cave_file = cave_file
+        if cave_file:
+            get_thumbnail_renderer(game_mode.get()).submit(cave_file, on_done=lambda cave_file, thumbnail: thumbnails_done.put((cave_file, thumbnail)))
+        else:
+            thumbnail_label.configure(image="")
+            thumbnail_label.image = None
+
+    def check_thumbnails():
+        # thumbnails are rendered in a thread pool, they're shown here in the Tk thread
+        while not thumbnails_done.empty():
+            cave_file, thumbnail = thumbnails_done.get()
+            if cave_file == thumbnail_label.cave_file:
+                image = tk.PhotoImage(file=thumbnail) if thumbnail else None
+                if image and (image.width() > 240 or image.height() > 160):
+                    factor = max((image.width() + 239) // 240, (image.height() + 159) // 160)
+                    image = image.subsample(factor)
+                thumbnail_label.configure(image=image or "")
+                thumbnail_label.image = image
+        window.after(100, check_thumbnails)
+
+    def check_index_refreshed():
+        # the index is refreshed on a background thread, the list is updated here in the Tk thread
+        if index_refreshed.is_set():
+            index_refreshed.clear()
+            selection = cave_listbox.curselection()
+            selected_cave = cave_listbox.get(selection[0]) if selection else None
+            update_cavelist(None)
+            for cave_id in range(cave_listbox.size()):
+                if cave_listbox.get(cave_id) == selected_cave:
+                    cave_listbox.selection_clear(0, cave_listbox.size())
+                    cave_listbox.selection_set(cave_id)
+                    cave_listbox.see(cave_id)
+                    update_cave_info(None)
+                    break
+        window.after(250, check_index_refreshed)
+
     cave_listbox_height = 8 if window.winfo_screenheight() >= 720 else 5
     folders_cbbox = tk.ttk.Combobox(frame_caveList, width=28, state="readonly")
     folders_cbbox.bind("<<ComboboxSelected>>", update_cavelist)
     folders_cbbox.pack()
-    cave_listbox = tk.Listbox(frame_caveList, yscrollcommand=scrollbar.set, width=30, height=cave_listbox_height)
+    frame_filter = tk.Frame(frame_caveList)
+    filter_var = tk.StringVar(window, "")
+    tk.Label(frame_filter, text="Find:").pack(side=tk.LEFT)
+    filter_entry = tk.Entry(frame_filter, textvariable=filter_var, width=10)
+    filter_entry.bind("<KeyRelease>", filter_changed)
+    filter_entry.pack(side=tk.LEFT)
+    sort_cbbox = tk.ttk.Combobox(frame_filter, width=14, state="readonly", values=list(SORT_ORDERS))
+    sort_cbbox.current(0)
+    sort_cbbox.bind("<<ComboboxSelected>>", update_cavelist)
+    sort_cbbox.pack(side=tk.LEFT)
+    frame_filter.pack()
+    cave_listbox = tk.Listbox(frame_caveList, yscrollcommand=scrollbar.set, width=30, height=cave_listbox_height, exportselection=False)
+    cave_listbox.bind("<<ListboxSelect>>", update_cave_info)
     cave_listbox.pack()
     scrollbar.config(command=cave_listbox.yview)
+    cave_info_var = tk.StringVar(window, "")
+    tk.Label(frame_caveList, textvariable=cave_info_var, width=36, height=2).pack()
+    thumbnail_label = tk.Label(frame_caveList)
+    thumbnail_label.cave_file = thumbnail_label.image = None
+    thumbnail_label.pack()
+    thumbnails_done = queue.SimpleQueue()
 
     separator = ttk.Separator(window, orient='horizontal')
     separator.pack(fill='x', pady=2)
@@ -445,7 +581,14 @@ def run():
     separator6.pack(fill='x', pady=2)
     frame_buttons.pack(side=tk.BOTTOM, expand=True, padx=5, pady=5)
     # --- TK interface ---
-    
+
+    global cave_index
+    cave_index = CaveLibraryIndex("caves")
+    index_refreshed = threading.Event()
+    cave_index.refresh_in_background(lambda changed: index_refreshed.set() if changed else None)
+    window.after(250, check_index_refreshed)
+    window.after(100, check_thumbnails)
+
     folder_list = get_folder_list()
     folders_cbbox["values"] = folder_list
     folders_cbbox.current(0)